@@ -1,31 +1,86 @@
+import time
+
+# Everything in the startup timeline is measured from here
+STARTUP_STARTED = time.perf_counter()
+
+import base64
+import bisect
+import collections
+import contextlib
+import errno
+import hashlib
+import heapq
+import html as html_lib
+import importlib
+import importlib.util
+import itertools
+import json
+import math
+import multiprocessing
 import os
+import re
+import signal
 import socket
+import sqlite3
 import subprocess
 import sys
 import threading
-import time
-from datetime import datetime
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
 from typing import List, Set, Tuple
+from urllib.parse import quote
 
-from PIL import Image, ExifTags
 import io
-import markdown as markdown_lib
-from flask import Flask, jsonify, send_from_directory, request, make_response
-from mutagen.id3 import ID3NoHeaderError
-from mutagen.mp3 import MP3
-from watchdog.events import FileSystemEventHandler
-from watchdog.observers import Observer
+from flask import Flask, jsonify, send_file, send_from_directory, request, make_response
+from werkzeug.http import is_resource_modified
+from werkzeug.security import safe_join
 
 # Force unbuffered output
 sys.stdout.reconfigure(line_buffering=True)
 sys.stderr.reconfigure(line_buffering=True)
 
-try:
-    from zeroconf import ServiceInfo, Zeroconf, NonUniqueNameException, IPVersion, InterfaceChoice
-    ZEROCONF_AVAILABLE = True
-except ImportError:
-    ZEROCONF_AVAILABLE = False
-    print("Warning: zeroconf not installed. mDNS service will not be available.")
+# Pillow, markdown, mutagen, watchdog, zeroconf, waitress and xhtml2pdf are imported
+# on first use through lazy_module(), so importing this module stays cheap.
+ZEROCONF_AVAILABLE = importlib.util.find_spec('zeroconf') is not None
+WAITRESS_AVAILABLE = importlib.util.find_spec('waitress') is not None
+
+STARTUP_TIMELINE = []  # (kind, name, offset from STARTUP_STARTED, seconds), for startup_report()
+STARTUP_TIMELINE_LOCK = threading.Lock()
+
+def record_startup(kind, name, started):
+    """Add an entry that began at perf_counter() value `started` and ends now"""
+    with STARTUP_TIMELINE_LOCK:
+        STARTUP_TIMELINE.append((kind, name, started - STARTUP_STARTED, time.perf_counter() - started))
+
+@contextlib.contextmanager
+def startup_phase(name):
+    """Time a step of the server start phase for the startup timeline"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_startup('phase', name, started)
+
+def lazy_module(name):
+    """Import a heavy module on first use, recording the import in the startup timeline"""
+    module = sys.modules.get(name)
+    if module is None:
+        started = time.perf_counter()
+        module = importlib.import_module(name)
+        record_startup('import', name, started)
+    return module
+
+def startup_report():
+    """Print the startup timeline: phases and lazy imports, in the order they finished"""
+    print("Startup timeline (offset / duration):")
+    with STARTUP_TIMELINE_LOCK:
+        entries = list(STARTUP_TIMELINE)
+    for kind, name, offset, seconds in entries:
+        indent = "    " if kind == 'import' else "  "
+        print(f"{indent}{offset * 1000:8.1f} ms  {seconds * 1000:8.1f} ms  {kind} {name}")
+    print(f"  Listening after {(time.perf_counter() - STARTUP_STARTED) * 1000:.1f} ms")
 
 app = Flask(__name__)
 
@@ -55,15 +110,74 @@ def handle_exception(e):
     # For other routes, return HTML error page
     return str(e), 500
 
+FIRST_REQUEST_AT = None  # perf_counter() value when the first request came in
+
+@app.before_request
+def note_first_request():
+    """Log how long after start the first request was picked up (time to first request)"""
+    global FIRST_REQUEST_AT
+    if FIRST_REQUEST_AT is not None:
+        return
+    with STARTUP_TIMELINE_LOCK:
+        if FIRST_REQUEST_AT is not None:
+            return
+        FIRST_REQUEST_AT = time.perf_counter()
+    print(f"Ready: first request ({request.method} {request.path}) "
+          f"{(FIRST_REQUEST_AT - STARTUP_STARTED) * 1000:.1f} ms after start")
+
 # Configuration
 MUSIC_FOLDER = os.path.join(os.path.dirname(__file__), 'music')
 PICTURES_FOLDER = os.path.join(os.path.dirname(__file__), 'pictures')
 DOCUMENTS_FOLDER = os.path.join(os.path.dirname(__file__), 'documents')
 THUMBNAILS_FOLDER = os.path.join(os.path.dirname(__file__), '.thumbnails')
-
-METADATA_CACHE = [] # Music cache
-PICTURES_CACHE = []
-DOCUMENTS_CACHE = []
+PICTURE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+# Thumbnail variants: every configured size is generated in every format
+THUMBNAIL_SIZES = tuple(sorted(int(size) for size in os.environ.get("THUMBNAIL_SIZES", "96,300,600").split(',')))
+DEFAULT_THUMBNAIL_SIZE = 300 if 300 in THUMBNAIL_SIZES else THUMBNAIL_SIZES[-1]
+THUMBNAIL_FORMATS = {'jpeg': ('JPEG', 'jpg'), 'webp': ('WEBP', 'webp')}  # format -> (Pillow name, extension)
+THUMBNAIL_QUALITY = 70
+# Disk quota for the thumbnail cache; least recently served thumbnails are evicted first
+THUMBNAIL_CACHE_MAX_BYTES = int(float(os.environ.get("THUMBNAIL_CACHE_MAX_MB", 200)) * 1024 * 1024)
+THUMBNAIL_WORKERS = max(1, int(os.environ.get("THUMBNAIL_WORKERS", 1)))
+# How long a thumbnail request waits for a pending job before serving a placeholder
+THUMBNAIL_WAIT_SECONDS = float(os.environ.get("THUMBNAIL_WAIT_SECONDS", 5))
+# Rendered documents (PDFs) cached on disk, keyed by document mtime and renderer version
+RENDER_CACHE_FOLDER = os.path.join(os.path.dirname(__file__), '.render_cache')
+PDF_WORKERS = max(1, int(os.environ.get("PDF_WORKERS", 1)))
+# Render PDFs in the background as soon as a .md file appears instead of on first download
+PDF_PRERENDER = os.environ.get("PDF_PRERENDER", "0") == "1"
+# How long a PDF request waits for its render before answering 503 + Retry-After
+PDF_WAIT_SECONDS = float(os.environ.get("PDF_WAIT_SECONDS", 60))
+# Paged /api/documents/<filename>/html splits at headings into pages of about this many characters
+DOCUMENT_PAGE_CHARS = max(1, int(os.environ.get("DOCUMENT_PAGE_CHARS", 20000)))
+# How long an HTML viewer request waits for its render before answering 503 + Retry-After
+HTML_WAIT_SECONDS = float(os.environ.get("HTML_WAIT_SECONDS", 10))
+# HTTP serving: SERVER_ENGINE=waitress (production, the default when installed) or dev
+# (Werkzeug's development server). SERVER_THREADS bounds concurrent requests, including
+# long-running audio streams; connections beyond SERVER_CONNECTION_LIMIT wait in the
+# listen backlog, and idle keep-alive connections are closed after SERVER_CHANNEL_TIMEOUT.
+SERVER_ENGINE = os.environ.get("SERVER_ENGINE", "waitress" if WAITRESS_AVAILABLE else "dev").lower()
+SERVER_THREADS = max(1, int(os.environ.get("SERVER_THREADS", 8)))
+SERVER_CONNECTION_LIMIT = max(1, int(os.environ.get("SERVER_CONNECTION_LIMIT", 100)))
+SERVER_CHANNEL_TIMEOUT = int(os.environ.get("SERVER_CHANNEL_TIMEOUT", 120))
+# /music/<filename> hands open files to the server (wsgi.file_wrapper) for full and ranged
+# responses; STREAM_FILE_WRAPPER=0 falls back to send_from_directory
+STREAM_FILE_WRAPPER = os.environ.get("STREAM_FILE_WRAPPER", "1") != "0"
+STREAM_CHUNK_SIZE = 256 * 1024
+MAX_BYTE_RANGES = 16  # Larger multi-range requests get the whole file instead
+# Persistent metadata index so restarts only re-parse files whose stat changed
+METADATA_INDEX_PATH = os.environ.get(
+    "METADATA_INDEX_PATH", os.path.join(os.path.dirname(__file__), '.metadata_index.sqlite3')
+)
+
+# Worker pool for full scans: SCAN_MAX_WORKERS caps concurrency (1 = serial, e.g. on a
+# Pi Zero); libraries listed in SCAN_PROCESS_KINDS are parsed in processes, the rest in threads.
+# Picture parsing only reads headers, so processes are opt-in (SCAN_PICTURE_PROCESSES=1).
+SCAN_MAX_WORKERS = max(1, int(os.environ.get("SCAN_MAX_WORKERS", os.cpu_count() or 1)))
+SCAN_PROCESS_KINDS = ('pictures',) if os.environ.get("SCAN_PICTURE_PROCESSES", "0") == "1" else ()
+SCAN_STATS = {}  # Per-library counts of reused vs re-parsed index entries from the last scan
+# Serializes library writers (scans and per-file updates) among themselves. Readers never
+# take it: they read the current immutable snapshot from LIBRARIES instead.
 FILE_CHANGE_LOCK = threading.Lock()
 
 # mDNS Configuration
@@ -75,12 +189,17 @@ SERVICE_NAME = os.environ.get("SERVICE_NAME", HOSTNAME)
 SERVICE_TYPE = "_http._tcp.local."
 SERVICE_TYPE_SHORT = SERVICE_TYPE.replace(".local.", "")  # For avahi-publish-service
 
-# Additional service types for Android compatibility
-ADDITIONAL_SERVICE_TYPES = [
-    "_workstation._tcp.local.",
-    "_smb._tcp.local.",
-    "_airplay._tcp.local.",
+# Services published for the server as (instance name suffix, type, extra TXT records);
+# the first is the primary one. _workstation and _airplay help Android discovery.
+MDNS_SERVICES = [
+    ("", SERVICE_TYPE, {}),
+    ("", "_workstation._tcp.local.", {}),
+    ("-airplay", "_airplay._tcp.local.", {'device': 'Music Server', 'fv': '1'}),
 ]
+# "zeroconf" (default): one in-process responder, falling back to avahi-publish-service
+# if zeroconf is missing or fails; "avahi": always use avahi-publish-service
+MDNS_RESPONDER = os.environ.get("MDNS_RESPONDER", "zeroconf").lower()
+AVAHI_PID_FILE = '/tmp/music_server_avahi.pids'  # Survives os.execv restarts, so children can be reaped
 
 # Auto-detect available port
 def find_available_port(start_port=5000, max_tries=100):
@@ -95,22 +214,28 @@ def find_available_port(start_port=5000, max_tries=100):
             continue
     raise RuntimeError(f"Could not find an available port in range {start_port}-{start_port + max_tries}")
 
-# Default preferred port
+# Default preferred port; prepare_server() replaces SERVICE_PORT with the port actually bound
 PREFERRED_SERVICE_PORT = int(os.environ.get("SERVICE_PORT", 5000))
-SERVICE_PORT = find_available_port(PREFERRED_SERVICE_PORT)
+SERVICE_PORT = PREFERRED_SERVICE_PORT
+SERVICE_PORT_FILE = '/tmp/music_server_port.txt'
 
-if SERVICE_PORT != PREFERRED_SERVICE_PORT:
-    print(f"Port {PREFERRED_SERVICE_PORT} was in use, using port {SERVICE_PORT} instead")
-else:
-    print(f"Using port {SERVICE_PORT}")
+def select_service_port():
+    """Pick the listening port and publish it for the captive portal configuration"""
+    global SERVICE_PORT
+    SERVICE_PORT = find_available_port(PREFERRED_SERVICE_PORT)
 
-# Write port to file for captive portal configuration
-try:
-    with open('/tmp/music_server_port.txt', 'w') as f:
-        f.write(str(SERVICE_PORT))
-    print(f"Wrote port to /tmp/music_server_port.txt for captive portal")
-except Exception as e:
-    print(f"Warning: Could not write port file: {e}")
+    if SERVICE_PORT != PREFERRED_SERVICE_PORT:
+        print(f"Port {PREFERRED_SERVICE_PORT} was in use, using port {SERVICE_PORT} instead")
+    else:
+        print(f"Using port {SERVICE_PORT}")
+
+    # Write port to file for captive portal configuration
+    try:
+        with open(SERVICE_PORT_FILE, 'w') as f:
+            f.write(str(SERVICE_PORT))
+        print(f"Wrote port to {SERVICE_PORT_FILE} for captive portal")
+    except Exception as e:
+        print(f"Warning: Could not write port file: {e}")
 
 # Configure iptables for captive portal (if setup was chosen)
 def configure_iptables_captive_portal():
@@ -144,81 +269,105 @@ def configure_iptables_captive_portal():
             )
             print(f"✓ Configured captive portal: redirecting port 80 -> {SERVICE_PORT}")
     except Exception as e:
-        # Silent fail - iptables might need sudo or not be available
-        pass
+        # iptables might need sudo or not be available; the server works without the redirect
+        print(f"Captive portal redirect not configured: {e}")
 
-# Try to configure iptables (may fail without sudo, that's OK)
-configure_iptables_captive_portal()
+def start_captive_portal_redirect():
+    """Configure the port 80 redirect on a background thread, so its subprocesses don't delay serving"""
+    def configure():
+        with startup_phase('captive portal iptables'):
+            configure_iptables_captive_portal()
+
+    threading.Thread(target=configure, name='captive-portal', daemon=True).start()
 
 REGISTERED_SERVICE_NAME = SERVICE_NAME
-AVAHI_PROCESS = None
+AVAHI_PROCESSES = []  # avahi-publish-service children, only when the avahi fallback is in use
 
 # WiFi Configuration
 WIFI_CONFIG_PATH = "/etc/wpa_supplicant/wpa_supplicant.conf"
 INTERNET_AVAILABLE = False
-
-class MusicEventHandler(FileSystemEventHandler):
-    """Handle file system events for music folder"""
+# Seconds between background internet checks (network changes trigger an immediate one)
+CONNECTIVITY_CHECK_INTERVAL = float(os.environ.get("CONNECTIVITY_CHECK_INTERVAL", 15))
+WIFI_INTERFACE = os.environ.get("WIFI_INTERFACE", "wlan0")
+# Seconds between background WiFi link-state polls served by /api/wifi/status
+WIFI_STATUS_INTERVAL = float(os.environ.get("WIFI_STATUS_INTERVAL", 5))
+# /api/wifi/networks rescans in the background once its cached results are older than this
+WIFI_SCAN_MAX_AGE = float(os.environ.get("WIFI_SCAN_MAX_AGE", 30))
+# Seconds between background `tailscale status` refreshes (up/down and address changes trigger one)
+TAILSCALE_STATUS_INTERVAL = float(os.environ.get("TAILSCALE_STATUS_INTERVAL", 15))
+
+class MusicEventHandler:
+    """Apply per-file library updates for changes in the music, pictures and documents folders.
+
+    Implements watchdog's handler interface (dispatch) without subclassing
+    FileSystemEventHandler, so watchdog is only imported when the monitor starts.
+    """
 
     def __init__(self):
-        super().__init__()
         self.debounce_delay = 0.5
-        self.last_change_time = 0
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._timer = None
+
+    def dispatch(self, event):
+        handler = getattr(self, f"on_{event.event_type}", None)
+        if handler:
+            handler(event)
 
     def on_created(self, event):
         if event.is_directory:
             return
-
-        # Check extension
-        is_music = event.src_path.lower().endswith('.mp3')
-        is_picture = event.src_path.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'))
-        is_doc = not event.is_directory and not is_music and not is_picture and not os.path.basename(event.src_path).startswith('.')
-
-        if is_music or is_picture or is_doc:
+        if library_kind_for_path(event.src_path):
             print(f"File created: {event.src_path}")
-            self._trigger_reload()
+            self._queue_change(event.src_path)
 
     def on_deleted(self, event):
         if event.is_directory:
             return
-
-        # Check extension
-        is_music = event.src_path.lower().endswith('.mp3')
-        is_picture = event.src_path.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'))
-        is_doc = not event.is_directory and not is_music and not is_picture and not os.path.basename(event.src_path).startswith('.')
-
-        if is_music or is_picture or is_doc:
+        if library_kind_for_path(event.src_path):
             print(f"File deleted: {event.src_path}")
-            self._trigger_reload()
+            self._queue_change(event.src_path)
 
     def on_modified(self, event):
         if event.is_directory:
             return
-
-        # Check extension to decide if reload is needed
-        is_music = event.src_path.lower().endswith('.mp3')
-        is_picture = event.src_path.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'))
-        is_doc = not event.is_directory and not is_music and not is_picture and not os.path.basename(event.src_path).startswith('.')
-
-        if is_music or is_picture or is_doc:
+        if library_kind_for_path(event.src_path):
             print(f"File modified: {event.src_path}")
-            self._trigger_reload()
+            self._queue_change(event.src_path)
 
-    def _trigger_reload(self):
-        current_time = time.time()
-        if current_time - self.last_change_time < self.debounce_delay:
+    def on_moved(self, event):
+        if event.is_directory:
             return
+        # A rename is a removal of the old path plus an insertion of the new one;
+        # either side may fall outside the watched libraries.
+        paths = [p for p in (event.src_path, event.dest_path) if library_kind_for_path(p)]
+        if paths:
+            print(f"File moved: {event.src_path} -> {event.dest_path}")
+        for path in paths:
+            self._queue_change(path)
+
+    def _queue_change(self, path):
+        # Debounce bursts (e.g. a file being copied in) so each path is parsed once
+        # after writes settle, without dropping events for other paths.
+        with self._pending_lock:
+            self._pending.add(path)
+            if self._timer:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.debounce_delay, self._apply_pending)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _apply_pending(self):
+        with self._pending_lock:
+            paths = sorted(self._pending)
+            self._pending.clear()
+            self._timer = None
 
-        self.last_change_time = current_time
-        time.sleep(self.debounce_delay)
-
-        print("Acquiring lock for metadata reload...")
         with FILE_CHANGE_LOCK:
-            print("Lock acquired. Reloading metadata...")
-            load_metadata()
-            load_picture_metadata()
-            load_document_metadata()
-            print("Metadata reload complete.")
+            for path in paths:
+                kind = library_kind_for_path(path)
+                if kind:
+                    apply_library_change(kind, path)
 
 def decode_text(data):
     """
@@ -274,336 +423,1796 @@ def decode_text(data):
         except:
             return ""
 
-def get_exif_data(image_path):
-    """Extract EXIF and IPTC data from image (compatible with Pillow 6.x+)"""
+EMPTY_IMAGE_METADATA = {'width': 0, 'height': 0, 'title': '', 'caption': '', 'make': '', 'model': '', 'date_taken': ''}
+
+def _iptc_text(val):
+    """Decode an IPTC dataset value (bytes, or a list of them for repeated datasets)"""
+    if isinstance(val, list):
+        val = val[0] if val else b''
+    if isinstance(val, bytes):
+        return val.decode('utf-8', errors='ignore').strip()
+    return str(val).strip()
+
+def _header_exif(img):
+    """EXIF tags by name, read only from metadata already parsed out of the header.
+
+    PNG's _getexif() decodes the whole image looking for a trailing eXIf chunk when
+    the header has none, so it is only called when the header carried EXIF.
+    """
+    if 'exif' not in img.info:
+        return {}
     try:
-        img = Image.open(image_path)
-        width, height = img.size
-        
-        # Try to get EXIF data safely
-        exif = {}
+        raw_exif = img._getexif()
+    except (AttributeError, TypeError, ValueError, SyntaxError, OSError):
+        return {}
+    if not raw_exif:
+        return {}
+    tags = lazy_module('PIL.ExifTags').TAGS
+    return {tags.get(k, k): v for k, v in raw_exif.items()}
+
+def _header_iptc(img):
+    """IPTC datasets from the header (JPEG APP13 / TIFF tag), or {}"""
+    try:
+        return lazy_module('PIL.IptcImagePlugin').getiptcinfo(img) or {}
+    except Exception as e:
+        print(f"IPTC read error: {e}")
+        return {}
+
+def get_exif_data(image_path, file_stat=None):
+    """Extract dimensions, EXIF, IPTC and XP* metadata from an image in one pass.
+
+    Image.open() only parses the header, and nothing here touches pixel data. The file
+    handle is closed on return.
+    """
+    Image = lazy_module('PIL.Image')
+    try:
+        with Image.open(image_path) as img:
+            width, height = img.size
+            exif = _header_exif(img)
+            iptc = _header_iptc(img)
+    except Exception as e:
+        print(f"Error reading metadata from {image_path}: {e}")
+        return dict(EMPTY_IMAGE_METADATA)
+
+    # IPTC first (this is what macOS uses for Title): Object Name (2, 5), then Headline (2, 105)
+    title = _iptc_text(iptc[(2, 5)]) if (2, 5) in iptc else ''
+    if not title and (2, 105) in iptc:
+        title = _iptc_text(iptc[(2, 105)])
+    # IPTC Caption/Abstract (2, 120)
+    caption = _iptc_text(iptc[(2, 120)]) if (2, 120) in iptc else ''
+
+    # Windows XPTitle / XPComment (UCS-2, sometimes surfaced as a tuple of byte values)
+    for key, current in (('XPTitle', title), ('XPComment', caption)):
+        val = exif.get(key)
+        if isinstance(val, tuple):
+            val = bytes(val)
+        if current or not isinstance(val, bytes):
+            continue
+        decoded = decode_text(val)
+        if key == 'XPTitle':
+            title = title or decoded
+        else:
+            caption = caption or decoded
+
+    if 'DocumentName' in exif:
+        title = str(exif['DocumentName']).strip()
+
+    if 'ImageDescription' in exif:
+        val = exif['ImageDescription']
+        if isinstance(val, bytes):
+            try:
+                caption = val.decode('utf-8').strip()
+            except UnicodeDecodeError:
+                caption = val.decode('latin-1', errors='ignore').strip()
+        else:
+            caption = decode_text(val)
+
+    # Date: EXIF, then IPTC Date Created (2, 55), then the file's modification time
+    date_taken = str(exif.get('DateTimeOriginal', ''))
+    if not date_taken and (2, 55) in iptc:
+        date_taken = _iptc_text(iptc[(2, 55)])
+    if not date_taken:
         try:
-            raw_exif = img._getexif()
-            if raw_exif:
-                exif = { ExifTags.TAGS.get(k, k): v for k, v in raw_exif.items() }
-        except (AttributeError, TypeError):
+            mtime = file_stat.st_mtime if file_stat is not None else os.path.getmtime(image_path)
+            date_taken = datetime.fromtimestamp(mtime).strftime('%Y:%m:%d %H:%M:%S')
+        except OSError:
             pass
-        
-        title = ""
-        caption = ""
-        
-        # Try IPTC first (this is what macOS uses for Title)
+
+    return {
+        'width': width,
+        'height': height,
+        'title': title,
+        'caption': caption,
+        'make': str(exif.get('Make', '')),
+        'model': str(exif.get('Model', '')),
+        'date_taken': date_taken
+    }
+
+# Background job priorities: lower runs first
+PRIORITY_ON_DEMAND = 0  # A client is waiting on the result
+PRIORITY_BULK = 10  # Pre-generation kicked off by scans
+
+class BackgroundJob:
+    """One unit of work in a BackgroundJobQueue; duplicate submissions share it"""
+
+    def __init__(self, key, func, args, priority):
+        self.id = uuid.uuid4().hex[:12]
+        self.key = key
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.status = 'pending'  # pending -> running -> done | failed
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Block until the job finishes or timeout expires; returns True if finished"""
+        return self._done.wait(timeout)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+class BackgroundJobQueue:
+    """Priority queue of jobs run by a small pool of daemon worker threads.
+
+    Submitting a key that is already pending or running returns the existing job
+    (raising its priority if needed), so concurrent requests for the same work
+    share one job. With join_running=False only a pending job is shared, for work
+    whose inputs may have changed since a running job read them. Workers start
+    lazily on the first submit.
+    """
+
+    def __init__(self, name, workers=1, keep_finished=64):
+        self.name = name
+        self.workers = max(1, workers)
+        self.keep_finished = keep_finished
+        self._heap = []
+        self._sequence = itertools.count()
+        self._active = {}  # key -> pending or running job
+        self._jobs = collections.OrderedDict()  # id -> recent jobs, for polling by id
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def submit(self, key, func, *args, priority=PRIORITY_BULK, join_running=True):
+        with self._cond:
+            job = self._active.get(key)
+            if job is not None and (join_running or job.status == 'pending'):
+                if job.status == 'pending' and priority < job.priority:
+                    # Re-queue with the better priority; the stale heap entry is skipped later
+                    job.priority = priority
+                    heapq.heappush(self._heap, (priority, next(self._sequence), job))
+                    self._cond.notify()
+                return job
+
+            job = BackgroundJob(key, func, args, priority)
+            self._active[key] = job
+            self._jobs[job.id] = job
+            self._trim_finished()
+            heapq.heappush(self._heap, (priority, next(self._sequence), job))
+            self._start_workers()
+            self._cond.notify()
+            return job
+
+    def _trim_finished(self):
+        """Forget the oldest finished jobs beyond keep_finished. Callers hold self._cond.
+
+        Pending and running jobs are never dropped, so their waiters and pollers keep
+        them; if none are finished yet, trimming is simply deferred to a later submit.
+        """
+        excess = len(self._jobs) - self.keep_finished - len(self._active)
+        if excess <= 0:
+            return
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in ('done', 'failed')]
+        for job_id in finished[:excess]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        """Return a recent job by id, or None"""
+        return self._jobs.get(job_id)
+
+    def active(self, key):
+        """Return the pending or running job for a key, or None"""
+        return self._active.get(key)
+
+    def pending_count(self):
+        with self._cond:
+            return sum(1 for job in self._active.values() if job.status == 'pending')
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(
+                target=self._run, name=f"{self.name}-{len(self._threads) + 1}", daemon=True
+            )
+            self._threads.append(thread)
+            thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    while not self._heap:
+                        self._cond.wait()
+                    _, _, job = heapq.heappop(self._heap)
+                    if job.status == 'pending':
+                        break
+                job.status = 'running'
+                job.started = time.time()
+
+            try:
+                job.result = job.func(*job.args)
+                job.status = 'done'
+            except Exception as e:
+                print(f"Background job {self.name}/{job.key} failed: {e}")
+                job.error = str(e)
+                job.status = 'failed'
+            finally:
+                job.finished = time.time()
+                with self._cond:
+                    # A newer job may have taken the key while this one ran (join_running=False)
+                    if self._active.get(job.key) is job:
+                        del self._active[job.key]
+                job._done.set()
+
+class PeriodicRefresher:
+    """Keeps the result of a slow probe current from a daemon thread.
+
+    Readers use `value` (and `age()`) without doing any I/O. The probe reruns
+    every `interval` seconds, or right away when trigger() is called, e.g. after
+    a network change. The thread starts lazily on the first start()/trigger().
+    """
+
+    def __init__(self, name, func, interval, initial=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.value = initial
+        self.updated = None  # Wall-clock time the last probe finished
+        self.duration = None  # Seconds the last probe took
+        self.error = None
+        self.runs = 0
+        self._wake = threading.Event()
+        self._refreshed = threading.Condition()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def trigger(self):
+        """Ask for a refresh as soon as possible"""
+        self.start()
+        self._wake.set()
+
+    def refresh(self):
+        """Run the probe in the calling thread and publish its result"""
+        started = time.monotonic()
         try:
-            from PIL import IptcImagePlugin
-            iptc = IptcImagePlugin.getiptcinfo(img)
-            if iptc:
-                # IPTC Object Name (2, 5) = Title/Headline
-                if (2, 5) in iptc:
-                    val = iptc[(2, 5)]
-                    if isinstance(val, bytes):
-                        title = val.decode('utf-8', errors='ignore').strip()
-                    elif isinstance(val, list) and val:
-                        title = val[0].decode('utf-8', errors='ignore').strip() if isinstance(val[0], bytes) else str(val[0]).strip()
-                    else:
-                        title = str(val).strip()
-                
-                # IPTC Headline (2, 105) as backup title
-                if not title and (2, 105) in iptc:
-                    val = iptc[(2, 105)]
-                    if isinstance(val, bytes):
-                        title = val.decode('utf-8', errors='ignore').strip()
-                    else:
-                        title = str(val).strip()
-                
-                # IPTC Caption/Abstract (2, 120)
-                if (2, 120) in iptc:
-                    val = iptc[(2, 120)]
-                    if isinstance(val, bytes):
-                        caption = val.decode('utf-8', errors='ignore').strip()
-                    else:
-                        caption = str(val).strip()
+            value = self.func()
+            error = None
         except Exception as e:
-            print(f"IPTC read error: {e}")
-        
-        # Fall back to EXIF if no IPTC title
+            print(f"{self.name} refresh failed: {e}")
+            value, error = self.value, str(e)
+        with self._refreshed:
+            self.value = value
+            self.error = error
+            self.duration = time.monotonic() - started
+            self.updated = time.time()
+            self.runs += 1
+            self._refreshed.notify_all()
+        return value
+
+    def wait_for_refresh(self, timeout):
+        """Trigger a refresh and block until one completes or timeout expires; returns the value"""
+        with self._refreshed:
+            runs = self.runs
+            self.trigger()
+            self._refreshed.wait_for(lambda: self.runs > runs, timeout)
+            return self.value
+
+    def age(self):
+        """Seconds since the last probe finished, or None if it never ran"""
+        return None if self.updated is None else time.time() - self.updated
+
+    def status(self):
+        age = self.age()
+        return {
+            'updated': datetime.fromtimestamp(self.updated).isoformat() if self.updated else None,
+            'age_seconds': round(age, 3) if age is not None else None,
+            'duration_ms': round(self.duration * 1000, 1) if self.duration is not None else None,
+            'interval_seconds': self.interval,
+            'runs': self.runs,
+            'error': self.error,
+        }
 
-        # XPTitle (Windows)
-        for key in list(exif.keys()):
-            if key == 0x9c9b or key == 'XPTitle':
-                try:
-                    val = exif[key]
-                    if isinstance(val, bytes):
-                        decoded = decode_text(val)
-                        if decoded and not title:
-                            title = decoded
-                except Exception as _e:
-                    pass
-            if key == 0x9c9c or key == 'XPComment':
-                try:
-                    val = exif[key]
-                    if isinstance(val, bytes):
-                        decoded = decode_text(val)
-                        if decoded and not caption:
-                            caption = decoded
-                except Exception as _e:
-                    pass
-
-        # if not title and 'DocumentName' in exif:
-        if 'DocumentName' in exif:
-            title = str(exif['DocumentName']).strip()
-
-        # if not caption and 'ImageDescription' in exif:
-        if 'ImageDescription' in exif:
-            val = exif['ImageDescription']
-            if isinstance(val, bytes):
-                try:
-                    caption = val.decode('utf-8').strip()
-                except Exception as _e:
-                    caption = val.decode('latin-1', errors='ignore').strip()
+    def _run(self):
+        if self.updated is None:
+            self.refresh()
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.refresh()
+
+def thumbnail_path(filename, size=DEFAULT_THUMBNAIL_SIZE, fmt='jpeg', file_stat=None):
+    """Path of one thumbnail variant of a picture.
+
+    The cache key covers the source path, byte size and mtime plus the variant, so
+    same-stem pictures (a.png / a.jpg) never collide and an edited picture gets a new
+    thumbnail. Raises OSError if the picture is gone and no file_stat was given.
+    """
+    source_path = os.path.abspath(os.path.join(PICTURES_FOLDER, filename))
+    if file_stat is None:
+        file_stat = os.stat(source_path)
+    raw = f"{source_path}|{file_stat.st_size}|{file_stat.st_mtime_ns}|{size}|{fmt}"
+    key = hashlib.sha1(raw.encode('utf-8')).hexdigest()[:24]
+    return os.path.join(THUMBNAILS_FOLDER, f"{key}.{THUMBNAIL_FORMATS[fmt][1]}")
+
+_WRITABLE_THUMBNAIL_FORMATS = None
+
+def writable_thumbnail_formats():
+    """THUMBNAIL_FORMATS this Pillow build can write (WebP support is optional), checked once"""
+    global _WRITABLE_THUMBNAIL_FORMATS
+    if _WRITABLE_THUMBNAIL_FORMATS is None:
+        features = lazy_module('PIL.features')
+        _WRITABLE_THUMBNAIL_FORMATS = tuple(
+            fmt for fmt in THUMBNAIL_FORMATS if fmt != 'webp' or features.check('webp')
+        )
+        if 'webp' not in _WRITABLE_THUMBNAIL_FORMATS:
+            print("Pillow was built without WebP support; thumbnails are JPEG only.")
+    return _WRITABLE_THUMBNAIL_FORMATS
+
+def generate_thumbnails(image_path, filename):
+    """Generate every missing size/format thumbnail variant of a picture from one decode.
+
+    JPEG sources are decoded with draft() at the smallest DCT scale that still covers the
+    largest missing size, and smaller sizes are downscaled from the larger results. A
+    variant that fails to save is skipped, so the others (JPEG above all) still get written.
+    """
+    try:
+        file_stat = os.stat(image_path)
+    except OSError:
+        return False  # Picture was removed before its job ran
+
+    formats = writable_thumbnail_formats()
+    missing = [
+        (size, fmt) for size in THUMBNAIL_SIZES for fmt in formats
+        if not os.path.exists(thumbnail_path(filename, size, fmt, file_stat))
+    ]
+    if not missing:
+        return True
+
+    Image = lazy_module('PIL.Image')
+    try:
+        # Ensure directory exists
+        os.makedirs(THUMBNAILS_FOLDER, exist_ok=True)
+
+        with Image.open(image_path) as img:
+            largest = max(size for size, _ in missing)
+            img.draft('RGB', (largest, largest))
+            if img.mode in ('RGBA', 'LA', 'P'):
+                # Flatten transparency onto white; JPEG can't store alpha
+                rgba = img.convert('RGBA')
+                current = Image.new('RGB', rgba.size, (255, 255, 255))
+                current.paste(rgba, mask=rgba.split()[-1])
             else:
-                caption = decode_text(val)
+                current = img.convert('RGB')
+
+        written = 0
+        failed = 0
+        for size in sorted({size for size, _ in missing}, reverse=True):
+            current.thumbnail((size, size))
+            for fmt in formats:
+                if (size, fmt) not in missing:
+                    continue
+                pil_format, _ = THUMBNAIL_FORMATS[fmt]
+                thumb_path = thumbnail_path(filename, size, fmt, file_stat)
+                # Write to a temp file first so a half-written thumbnail is never served
+                tmp_path = f"{thumb_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                try:
+                    current.save(tmp_path, pil_format, quality=THUMBNAIL_QUALITY)
+                    os.replace(tmp_path, thumb_path)
+                    written += os.path.getsize(thumb_path)
+                except Exception as e:
+                    print(f"Error writing {size}px {fmt} thumbnail for {image_path}: {e}")
+                    failed += 1
+                    with contextlib.suppress(OSError):
+                        os.remove(tmp_path)
+        THUMBNAIL_CACHE.added(written)
+        return not failed
+    except Exception as e:
+        print(f"Error generating thumbnail for {image_path}: {e}")
+        return False
 
-        # Get date - try EXIF first
-        date_taken = str(exif.get('DateTimeOriginal', ''))
-        
-        # Try IPTC date if no EXIF date
-        if not date_taken:
+def thumbnail_urls(filename):
+    """srcset strings advertising every configured thumbnail size, per writable format"""
+    base = f"/api/pictures/{quote(filename)}/thumbnail"
+    return {
+        fmt: ', '.join(f"{base}?size={size}&format={fmt} {size}w" for size in THUMBNAIL_SIZES)
+        for fmt in writable_thumbnail_formats()
+    }
+
+def picture_response_record(record):
+    """A picture record as served, with the thumbnail fields for the current configuration.
+
+    These are derived from THUMBNAIL_SIZES and the Pillow build, so they are added per
+    snapshot rather than stored in the persistent metadata index (where older records
+    may still carry stale copies, which this overrides).
+    """
+    return dict(
+        record,
+        thumbnail_sizes=list(THUMBNAIL_SIZES),
+        thumbnail_srcset=thumbnail_urls(record['filename']),
+    )
+
+THUMBNAIL_QUEUE = BackgroundJobQueue('thumbnails', workers=THUMBNAIL_WORKERS)
+
+class ThumbnailCache:
+    """Disk quota for THUMBNAILS_FOLDER: orphan cleanup plus LRU eviction.
+
+    Served thumbnails get their mtime bumped (at most once per TOUCH_INTERVAL, to
+    spare the SD card), so mtime order approximates least-recently-used.
+    """
+
+    TOUCH_INTERVAL = 3600
+    STALE_TMP_AGE = 3600  # Leftover .tmp files from interrupted writes
+    EVICT_TO = 0.9  # Evict down to this fraction of the quota
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._bytes = None  # Unknown until the first cleanup scans the folder
+        self._evicted = False  # Set once eviction was needed; pre-generation then stops
+
+    def added(self, nbytes):
+        """Account for newly written thumbnails and schedule eviction if over quota"""
+        with self._lock:
+            if self._bytes is None:
+                return
+            self._bytes += nbytes
+            over_quota = self._bytes > self.max_bytes
+        if over_quota:
+            THUMBNAIL_QUEUE.submit(('thumbnail-cache', 'evict'), self.evict, priority=PRIORITY_BULK - 1)
+
+    def has_room(self):
+        """True if bulk pre-generation may add thumbnails.
+
+        Pre-generation stops at the level eviction trims down to, and for good once
+        anything had to be evicted, so it never makes the cache evict (and later
+        regenerate) other pictures' thumbnails; past that, thumbnails are only made
+        when requested. Until the first cleanup has measured the folder the usage is
+        unknown, so there is no room either.
+        """
+        with self._lock:
+            return (not self._evicted and self._bytes is not None
+                    and self._bytes < self.max_bytes * self.EVICT_TO)
+
+    def touch(self, path):
+        """Mark a thumbnail as recently used"""
+        try:
+            if time.time() - os.path.getmtime(path) > self.TOUCH_INTERVAL:
+                os.utime(path)
+        except OSError:
+            pass
+
+    def _entries(self):
+        entries = []
+        try:
+            with os.scandir(self.folder) as it:
+                for entry in it:
+                    if entry.is_file():
+                        st = entry.stat()
+                        entries.append((entry.path, entry.name, st.st_size, st.st_mtime))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def cleanup(self, valid_names):
+        """Delete thumbnails not in valid_names (deleted/edited pictures, old naming schemes)"""
+        removed = 0
+        total = 0
+        now = time.time()
+        for path, name, size, mtime in self._entries():
+            if name in valid_names or (name.endswith('.tmp') and now - mtime < self.STALE_TMP_AGE):
+                total += size
+                continue
             try:
-                from PIL import IptcImagePlugin
-                iptc = IptcImagePlugin.getiptcinfo(img)
-                if iptc:
-                    # IPTC Date Created (2, 55) + Time Created (2, 60)
-                    if (2, 55) in iptc:
-                        val = iptc[(2, 55)]
-                        if isinstance(val, bytes):
-                            date_taken = val.decode('utf-8', errors='ignore').strip()
-                        else:
-                            date_taken = str(val).strip()
-            except Exception as _e:
-                pass
-        
-        # Fall back to file modification date if still no date
-        if not date_taken:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                total += size
+        with self._lock:
+            self._bytes = total
+            if removed:
+                self._evicted = False  # Deleted pictures freed space
+        if removed:
+            print(f"Removed {removed} orphaned thumbnails.")
+        if total > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used thumbnails until usage is back under quota"""
+        entries = sorted(self._entries(), key=lambda entry: entry[3])
+        total = sum(entry[2] for entry in entries)
+        target = self.max_bytes * self.EVICT_TO
+        evicted = 0
+        for path, name, size, _ in entries:
+            if total <= target:
+                break
+            if name.endswith('.tmp'):
+                continue
             try:
-                import os
-                mtime = os.path.getmtime(image_path)
-                from datetime import datetime
-                date_taken = datetime.fromtimestamp(mtime).strftime('%Y:%m:%d %H:%M:%S')
-            except Exception as _e:
+                os.remove(path)
+                total -= size
+                evicted += 1
+            except OSError:
                 pass
-                
-        return {
-            'width': width,
-            'height': height,
-            'title': title,
-            'caption': caption,
-            'make': str(exif.get('Make', '')),
-            'model': str(exif.get('Model', '')),
-            'date_taken': date_taken
+        with self._lock:
+            self._bytes = total
+            if evicted:
+                self._evicted = True
+        if evicted:
+            print(f"Evicted {evicted} thumbnails ({total // 1024} KB cached).")
+
+    def stats(self):
+        return {'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+THUMBNAIL_CACHE = ThumbnailCache(THUMBNAILS_FOLDER, THUMBNAIL_CACHE_MAX_BYTES)
+
+def cleanup_thumbnails():
+    """Remove thumbnails that no longer match any picture in the current library"""
+    snapshot = LIBRARIES['pictures']
+    if not snapshot.generation:
+        return
+    valid_names = set()
+    for picture in snapshot.records:
+        try:
+            file_stat = os.stat(os.path.join(PICTURES_FOLDER, picture['filename']))
+        except OSError:
+            continue
+        for size in THUMBNAIL_SIZES:
+            for fmt in writable_thumbnail_formats():
+                valid_names.add(os.path.basename(thumbnail_path(picture['filename'], size, fmt, file_stat)))
+    THUMBNAIL_CACHE.cleanup(valid_names)
+
+def schedule_thumbnail_cleanup():
+    """Queue an orphan cleanup (which also measures cache usage) ahead of bulk pre-generation"""
+    THUMBNAIL_QUEUE.submit(('thumbnail-cache', 'cleanup'), cleanup_thumbnails, priority=PRIORITY_BULK - 1)
+
+def thumbnails_missing(filename):
+    """True if any configured thumbnail variant of a picture doesn't exist yet"""
+    try:
+        file_stat = os.stat(os.path.join(PICTURES_FOLDER, filename))
+    except OSError:
+        return False
+    return any(
+        not os.path.exists(thumbnail_path(filename, size, fmt, file_stat))
+        for size in THUMBNAIL_SIZES for fmt in writable_thumbnail_formats()
+    )
+
+def pregenerate_thumbnails(image_path, filename):
+    """Bulk job body: generate thumbnails only while the cache has room.
+
+    Returns None when skipped, leaving the picture (e.g. one whose thumbnails were
+    evicted) to on-demand generation. A bulk job that a thumbnail request promoted
+    before it started always generates, since a client is waiting on it.
+    """
+    job = THUMBNAIL_QUEUE.active(('thumbnails', filename))
+    requested = job is not None and job.priority == PRIORITY_ON_DEMAND
+    if not requested and not THUMBNAIL_CACHE.has_room():
+        return None
+    return generate_thumbnails(image_path, filename)
+
+def queue_thumbnails(filename, priority=PRIORITY_BULK):
+    """Queue generation of a picture's thumbnails; returns the (possibly shared) job"""
+    func = generate_thumbnails if priority == PRIORITY_ON_DEMAND else pregenerate_thumbnails
+    return THUMBNAIL_QUEUE.submit(
+        ('thumbnails', filename), func,
+        os.path.join(PICTURES_FOLDER, filename), filename,
+        priority=priority
+    )
+
+# Rendered document cache: '<document key>-<content key>.<ext>', so stale renders of a
+# document can be found (and removed) by prefix when it changes or is deleted
+MARKDOWN_EXTENSIONS = ['tables', 'fenced_code']
+PDF_STYLESHEET = """
+  body{font-family:Helvetica;font-size:11pt;line-height:1.5;color:#000}
+  h1{font-size:18pt;font-weight:bold;margin:8pt 0 4pt}
+  h2{font-size:15pt;font-weight:bold;margin:8pt 0 4pt}
+  h3{font-size:13pt;font-weight:bold;margin:6pt 0 3pt}
+  h4,h5,h6{font-weight:bold;margin:5pt 0 3pt}
+  p{margin:4pt 0}
+  ul,ol{margin:4pt 0 6pt;padding-left:18pt}
+  li{margin:2pt 0}
+  code{font-size:9pt}
+  pre{background:#f0f0f0;padding:8pt;margin:6pt 0;font-size:9pt}
+  blockquote{margin:6pt 0;padding-left:10pt;border-left:3pt solid #667eea;color:#555}
+  table{width:100%;border-collapse:collapse;margin:6pt 0}
+  th,td{border:0.5pt solid #ccc;padding:4pt 6pt;text-align:left}
+  th{background:#f0f0f0;font-weight:bold}
+  hr{border-top:0.5pt solid #ccc;margin:8pt 0}
+"""
+# Changing the stylesheet or Markdown extensions invalidates every cached PDF
+PDF_STYLESHEET_VERSION = hashlib.sha1(
+    (PDF_STYLESHEET + ','.join(MARKDOWN_EXTENSIONS)).encode('utf-8')
+).hexdigest()[:8]
+
+def _document_key(filename):
+    source_path = os.path.abspath(os.path.join(DOCUMENTS_FOLDER, filename))
+    return hashlib.sha1(source_path.encode('utf-8')).hexdigest()[:16]
+
+def rendered_document_path(filename, file_stat, ext, version):
+    """Cache path for one rendering of a document, keyed by its size, mtime and the renderer version"""
+    raw = f"{file_stat.st_size}|{file_stat.st_mtime_ns}|{version}"
+    content_key = hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(RENDER_CACHE_FOLDER, f"{_document_key(filename)}-{content_key}.{ext}")
+
+def remove_rendered_documents(filename, ext, keep=None):
+    """Delete cached renderings of a document, except `keep`"""
+    prefix = _document_key(filename)
+    try:
+        with os.scandir(RENDER_CACHE_FOLDER) as it:
+            for entry in it:
+                if entry.name.startswith(prefix + '-') and entry.name.endswith('.' + ext) and entry.path != keep:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+    except FileNotFoundError:
+        pass
+
+def render_document_pdf(filename):
+    """Render a Markdown document to a cached PDF (if not cached already) and return its path"""
+    filepath = os.path.join(DOCUMENTS_FOLDER, filename)
+    file_stat = os.stat(filepath)
+    pdf_path = rendered_document_path(filename, file_stat, 'pdf', PDF_STYLESHEET_VERSION)
+    if os.path.exists(pdf_path):
+        return pdf_path
+
+    started = time.time()
+    with open(filepath, 'r', encoding='utf-8') as f:
+        content = f.read()
+    body_html = lazy_module('markdown').markdown(content, extensions=MARKDOWN_EXTENSIONS)
+    title = html_lib.escape(os.path.splitext(filename)[0])
+    full_html = f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title>
+<style>{PDF_STYLESHEET}</style></head>
+<body>{body_html}</body></html>"""
+    buf = io.BytesIO()
+    result = lazy_module('xhtml2pdf.pisa').CreatePDF(full_html.encode('utf-8'), dest=buf, encoding='utf-8')
+    if result.err:
+        raise RuntimeError(f"xhtml2pdf reported {result.err} error(s)")
+
+    os.makedirs(RENDER_CACHE_FOLDER, exist_ok=True)
+    tmp_path = f"{pdf_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(buf.getvalue())
+    os.replace(tmp_path, pdf_path)
+    remove_rendered_documents(filename, 'pdf', keep=pdf_path)
+    print(f"Rendered {filename} to PDF in {time.time() - started:.2f}s")
+    return pdf_path
+
+PDF_QUEUE = BackgroundJobQueue('pdf', workers=PDF_WORKERS)
+
+def queue_pdf(filename, priority=PRIORITY_BULK):
+    """Queue rendering of a document's PDF; returns the (possibly shared) job"""
+    return PDF_QUEUE.submit(('pdf', filename), render_document_pdf, filename, priority=priority)
+
+def is_markdown(filename):
+    return os.path.splitext(filename)[1].lower() == '.md'
+
+# Rendered HTML fragments for the document viewer, kept in memory per document
+HTML_RENDER_VERSION = hashlib.sha1(
+    (','.join(MARKDOWN_EXTENSIONS) + '|escaped-html|blank-links').encode('utf-8')
+).hexdigest()[:8]
+MAX_RENDERED_DOCUMENTS = 32
+RENDERED_DOCUMENTS = collections.OrderedDict()  # filename -> RenderedDocument, most recent last
+RENDERED_DOCUMENTS_LOCK = threading.Lock()
+
+RenderedDocument = collections.namedtuple('RenderedDocument', 'stat_key etag html pages')
+
+def markdown_to_html(text):
+    """Render Markdown to an HTML fragment for the in-app viewer"""
+    md = lazy_module('markdown').Markdown(extensions=MARKDOWN_EXTENSIONS)
+    # Raw HTML in documents is shown as text, not injected into the page
+    md.preprocessors.deregister('html_block')
+    md.inlinePatterns.deregister('html')
+    return md.convert(text).replace('<a href=', '<a target="_blank" rel="noopener noreferrer" href=')
+
+_HTML_TAG_RE = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9]*)\b[^>]*?(/?)>')
+_VOID_TAGS = frozenset(('area', 'base', 'br', 'col', 'hr', 'img', 'input', 'link', 'meta', 'source', 'wbr'))
+
+def paginate_html(html, page_chars):
+    """Split a rendered fragment at h1-h3 headings into pages of roughly page_chars.
+
+    Only headings at the top level of the fragment start a page, never ones nested
+    in a list, blockquote or table, so every page is balanced HTML on its own.
+    """
+    sections = []
+    start = 0
+    depth = 0
+    for match in _HTML_TAG_RE.finditer(html):
+        closing, tag, self_closing = match.groups()
+        tag = tag.lower()
+        if closing:
+            depth = max(0, depth - 1)
+        elif not self_closing and tag not in _VOID_TAGS:
+            if depth == 0 and tag in ('h1', 'h2', 'h3') and html[match.start() - 1:match.start()] == '\n':
+                sections.append(html[start:match.start() - 1])
+                start = match.start()
+            depth += 1
+    sections.append(html[start:])
+
+    pages = []
+    for section in sections:
+        if pages and len(pages[-1]) < page_chars:
+            pages[-1] += '\n' + section
+        else:
+            pages.append(section)
+    return pages or ['']
+
+def render_document_html(filename, stat_key):
+    """Render a document for the viewer and cache it; runs on HTML_RENDER_QUEUE, outside the cache lock"""
+    with open(os.path.join(DOCUMENTS_FOLDER, filename), 'r', encoding='utf-8', errors='replace') as f:
+        html = markdown_to_html(f.read())
+    raw = f"{filename}|{stat_key[0]}|{stat_key[1]}|{HTML_RENDER_VERSION}"
+    etag = hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+    rendered = RenderedDocument(stat_key, etag, html, paginate_html(html, DOCUMENT_PAGE_CHARS))
+    with RENDERED_DOCUMENTS_LOCK:
+        RENDERED_DOCUMENTS[filename] = rendered
+        RENDERED_DOCUMENTS.move_to_end(filename)
+        while len(RENDERED_DOCUMENTS) > MAX_RENDERED_DOCUMENTS:
+            RENDERED_DOCUMENTS.popitem(last=False)
+    return rendered
+
+# A couple of workers, so one long document doesn't hold up the rest
+HTML_RENDER_QUEUE = BackgroundJobQueue('html', workers=2)
+
+def rendered_document(filename):
+    """Return (rendered, None) for a cached render of the document's current version, else (None, job).
+
+    Documents are re-rendered only when their size or mtime changes, and concurrent
+    requests for the same version share one render job. Raises OSError if the
+    document is gone.
+    """
+    file_stat = os.stat(os.path.join(DOCUMENTS_FOLDER, filename))
+    stat_key = (file_stat.st_size, file_stat.st_mtime_ns)
+    with RENDERED_DOCUMENTS_LOCK:
+        cached = RENDERED_DOCUMENTS.get(filename)
+        if cached is not None and cached.stat_key == stat_key:
+            RENDERED_DOCUMENTS.move_to_end(filename)
+            return cached, None
+
+    job = HTML_RENDER_QUEUE.submit(('html', filename, stat_key), render_document_html, filename, stat_key,
+                                   priority=PRIORITY_ON_DEMAND)
+    return None, job
+
+class MetadataIndex:
+    """Persistent per-file metadata records, keyed by path + size + mtime.
+
+    Restarts (including the os.execv in wifi_restart) reuse the stored record for
+    every file whose stat hasn't changed, so only new or edited files are re-opened
+    with mutagen/Pillow.
+    """
+
+    # Bump whenever the shape of the records produced by the parse_* functions changes
+    SCHEMA_VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            if conn.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+                conn.execute('DROP TABLE IF EXISTS entries')
+                conn.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                ' kind TEXT NOT NULL, path TEXT NOT NULL,'
+                ' size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,'
+                ' record TEXT NOT NULL, PRIMARY KEY (kind, path))'
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def load(self, kind):
+        """Return {path: (size, mtime_ns, record)} for every stored entry of a kind"""
+        try:
+            with self._lock:
+                rows = self._connect().execute(
+                    'SELECT path, size, mtime_ns, record FROM entries WHERE kind = ?', (kind,)
+                ).fetchall()
+            return {path: (size, mtime_ns, json.loads(record)) for path, size, mtime_ns, record in rows}
+        except Exception as e:
+            print(f"Warning: Could not read metadata index {self.path}: {e}")
+            return {}
+
+    def get(self, kind, path):
+        """Return the stored (size, mtime_ns, record) for one path, or None"""
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    'SELECT size, mtime_ns, record FROM entries WHERE kind = ? AND path = ?', (kind, path)
+                ).fetchone()
+            return (row[0], row[1], json.loads(row[2])) if row else None
+        except Exception as e:
+            print(f"Warning: Could not read metadata index {self.path}: {e}")
+            return None
+
+    def remove(self, kind, paths):
+        """Drop the entries for the given paths"""
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.executemany('DELETE FROM entries WHERE kind = ? AND path = ?', [(kind, path) for path in paths])
+                conn.commit()
+        except Exception as e:
+            print(f"Warning: Could not update metadata index {self.path}: {e}")
+
+    def update(self, kind, fresh, keep_paths=None):
+        """Store fresh {path: (size, mtime_ns, record)} entries.
+
+        If keep_paths is given, entries of this kind whose path is not in it are dropped.
+        """
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.executemany(
+                    'INSERT OR REPLACE INTO entries (kind, path, size, mtime_ns, record) VALUES (?, ?, ?, ?, ?)',
+                    [(kind, path, size, mtime_ns, json.dumps(record))
+                     for path, (size, mtime_ns, record) in fresh.items()]
+                )
+                if keep_paths is not None:
+                    stored = [row[0] for row in conn.execute('SELECT path FROM entries WHERE kind = ?', (kind,))]
+                    conn.executemany(
+                        'DELETE FROM entries WHERE kind = ? AND path = ?',
+                        [(kind, path) for path in stored if path not in keep_paths]
+                    )
+                conn.commit()
+        except Exception as e:
+            print(f"Warning: Could not update metadata index {self.path}: {e}")
+
+
+METADATA_INDEX = MetadataIndex(METADATA_INDEX_PATH)
+
+
+def encode_json(payload):
+    """Compact UTF-8 JSON (non-ASCII lyrics stay unescaped to keep payloads small)"""
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Lower-cased word tokens (Unicode-aware, so Cyrillic lyrics index too)"""
+    return _TOKEN_RE.findall(text.casefold()) if text else []
+
+
+if hasattr(int, 'bit_count'):
+    popcount = int.bit_count
+else:
+    def popcount(bits):
+        """Number of set bits in a non-negative int (int.bit_count needs Python 3.10)"""
+        return bin(bits).count('1')
+
+
+def bitmap_ordinals(bits):
+    """Yield the positions of the set bits in bits, lowest first"""
+    digits = format(bits, 'b')[::-1]
+    position = digits.find('1')
+    while position >= 0:
+        yield position
+        position = digits.find('1', position + 1)
+
+
+class SearchIndex:
+    """Immutable inverted index over music titles, artists and lyrics.
+
+    Every track gets a small integer ordinal, and postings map each token to
+    bitmaps (ints with bit n set for ordinal n) grouped by weight (the best field
+    the token appears in), highest weight first. Intersections, unions and match
+    counts over a whole weight tier are then single big-integer operations
+    rather than per-track set work. updated() returns a new index that shares
+    every untouched posting with the old one, so per-file changes don't
+    re-tokenize the library.
+    """
+
+    FIELD_WEIGHTS = (('title', 3.0), ('artist', 2.0), ('lyrics', 1.0))
+    PREFIX_FACTOR = 0.6  # Prefix-only (typeahead) matches rank below whole-word matches
+    MIN_PREFIX_LENGTH = 2  # Shorter terms only match whole tokens
+    MAX_PREFIX_EXPANSIONS = 200
+    MAX_PREFIX_POSTINGS = 20000  # Prefix matches also stop, weakest tiers first, past this many postings
+
+    __slots__ = ('postings', 'tokens', 'record_tokens', 'ordinals', 'by_ordinal', 'filenames')
+
+    def __init__(self, postings, tokens, record_tokens, ordinals, by_ordinal, filenames):
+        self.postings = postings  # {token: ((weight, bitmap), ...)}, highest weight first
+        self.tokens = tokens  # Sorted token list for prefix lookups
+        self.record_tokens = record_tokens  # {filename: {token: weight}}, for removals
+        self.ordinals = ordinals  # {filename: ordinal}
+        self.by_ordinal = by_ordinal  # [filename or None], freed ordinals are reused
+        self.filenames = filenames  # Sorted filenames, for filename-ordered ties
+
+    @classmethod
+    def _record_weights(cls, record):
+        weights = {}
+        for field, weight in cls.FIELD_WEIGHTS:
+            for token in tokenize(record.get(field)):
+                if weights.get(token, 0) < weight:
+                    weights[token] = weight
+        return weights
+
+    @staticmethod
+    def _freeze(tiers):
+        """{weight: bitmap} -> posting tuple, highest weight first, without empty tiers"""
+        return tuple((weight, bits) for weight, bits in sorted(tiers.items(), reverse=True) if bits)
+
+    @staticmethod
+    def _bitmap(ordinals):
+        bits = bytearray((max(ordinals) >> 3) + 1)
+        for ordinal in ordinals:
+            bits[ordinal >> 3] |= 1 << (ordinal & 7)
+        return int.from_bytes(bits, 'little')
+
+    @classmethod
+    def from_records(cls, records):
+        filenames = sorted(record['filename'] for record in records)
+        ordinals = {filename: ordinal for ordinal, filename in enumerate(filenames)}
+        tiers = {}
+        record_tokens = {}
+        for record in records:
+            weights = cls._record_weights(record)
+            record_tokens[record['filename']] = weights
+            ordinal = ordinals[record['filename']]
+            for token, weight in weights.items():
+                tiers.setdefault(token, {}).setdefault(weight, []).append(ordinal)
+        postings = {
+            token: cls._freeze({weight: cls._bitmap(members) for weight, members in token_tiers.items()})
+            for token, token_tiers in tiers.items()
         }
+        return cls(postings, sorted(postings), record_tokens, ordinals, list(filenames), filenames)
+
+    def updated(self, removed=(), added=()):
+        """Return a new index with the removed records dropped and the added ones indexed"""
+        postings = dict(self.postings)
+        record_tokens = dict(self.record_tokens)
+        ordinals = dict(self.ordinals)
+        by_ordinal = list(self.by_ordinal)
+        filenames = list(self.filenames)
+        touched = {}  # Copy-on-write {weight: bitmap} for the tokens this change affects
+
+        def tiers_for(token):
+            if token not in touched:
+                touched[token] = dict(postings.get(token, ()))
+            return touched[token]
+
+        for record in removed:
+            filename = record['filename']
+            ordinal = ordinals.pop(filename, None)
+            if ordinal is None:
+                continue
+            by_ordinal[ordinal] = None
+            del filenames[bisect.bisect_left(filenames, filename)]
+            for token, weight in record_tokens.pop(filename, {}).items():
+                tiers = tiers_for(token)
+                tiers[weight] = tiers.get(weight, 0) & ~(1 << ordinal)
+
+        # Free ordinals are reused lowest first, so bitmaps stay as short as the library
+        free = [ordinal for ordinal, filename in enumerate(by_ordinal) if filename is None] \
+            if len(by_ordinal) > len(ordinals) else []
+        free.reverse()
+        for record in added:
+            filename = record['filename']
+            ordinal = free.pop() if free else len(by_ordinal)
+            if ordinal == len(by_ordinal):
+                by_ordinal.append(filename)
+            else:
+                by_ordinal[ordinal] = filename
+            ordinals[filename] = ordinal
+            bisect.insort(filenames, filename)
+            weights = self._record_weights(record)
+            record_tokens[filename] = weights
+            for token, weight in weights.items():
+                tiers = tiers_for(token)
+                tiers[weight] = tiers.get(weight, 0) | (1 << ordinal)
+
+        while by_ordinal and by_ordinal[-1] is None:
+            by_ordinal.pop()
+
+        new_tokens = []
+        dead_tokens = set()
+        for token, tiers in touched.items():
+            posting = self._freeze(tiers)
+            if posting:
+                if token not in postings:
+                    new_tokens.append(token)
+                postings[token] = posting
+            elif token in postings:
+                del postings[token]
+                dead_tokens.add(token)
+
+        tokens = self.tokens
+        if new_tokens or dead_tokens:
+            tokens = [token for token in tokens if token not in dead_tokens]
+            for token in new_tokens:
+                bisect.insort(tokens, token)
+        return SearchIndex(postings, tokens, record_tokens, ordinals, by_ordinal, filenames)
+
+    def _expand(self, term):
+        """Yield (level, bitmap) tiers for the exact term and, for longer terms, its prefix matches.
+
+        Prefix tiers are taken highest weight first until their postings add up to
+        MAX_PREFIX_POSTINGS (finishing the weight they stop in), so a short prefix of
+        common words stays cheap and only drops its weakest, lyrics-only matches.
+        """
+        yield from self.postings.get(term, ())
+        if len(term) < self.MIN_PREFIX_LENGTH:
+            return
+        tiers = []
+        start = bisect.bisect_left(self.tokens, term)
+        for token in itertools.islice(self.tokens, start, start + self.MAX_PREFIX_EXPANSIONS):
+            if not token.startswith(term):
+                break
+            if token != term:
+                tiers.extend(self.postings[token])
+        tiers.sort(key=lambda tier: -tier[0])
+        budget = self.MAX_PREFIX_POSTINGS
+        cutoff = None  # Weight of the tier that used up the budget
+        for weight, bits in tiers:
+            if cutoff is not None and weight < cutoff:
+                break
+            yield weight * self.PREFIX_FACTOR, bits
+            budget -= popcount(bits)
+            if budget <= 0 and cutoff is None:
+                cutoff = weight
+
+    @staticmethod
+    def _combinations(term_levels):
+        """Yield (score, bitmap) per level combination, highest score first.
+
+        Combinations are generated lazily best-first from a heap, so ranking only
+        intersects the ones it actually reaches.
+        """
+        def score(indexes):
+            return round(sum(levels[i][0] for levels, i in zip(term_levels, indexes)), 9)
+
+        first = (0,) * len(term_levels)
+        heap = [(-score(first), first)]
+        queued = {first}
+        while heap:
+            negative_score, indexes = heapq.heappop(heap)
+            bits = term_levels[0][indexes[0]][1]
+            for levels, i in zip(term_levels[1:], indexes[1:]):
+                if not bits:
+                    break
+                bits &= levels[i][1]
+            yield -negative_score, bits
+            for position, levels in enumerate(term_levels):
+                if indexes[position] + 1 < len(levels):
+                    following = indexes[:position] + (indexes[position] + 1,) + indexes[position + 1:]
+                    if following not in queued:
+                        queued.add(following)
+                        heapq.heappush(heap, (-score(following), following))
+
+    def _first_filenames(self, bits, count):
+        """The `count` smallest filenames among the tracks in bits"""
+        found = popcount(bits)
+        if found * found <= count * len(self.filenames):
+            # Sparse: decode every track and pick the smallest names
+            return heapq.nsmallest(count, (self.by_ordinal[ordinal] for ordinal in bitmap_ordinals(bits)))
+        # Dense: walk filename order, which reaches `count` matches after about count * total / found steps
+        digits = format(bits, 'b')[::-1]
+        names = []
+        for filename in self.filenames:
+            ordinal = self.ordinals[filename]
+            if ordinal < len(digits) and digits[ordinal] == '1':
+                names.append(filename)
+                if len(names) == count:
+                    break
+        return names
+
+    def search(self, query, limit):
+        """Return ([(filename, score)] best first, total matches); every term must match.
+
+        A term scores a track at the best weight x prefix factor among its expansions,
+        and the track's score is the sum over terms. Each term's matches are split into
+        bitmaps by the exact level they score, the terms are intersected rarest first,
+        and level combinations are visited from the highest total down until `limit`
+        tracks are ranked.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return [], 0
+
+        term_levels = []  # (matches, [(level, bitmap)] highest level first) per term
+        for term in terms:
+            by_level = {}
+            for level, bits in self._expand(term):
+                by_level[level] = by_level.get(level, 0) | bits
+            levels = []
+            matched = 0
+            for level in sorted(by_level, reverse=True):
+                bits = by_level[level] & ~matched
+                if bits:
+                    levels.append((level, bits))
+                    matched |= bits
+            if not matched:
+                return [], 0
+            term_levels.append((matched, levels))
+        term_levels.sort(key=lambda item: popcount(item[0]))
+
+        candidates = term_levels[0][0]
+        for matched, _ in term_levels[1:]:
+            candidates &= matched
+            if not candidates:
+                return [], 0
+        total = popcount(candidates)
+
+        # Tracks outside the intersection can't rank, so drop them from every level
+        narrowed = []
+        for _, levels in term_levels:
+            narrowed.append([(level, bits & candidates) for level, bits in levels if bits & candidates])
+
+        ranked = []
+        remaining = candidates
+        tied_score, tied = None, 0
+        for score, bits in itertools.chain(self._combinations(narrowed), [(None, 0)]):
+            if score != tied_score:
+                if tied:
+                    # Ties are broken by filename
+                    ranked.extend((filename, tied_score)
+                                  for filename in self._first_filenames(tied, limit - len(ranked)))
+                    remaining &= ~tied
+                    if len(ranked) >= limit or not remaining:
+                        break
+                tied_score, tied = score, 0
+            tied |= bits
+        return ranked, total
+
+
+def highlight_snippet(text, query, radius=60):
+    """Return an HTML-escaped excerpt of text around the first query match, with matches in <mark>"""
+    terms = sorted(set(tokenize(query)), key=len, reverse=True)
+    if not text or not terms:
+        return ''
+    pattern = re.compile(r'(?<!\w)(?:' + '|'.join(re.escape(term) for term in terms) + r')\w*', re.IGNORECASE)
+    first = pattern.search(text)
+    if not first:
+        return ''
+
+    start = max(0, first.start() - radius)
+    end = min(len(text), first.end() + radius)
+    excerpt = ' '.join(text[start:end].split())
+
+    parts = []
+    position = 0
+    for match in pattern.finditer(excerpt):
+        parts.append(html_lib.escape(excerpt[position:match.start()]))
+        parts.append(f"<mark>{html_lib.escape(match.group(0))}</mark>")
+        position = match.end()
+    parts.append(html_lib.escape(excerpt[position:]))
+
+    return ('…' if start > 0 else '') + ''.join(parts) + ('…' if end < len(text) else '')
+
+
+# Sort keys for /api/music?sort=...; ties are broken by filename
+MUSIC_SORT_KEYS = {
+    'filename': lambda record: record['filename'].casefold(),
+    'title': lambda record: record['title'].casefold(),
+    'artist': lambda record: record['artist'].casefold(),
+    'duration': lambda record: float(record['duration'] or 0),
+    'modified': lambda record: record['modified'],
+}
+
+
+def build_sort_orders(records):
+    """Precompute, per sort key, the ascending list of (sort value, filename) entries"""
+    return {
+        key: sorted((sort_value(record), record['filename']) for record in records)
+        for key, sort_value in MUSIC_SORT_KEYS.items()
+    }
 
-    except Exception as e:
-        print(f"Error reading metadata from {image_path}: {e}")
+
+def update_sort_orders(sort_orders, removed, added):
+    """Return new sort orders with removed records taken out and added ones inserted in place"""
+    updated = {}
+    for key, sort_value in MUSIC_SORT_KEYS.items():
+        entries = list(sort_orders[key])
+        for record in removed:
+            entry = (sort_value(record), record['filename'])
+            position = bisect.bisect_left(entries, entry)
+            if position < len(entries) and entries[position] == entry:
+                del entries[position]
+        for record in added:
+            bisect.insort(entries, (sort_value(record), record['filename']))
+        updated[key] = entries
+    return updated
+
+
+def encode_cursor(generation, sort, order, entry):
+    """Opaque cursor pinning the library generation and the last (sort value, filename) served"""
+    raw = json.dumps([generation, sort, order, list(entry)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor. Raises ValueError for malformed cursors."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        generation, sort, order, entry = json.loads(raw)
+        if sort not in MUSIC_SORT_KEYS or order not in ('asc', 'desc'):
+            raise ValueError('unknown sort')
+        value, filename = entry
+        # The entry is bisected into the sort order, so it must compare like its entries
+        if sort == 'duration':
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError('duration cursor value must be a number')
+            value = float(value)
+        elif not isinstance(value, str):
+            raise ValueError(f'{sort} cursor value must be a string')
+        if not isinstance(filename, str):
+            raise ValueError('cursor filename must be a string')
+        # Exactly an int: floats or booleans (true == 1) could otherwise alias a real generation
+        if type(generation) is not int or generation < 0:
+            raise ValueError('cursor generation must be a non-negative integer')
+        return generation, sort, order, (value, filename)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+
+class LibrarySnapshot:
+    """Immutable view of one library (music, pictures or documents).
+
+    Writers build a new snapshot off to the side and publish it with a single
+    reference swap in LIBRARIES; readers grab the current reference without locking
+    and keep a consistent view even if a newer snapshot is published meanwhile.
+    """
+
+    __slots__ = ('kind', 'records', 'generation', 'by_filename', 'search_index', 'sort_orders',
+                 '_full', '_encoded', '_encoded_lock')
+
+    # Cached response variants (e.g. distinct page/per_page pairs) per snapshot, least recently used evicted
+    MAX_ENCODED_VARIANTS = 16
+
+    def __init__(self, kind, records, generation, search_index=None, sort_orders=None):
+        self.kind = kind
+        self.records = tuple(records)  # Sorted by filename; the record dicts are never mutated
+        self.generation = generation  # 0 means the library has not been loaded yet
+        self.by_filename = {record['filename']: record for record in self.records}
+        self.search_index = search_index  # Music only
+        self.sort_orders = sort_orders  # Music only: {sort key: [(sort value, filename), ...]}
+        # The full record list is encoded on first request, not per published change,
+        # and is kept apart from the other variants so they never evict it
+        self._full = None
+        self._encoded = collections.OrderedDict()  # variant -> JSON bytes, most recent last; None once retired
+        self._encoded_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def loading(self):
+        """True for the empty placeholder served until the initial scan publishes the library"""
+        return self.generation == 0
+
+    def etag(self, variant=''):
+        """Strong ETag for a response variant, derived from the library generation"""
+        return f"{self.kind}-{_LIBRARY_EPOCH}.{self.generation}" + (f"-{variant}" if variant else "")
+
+    def encoded(self, variant, build_payload):
+        """Return the JSON bytes for a variant, encoding build_payload() on first use"""
+        if not variant:
+            with self._encoded_lock:
+                # Under the lock so concurrent first requests don't each encode the whole library
+                body = self._full
+                if body is None:
+                    body = encode_json(build_payload())
+                    if self._encoded is not None:
+                        self._full = body
+                return body
+
+        with self._encoded_lock:
+            body = self._encoded.get(variant) if self._encoded is not None else None
+            if body is not None:
+                self._encoded.move_to_end(variant)
+                return body
+        body = encode_json(build_payload())
+        with self._encoded_lock:
+            if self._encoded is not None:
+                self._encoded[variant] = body
+                while len(self._encoded) > self.MAX_ENCODED_VARIANTS:
+                    self._encoded.popitem(last=False)
+        return body
+
+    def retire(self):
+        """Drop cached bodies once a newer snapshot is published.
+
+        Retired snapshots may still be pinned for cursor paging, so they keep their
+        records but encode every response afresh instead of holding on to JSON.
+        """
+        with self._encoded_lock:
+            self._full = None
+            self._encoded = None
+
+
+_LIBRARY_GENERATIONS = itertools.count(1)
+# Generations restart with the process, so ETags also carry the start time
+_LIBRARY_EPOCH = format(int(time.time()), 'x')
+LIBRARIES = {kind: LibrarySnapshot(kind, (), 0) for kind in ('music', 'pictures', 'documents')}
+LIBRARIES['music'].search_index = SearchIndex.from_records(())
+LIBRARIES['music'].sort_orders = build_sort_orders(())
+# Recently published music snapshots by generation, so cursors can keep paging a pinned view
+RECENT_MUSIC_SNAPSHOTS = collections.OrderedDict()
+MAX_RECENT_MUSIC_SNAPSHOTS = 4
+
+
+def snapshot_response(snapshot, variant='', build_payload=None, cache=True):
+    """Serve a snapshot's pre-encoded JSON with an ETag, or 304 if the client is current.
+
+    With cache=False the body is encoded per request instead of being kept in the
+    snapshot (for small, open-ended variants such as single-track details).
+    """
+    build_payload = build_payload or (lambda: snapshot.records)
+
+    def encode():
+        return snapshot.encoded(variant, build_payload) if cache else encode_json(build_payload())
+
+    if snapshot.loading:
+        # Still scanning: an empty placeholder the client must not keep
+        body = encode()
+        response = app.response_class(body, mimetype='application/json')
+        response.headers['Cache-Control'] = 'no-store'
+        response.headers['X-Library-Loading'] = '1'
+        return response
+
+    etag = snapshot.etag(variant)
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(encode(), mimetype='application/json')
+    response.set_etag(etag)
+    # Let browsers keep the body but revalidate on every refresh
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def publish_library(kind, records, removed=None, added=None):
+    """Atomically replace a library's snapshot. Callers must hold FILE_CHANGE_LOCK.
+
+    Per-file updates pass the removed/added records so derived indexes are updated
+    incrementally; full scans rebuild them.
+    """
+    search_index = None
+    sort_orders = None
+    if kind == 'music':
+        previous = LIBRARIES[kind]
+        if removed is None and added is None and previous.generation:
+            # Full scan: diff against the previous snapshot so unchanged tracks keep their postings
+            current = {record['filename']: record for record in records}
+            removed = [r for name, r in previous.by_filename.items() if current.get(name) != r]
+            added = [r for name, r in current.items() if previous.by_filename.get(name) != r]
+            if len(removed) + len(added) > len(current) // 2:
+                removed = added = None
+        if removed is not None or added is not None:
+            search_index = previous.search_index.updated(removed or (), added or ())
+            sort_orders = update_sort_orders(previous.sort_orders, removed or (), added or ())
+        else:
+            search_index = SearchIndex.from_records(records)
+            sort_orders = build_sort_orders(records)
+    snapshot = LibrarySnapshot(kind, records, next(_LIBRARY_GENERATIONS), search_index, sort_orders)
+    previous = LIBRARIES[kind]
+    LIBRARIES[kind] = snapshot
+    previous.retire()
+    if kind == 'music':
+        RECENT_MUSIC_SNAPSHOTS[snapshot.generation] = snapshot
+        while len(RECENT_MUSIC_SNAPSHOTS) > MAX_RECENT_MUSIC_SNAPSHOTS:
+            RECENT_MUSIC_SNAPSHOTS.popitem(last=False)
+    return snapshot
+
+
+def ensure_library_loaded(kind):
+    """Return the library snapshot without waiting for it to load.
+
+    Until the initial scan publishes it, this is the empty generation-0 snapshot
+    (snapshot.loading); the scan is started here if nothing started it yet.
+    """
+    snapshot = LIBRARIES[kind]
+    if not snapshot.generation:
+        start_library_load()
+    return snapshot
+
+
+LIBRARY_LOAD_THREAD = None
+LIBRARY_LOAD_LOCK = threading.Lock()
+
+def load_libraries():
+    """Initial scan of every library, music first, each published as soon as it is loaded"""
+    for kind, load_library in (('music', load_metadata), ('pictures', load_picture_metadata),
+                               ('documents', load_document_metadata)):
+        # One library at a time, so file-change updates for loaded ones aren't held up
+        with FILE_CHANGE_LOCK:
+            if not LIBRARIES[kind].generation:  # /api/refresh may have got there first
+                with startup_phase(f'load {kind}'):
+                    load_library()
+    print(f"Libraries loaded {(time.perf_counter() - STARTUP_STARTED) * 1000:.1f} ms after start")
+
+def start_library_load():
+    """Run load_libraries on a background thread, unless it is already running"""
+    global LIBRARY_LOAD_THREAD
+    with LIBRARY_LOAD_LOCK:
+        if LIBRARY_LOAD_THREAD is None or not LIBRARY_LOAD_THREAD.is_alive():
+            LIBRARY_LOAD_THREAD = threading.Thread(target=load_libraries, name='library-load', daemon=True)
+            LIBRARY_LOAD_THREAD.start()
+
+
+def parse_files(kind, parse_file, jobs):
+    """Run parse_file over [(filepath, file_stat)] jobs on a bounded worker pool.
+
+    Tag reads are mostly SD-card waits, so they fan out to threads; kinds in
+    SCAN_PROCESS_KINDS go to processes to sidestep the GIL. Those are started from a
+    forkserver (or spawned), never forked: by now this process runs daemon threads
+    whose locks a forked child could inherit held. Results come back in job order,
+    so merging them is deterministic.
+    """
+    workers = min(SCAN_MAX_WORKERS, len(jobs))
+    if workers <= 1:
+        return [parse_file(filepath, file_stat) for filepath, file_stat in jobs]
+
+    filepaths = [filepath for filepath, _ in jobs]
+    file_stats = [file_stat for _, file_stat in jobs]
+
+    if kind in SCAN_PROCESS_KINDS:
         try:
-            img = Image.open(image_path)
-            w, h = img.size
-            return {'width': w, 'height': h, 'title': '', 'caption': '', 'make': '', 'model': '', 'date_taken': ''}
-        except:
-            return {'width': 0, 'height': 0, 'title': '', 'caption': '', 'make': '', 'model': '', 'date_taken': ''}
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            context = multiprocessing.get_context(start_method)
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+                chunksize = max(1, len(jobs) // (workers * 4))
+                return list(pool.map(parse_file, filepaths, file_stats, chunksize=chunksize))
+        except (OSError, BrokenProcessPool) as e:
+            print(f"  Warning: process pool unavailable for {kind} ({e}), falling back to threads")
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"scan-{kind}") as pool:
+        return list(pool.map(parse_file, filepaths, file_stats))
+
+def scan_folder(kind, folder, filenames, parse_file):
+    """Build the record list for a folder, reusing index entries whose stat is unchanged.
+
+    parse_file(filepath, file_stat) returns the record for one file, or None on failure.
+    Files that need parsing are handed to parse_files as one batch.
+    """
+    known = METADATA_INDEX.load(kind)
+    records = []
+    jobs = []
+    keep_paths = set()
+
+    for filename in filenames:
+        filepath = os.path.join(folder, filename)
+        try:
+            file_stat = os.stat(filepath)
+        except OSError as e:
+            print(f"  Error reading {filename}: {e}")
+            continue
 
+        keep_paths.add(filepath)
+        entry = known.get(filepath)
+        if entry and entry[0] == file_stat.st_size and entry[1] == file_stat.st_mtime_ns:
+            records.append(entry[2])
+        else:
+            jobs.append((filepath, file_stat))
+
+    reused = len(records)
+    started = time.time()
+    fresh = {}
+    for (filepath, file_stat), record in zip(jobs, parse_files(kind, parse_file, jobs)):
+        if record is None:
+            continue
+        fresh[filepath] = (file_stat.st_size, file_stat.st_mtime_ns, record)
+        records.append(record)
+    parse_seconds = time.time() - started
+
+    METADATA_INDEX.update(kind, fresh, keep_paths)
+    SCAN_STATS[kind] = {
+        'reused': reused,
+        'parsed': len(jobs),
+        'total': len(records),
+        'parse_seconds': round(parse_seconds, 3),
+    }
+    print(f"  Metadata index ({kind}): reused {reused} entries, re-parsed {len(jobs)} files"
+          f" in {parse_seconds:.2f}s")
 
+    records.sort(key=lambda x: x['filename'])
+    return records
 
-def generate_thumbnail(image_path, thumb_path):
+def parse_picture_file(filepath, file_stat):
+    """Build the metadata record for one picture (thumbnails are queued separately)"""
+    filename = os.path.basename(filepath)
 
-    """Generate thumbnail for image"""
     try:
-        if os.path.exists(thumb_path):
-            return True
-            
-        img = Image.open(image_path)
-        img.thumbnail((300, 300))
-        
-        # Ensure directory exists
-        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
-        
-        # Save as JPEG
-        img.save(thumb_path, "JPEG", quality=70)
-        return True
+        # Get metadata
+        exif_data = get_exif_data(filepath, file_stat)
+
+        return {
+            'filename': filename,
+            'thumbnail_url': f'/api/pictures/{filename}/thumbnail',
+            'url': f'/api/pictures/{filename}',
+            'title': exif_data['title'] or filename,
+            'caption': exif_data['caption'],
+            'width': exif_data['width'],
+            'height': exif_data['height'],
+            'date_taken': exif_data.get('date_taken', ''),
+            'created': datetime.fromtimestamp(file_stat.st_ctime).isoformat(),
+            'modified': datetime.fromtimestamp(file_stat.st_mtime).isoformat()
+        }
     except Exception as e:
-        print(f"Error generating thumbnail for {image_path}: {e}")
-        return False
+        print(f"Error processing picture {filename}: {e}")
+        return None
 
 def load_picture_metadata():
     """Load metadata from pictures folder"""
-    global PICTURES_CACHE
     print("Loading picture metadata...")
-    pictures = []
-    
+
     if not os.path.exists(PICTURES_FOLDER):
         os.makedirs(PICTURES_FOLDER)
-        PICTURES_cache = []
+        publish_library('pictures', [])
         return
 
     if not os.path.exists(THUMBNAILS_FOLDER):
         os.makedirs(THUMBNAILS_FOLDER)
 
-    valid_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
-    files = [f for f in os.listdir(PICTURES_FOLDER) if f.lower().endswith(valid_extensions)]
-    
-    for filename in files:
-        filepath = os.path.join(PICTURES_FOLDER, filename)
-        thumb_filename = f"{os.path.splitext(filename)[0]}.jpg"
-        thumb_path = os.path.join(THUMBNAILS_FOLDER, thumb_filename)
-        
-        try:
-            # Generate thumbnail if needed
-            generate_thumbnail(filepath, thumb_path)
-            
-            # Get metadata
-            exif_data = get_exif_data(filepath)
-            file_stat = os.stat(filepath)
-            
-            picture = {
-                'filename': filename,
-                'thumbnail_url': f'/api/pictures/{filename}/thumbnail',
-                'url': f'/api/pictures/{filename}',
-                'title': exif_data['title'] or filename,
-                'caption': exif_data['caption'],
-                'width': exif_data['width'],
-                'height': exif_data['height'],
-                'date_taken': exif_data.get('date_taken', ''),
-                'created': datetime.fromtimestamp(file_stat.st_ctime).isoformat(),
-                'modified': datetime.fromtimestamp(file_stat.st_mtime).isoformat()
-            }
-            pictures.append(picture)
-        except Exception as e:
-            print(f"Error processing picture {filename}: {e}")
-            
-    pictures.sort(key=lambda x: x['filename'])
-    PICTURES_CACHE = pictures
+    files = [f for f in os.listdir(PICTURES_FOLDER) if f.lower().endswith(PICTURE_EXTENSIONS)]
+
+    pictures = scan_folder('pictures', PICTURES_FOLDER, files, parse_picture_file)
+
+    publish_library('pictures', pictures)
+    # Cleanup measures the cache before any pre-generation job runs, so those can respect the quota
+    schedule_thumbnail_cleanup()
+
+    # The scan only enqueues thumbnail work; the background worker generates them
+    queued = 0
+    for picture in pictures:
+        if thumbnails_missing(picture['filename']):
+            queue_thumbnails(picture['filename'])
+            queued += 1
+    if queued:
+        print(f"Queued thumbnail generation for {queued} pictures.")
     print(f"Loaded {len(pictures)} pictures.")
 
+def parse_document_file(filepath, file_stat):
+    """Build the metadata record for one document"""
+    filename = os.path.basename(filepath)
+    try:
+        ext = os.path.splitext(filename)[1].lower().replace('.', '')
+        title = filename
+        if ext == 'md':
+            try:
+                with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
+                    for line in f:
+                        line = line.strip()
+                        if line.startswith('#'):
+                            title = line.lstrip('#').strip()
+                            break
+            except Exception:
+                pass
+
+        return {
+            'filename': filename,
+            'title': title,
+            'url': f'/api/documents/{filename}',
+            'size': file_stat.st_size,
+            'created': datetime.fromtimestamp(file_stat.st_ctime).isoformat(),
+            'modified': datetime.fromtimestamp(file_stat.st_mtime).isoformat(),
+            'type': ext
+        }
+    except Exception as e:
+        print(f"Error processing document {filename}: {e}")
+        return None
+
 def load_document_metadata():
     """Load metadata from documents folder"""
-    global DOCUMENTS_CACHE
     print("Loading document metadata...")
-    documents = []
-    
+
     if not os.path.exists(DOCUMENTS_FOLDER):
         os.makedirs(DOCUMENTS_FOLDER)
-        DOCUMENTS_CACHE = []
+        publish_library('documents', [])
         return
-        
-    for filename in os.listdir(DOCUMENTS_FOLDER):
-        if filename.startswith('.'): continue
-        
-        filepath = os.path.join(DOCUMENTS_FOLDER, filename)
-        if os.path.isdir(filepath): continue
-        
-        try:
-            file_stat = os.stat(filepath)
-            
-            ext = os.path.splitext(filename)[1].lower().replace('.', '')
-            title = filename
-            if ext == 'md':
-                try:
-                    with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-                        for line in f:
-                            line = line.strip()
-                            if line.startswith('#'):
-                                title = line.lstrip('#').strip()
-                                break
-                except Exception:
-                    pass
-
-            doc = {
-                'filename': filename,
-                'title': title,
-                'url': f'/api/documents/{filename}',
-                'size': file_stat.st_size,
-                'created': datetime.fromtimestamp(file_stat.st_ctime).isoformat(),
-                'modified': datetime.fromtimestamp(file_stat.st_mtime).isoformat(),
-                'type': ext
-            }
-            documents.append(doc)
-        except Exception as e:
-            print(f"Error processing document {filename}: {e}")
-            
-    documents.sort(key=lambda x: x['filename'])
-    DOCUMENTS_CACHE = documents
+
+    files = [
+        f for f in os.listdir(DOCUMENTS_FOLDER)
+        if not f.startswith('.') and not os.path.isdir(os.path.join(DOCUMENTS_FOLDER, f))
+    ]
+
+    documents = scan_folder('documents', DOCUMENTS_FOLDER, files, parse_document_file)
+    publish_library('documents', documents)
     print(f"Loaded {len(documents)} documents.")
 
+    if PDF_PRERENDER:
+        for document in documents:
+            if is_markdown(document['filename']):
+                queue_pdf(document['filename'])
+
+def parse_music_file(filepath, file_stat):
+    """Build the metadata record for one MP3 file"""
+    filename = os.path.basename(filepath)
+    ID3NoHeaderError = lazy_module('mutagen.id3').ID3NoHeaderError
+    try:
+        audio = lazy_module('mutagen.mp3').MP3(filepath)
+
+        title = filename[:-4]
+        artist = "Unknown"
+        lyrics = ""
+
+        try:
+            tags = audio.tags
+            if tags:
+                if 'TIT2' in tags:
+                    title = str(tags['TIT2'][0])
+
+                if 'TPE1' in tags:
+                    artist = str(tags['TPE1'][0])
+
+                lyrics_keys = [k for k in tags.keys() if k.startswith('USLT')]
+                if lyrics_keys:
+                    lyrics_value = tags[lyrics_keys[0]]
+                    if hasattr(lyrics_value, 'text'):
+                        lyrics = str(lyrics_value.text)
+                    else:
+                        lyrics = str(lyrics_value)
+        except (ID3NoHeaderError, AttributeError, Exception) as e:
+            print(f"    Warning: Could not read ID3 tags for {filename}: {e}")
+
+        duration = audio.info.length if hasattr(audio.info, 'length') else 0
+
+        return {
+            'filename': filename,
+            'title': title,
+            'artist': artist,
+            'lyrics': lyrics,
+            'duration': duration,
+            'created': datetime.fromtimestamp(file_stat.st_ctime).isoformat(),
+            'modified': datetime.fromtimestamp(file_stat.st_mtime).isoformat()
+        }
+
+    except Exception as e:
+        print(f"  Error processing {filename}: {e}")
+        return None
+
 def load_metadata():
     """Load metadata from all MP3 files in the music folder"""
-    global METADATA_CACHE
     print("Starting load_metadata function...")
-    metadata_list = []
 
     if not os.path.exists(MUSIC_FOLDER):
         print(f"Music folder not found: {MUSIC_FOLDER}. Creating it.")
         os.makedirs(MUSIC_FOLDER)
-        METADATA_CACHE = metadata_list
+        publish_library('music', [])
         return
 
     files = [f for f in os.listdir(MUSIC_FOLDER) if f.endswith('.mp3')]
     print(f"Found {len(files)} MP3 files to process.")
 
-    for filename in files:
-        filepath = os.path.join(MUSIC_FOLDER, filename)
-        # print(f"  Processing: {filename}") 
+    metadata_list = scan_folder('music', MUSIC_FOLDER, files, parse_music_file)
+    publish_library('music', metadata_list)
+    print(f"Finished load_metadata. Cache updated with {len(metadata_list)} items.")
 
-        try:
-            audio = MP3(filepath)
+def library_kind_for_path(path):
+    """Return which library ('music', 'pictures', 'documents') a path belongs to, or None.
 
-            title = filename[:-4]
-            artist = "Unknown"
-            lyrics = ""
+    Mirrors the filename filters used by the full scans.
+    """
+    folder = os.path.abspath(os.path.dirname(path))
+    filename = os.path.basename(path)
+    if folder == os.path.abspath(MUSIC_FOLDER) and filename.endswith('.mp3'):
+        return 'music'
+    if folder == os.path.abspath(PICTURES_FOLDER) and filename.lower().endswith(PICTURE_EXTENSIONS):
+        return 'pictures'
+    if folder == os.path.abspath(DOCUMENTS_FOLDER) and not filename.startswith('.'):
+        return 'documents'
+    return None
+
+def _library_sources(kind):
+    """Return (folder, parse function) for a library"""
+    return {
+        'music': (MUSIC_FOLDER, parse_music_file),
+        'pictures': (PICTURES_FOLDER, parse_picture_file),
+        'documents': (DOCUMENTS_FOLDER, parse_document_file),
+    }[kind]
+
+def _record_position(records, filename):
+    """Binary search for filename in a list of records sorted by filename"""
+    lo, hi = 0, len(records)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if records[mid]['filename'] < filename:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
 
-            try:
-                tags = audio.tags
-                if tags:
-                    if 'TIT2' in tags:
-                        title = str(tags['TIT2'][0])
-                    elif 'TIT2' in tags:
-                        title = str(tags['TIT2'][0])
-
-                    if 'TPE1' in tags:
-                        artist = str(tags['TPE1'][0])
-                    elif 'TPE1' in tags:
-                        artist = str(tags['TPE1'][0])
-
-                    lyrics_keys = [k for k in tags.keys() if k.startswith('USLT')]
-                    if lyrics_keys:
-                        lyrics_value = tags[lyrics_keys[0]]
-                        if hasattr(lyrics_value, 'text'):
-                            lyrics = str(lyrics_value.text)
-                        else:
-                            lyrics = str(lyrics_value)
-            except (ID3NoHeaderError, AttributeError, Exception) as e:
-                print(f"    Warning: Could not read ID3 tags for {filename}: {e}")
+def apply_library_change(kind, path):
+    """Insert, replace or remove the record for a single file and publish the new snapshot.
 
-            file_stat = os.stat(filepath)
-            duration = audio.info.length if hasattr(audio.info, 'length') else 0
-
-            metadata = {
-                'filename': filename,
-                'title': title,
-                'artist': artist,
-                'lyrics': lyrics,
-                'duration': duration,
-                'created': datetime.fromtimestamp(file_stat.st_ctime).isoformat(),
-                'modified': datetime.fromtimestamp(file_stat.st_mtime).isoformat()
-            }
+    Only the affected file is parsed, and the records stay sorted by filename
+    without re-sorting. Callers must hold FILE_CHANGE_LOCK.
+    """
+    records = LIBRARIES[kind].records
+    if not LIBRARIES[kind].generation:
+        # Never loaded: the initial scan will pick the file up
+        return
+    folder, parse_file = _library_sources(kind)
+    filename = os.path.basename(path)
+    filepath = os.path.join(folder, filename)
 
-            metadata_list.append(metadata)
+    position = _record_position(records, filename)
+    present = position < len(records) and records[position]['filename'] == filename
 
-        except Exception as e:
-            print(f"  Error processing {filename}: {e}")
-            continue
+    try:
+        file_stat = os.stat(filepath)
+        if os.path.isdir(filepath):
+            file_stat = None
+    except OSError:
+        file_stat = None
+
+    if file_stat is None:
+        if present:
+            removed = records[position]
+            records = records[:position] + records[position + 1:]
+            publish_library(kind, records, removed=[removed])
+            print(f"Removed {filename} from {kind} library ({len(records)} items)")
+            if kind == 'pictures':
+                schedule_thumbnail_cleanup()
+            elif kind == 'documents':
+                remove_rendered_documents(filename, 'pdf')
+                with RENDERED_DOCUMENTS_LOCK:
+                    RENDERED_DOCUMENTS.pop(filename, None)
+        METADATA_INDEX.remove(kind, [filepath])
+        return
+
+    entry = METADATA_INDEX.get(kind, filepath)
+    if entry and entry[0] == file_stat.st_size and entry[1] == file_stat.st_mtime_ns:
+        record = entry[2]
+    else:
+        record = parse_file(filepath, file_stat)
+        if record is None:
+            return
+        METADATA_INDEX.update(kind, {filepath: (file_stat.st_size, file_stat.st_mtime_ns, record)})
+
+    if present:
+        publish_library(kind, records[:position] + (record,) + records[position + 1:],
+                        removed=[records[position]], added=[record])
+        print(f"Updated {filename} in {kind} library")
+    else:
+        records = records[:position] + (record,) + records[position:]
+        publish_library(kind, records, added=[record])
+        print(f"Added {filename} to {kind} library ({len(records)} items)")
+
+    # Queued only once the record is published, so a concurrent thumbnail cleanup
+    # already counts the new thumbnails as belonging to a library picture
+    if kind == 'pictures':
+        queue_thumbnails(filename)
+        if present:
+            # The edited picture's old thumbnails are now orphans
+            schedule_thumbnail_cleanup()
+    elif kind == 'documents' and PDF_PRERENDER and is_markdown(filename):
+        queue_pdf(filename)
 
-    metadata_list.sort(key=lambda x: x['filename'])
-    METADATA_CACHE = metadata_list
-    print(f"Finished load_metadata. Cache updated with {len(metadata_list)} items.")
 
 def get_music_folder():
     """Get the music folder path (for local services on same machine)"""
@@ -612,158 +2221,497 @@ def get_music_folder():
 @app.route('/')
 def index():
     """Serve the main web interface"""
-    # Check if internet is available
-    check_internet_connection()
-    if not INTERNET_AVAILABLE:
+    # Check if internet is available (cached by the background prober)
+    if not internet_available():
         # Redirect to WiFi setup page if offline
         from flask import redirect
         return redirect('/setup-wifi')
     return send_from_directory('static', 'index.html')
 
-@app.route('/api/tailscale/status')
-def tailscale_status():
-    """Get TailScale status"""
+def read_tailscale_status():
+    """Parsed `tailscale status --json` (blocking; the API serves TAILSCALE_STATUS instead)"""
+    import shutil
+
+    if shutil.which('tailscale') is None:
+        return {
+            'installed': False,
+            'running': False,
+            'error': 'TailScale not installed'
+        }
     try:
         result = subprocess.run(['tailscale', 'status', '--json'],
                               capture_output=True, text=True, timeout=10)
 
         if result.returncode != 0:
-            return jsonify({
+            return {
                 'installed': False,
                 'running': False,
                 'error': result.stderr
-            }), 200
+            }
 
-        import json
         status_data = json.loads(result.stdout)
 
-        # Parse status
-        installed = True
-        running = status_data.get('BackendState') == 'Running'
-
-        return jsonify({
-            'installed': installed,
-            'running': running,
+        return {
+            'installed': True,
+            'running': status_data.get('BackendState') == 'Running',
             'status': status_data,
             'url': status_data.get('Self', {}).get('ID', ''),
             'addresses': status_data.get('Self', {}).get('TailscaleIPs', []),
             'version': status_data.get('Version', '')
-        }), 200
+        }
 
     except subprocess.TimeoutExpired:
-        return jsonify({
+        return {
             'installed': True,
             'running': False,
             'error': 'Command timed out'
-        }), 200
-    except FileNotFoundError:
-        return jsonify({
-            'installed': False,
-            'running': False,
-            'error': 'TailScale not installed'
-        }), 200
+        }
     except Exception as e:
-        return jsonify({
+        return {
             'installed': True,
             'running': False,
             'error': str(e)
-        }), 200
+        }
 
-@app.route('/api/tailscale/up', methods=['POST'])
-def tailscale_up():
-    """Enable TailScale"""
+TAILSCALE_STATUS = PeriodicRefresher('tailscale-status', read_tailscale_status, TAILSCALE_STATUS_INTERVAL)
+# up/down run one at a time; resubmitting an action that is already pending returns the same job
+TAILSCALE_JOBS = BackgroundJobQueue('tailscale')
+
+def run_tailscale_command(action):
+    """Run `sudo tailscale up|down`; raises with tailscale's output if it fails"""
     try:
-        result = subprocess.run(['sudo', 'tailscale', 'up'],
+        result = subprocess.run(['sudo', 'tailscale', action],
                               capture_output=True, text=True, timeout=30)
+    finally:
+        TAILSCALE_STATUS.trigger()
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip() or f'tailscale {action} exited with {result.returncode}')
+    return {'message': f"TailScale {'enabled' if action == 'up' else 'disabled'} successfully"}
 
-        if result.returncode == 0:
-            return jsonify({
-                'status': 'success',
-                'message': 'TailScale enabled successfully'
-            }), 200
-        else:
-            return jsonify({
-                'status': 'error',
-                'message': result.stderr
-            }), 500
+@app.route('/api/tailscale/status')
+def tailscale_status():
+    """Get TailScale status (cached by a background refresher; age_seconds says how old).
 
-    except Exception as e:
-        return jsonify({
-            'status': 'error',
-            'message': str(e)
-        }), 500
+    Until the first probe finishes this returns a placeholder with pending: true
+    rather than waiting for it.
+    """
+    TAILSCALE_STATUS.start()
+    if TAILSCALE_STATUS.updated is None:
+        return jsonify({'pending': True, 'installed': None, 'running': None, 'age_seconds': None}), 200
+    status = dict(TAILSCALE_STATUS.value or {'installed': False, 'running': False, 'error': 'Status not available yet'})
+    age = TAILSCALE_STATUS.age()
+    status['age_seconds'] = round(age, 1) if age is not None else None
+    return jsonify(status), 200
+
+def _queue_tailscale_command(action):
+    job = TAILSCALE_JOBS.submit(('tailscale', action), run_tailscale_command, action, priority=PRIORITY_ON_DEMAND)
+    return jsonify({
+        'status': 'accepted',
+        'job_id': job.id,
+        'job': job.to_dict()
+    }), 202
+
+@app.route('/api/tailscale/up', methods=['POST'])
+def tailscale_up():
+    """Enable TailScale in the background; poll /api/tailscale/jobs/<job_id> for the outcome"""
+    return _queue_tailscale_command('up')
 
 @app.route('/api/tailscale/down', methods=['POST'])
 def tailscale_down():
-    """Disable TailScale"""
-    try:
-        result = subprocess.run(['sudo', 'tailscale', 'down'],
-                              capture_output=True, text=True, timeout=30)
+    """Disable TailScale in the background; poll /api/tailscale/jobs/<job_id> for the outcome"""
+    return _queue_tailscale_command('down')
+
+@app.route('/api/tailscale/jobs/<job_id>')
+def tailscale_job(job_id):
+    """State of a TailScale up/down job"""
+    job = TAILSCALE_JOBS.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    return jsonify(job.to_dict()), 200
+
+# Fields selectable with /api/music?fields=...; filename is always included as the track key
+MUSIC_FIELDS = ('filename', 'title', 'artist', 'lyrics', 'duration', 'created', 'modified')
+LYRICS_PREVIEW_LENGTH = 100
+MUSIC_DERIVED_FIELDS = {
+    'lyrics_preview': lambda record: record['lyrics'][:LYRICS_PREVIEW_LENGTH],
+    'has_lyrics': lambda record: bool(record['lyrics']),
+}
+
+def parse_music_fields(value):
+    """Parse a comma-separated fields= value into a field tuple (None = all fields).
+
+    Raises ValueError for unknown field names.
+    """
+    if not value:
+        return None
+    fields = ['filename']
+    for field in value.split(','):
+        field = field.strip()
+        if not field or field in fields:
+            continue
+        if field not in MUSIC_FIELDS and field not in MUSIC_DERIVED_FIELDS:
+            raise ValueError(f"Unknown field '{field}'")
+        fields.append(field)
+    return tuple(fields)
+
+def project_record(record, fields):
+    """Return only the requested fields of a music record"""
+    if fields is None:
+        return record
+    return {
+        field: MUSIC_DERIVED_FIELDS[field](record) if field in MUSIC_DERIVED_FIELDS else record.get(field)
+        for field in fields
+    }
 
-        if result.returncode == 0:
-            return jsonify({
-                'status': 'success',
-                'message': 'TailScale disabled successfully'
-            }), 200
-        else:
-            return jsonify({
-                'status': 'error',
-                'message': result.stderr
-            }), 500
+MAX_CURSOR_PAGE_SIZE = 500
 
-    except Exception as e:
-        return jsonify({
-            'status': 'error',
-            'message': str(e)
-        }), 500
+def sorted_slice(entries, descending, start, stop):
+    """Slice [start:stop) of a sort order, reading it backwards when descending"""
+    if descending:
+        total = len(entries)
+        return entries[max(0, total - stop):max(0, total - start)][::-1]
+    return entries[start:stop]
 
 @app.route('/api/music')
 def get_music():
-    """Return JSON array of music files with metadata"""
+    """Return JSON array of music files with metadata.
+
+    No pagination params returns the full array; page/per_page gives offset pages;
+    cursor/limit (or sort/order alone) gives cursor pages that stay consistent while
+    the library changes.
+    """
     print("Received request: GET /api/music")
-    
-    # Check if cache is empty and try to load if it is
-    if not METADATA_CACHE:
-        print("Cache is empty. Attempting to load metadata...")
-        # We don't use the lock here to avoid potential deadlock if the lock is already held by a stuck observer?
-        # Actually, if we are here, we are in a request thread.
-        # If observer holds the lock, we wait.
-        with FILE_CHANGE_LOCK:
-             if not METADATA_CACHE: # Double check
-                 load_metadata()
-    
-    print("Acquiring lock to read metadata...")
-    with FILE_CHANGE_LOCK:
-        print(f"Returning {len(METADATA_CACHE)} tracks.")
-        # Pagination support
+
+    # Lock-free read of the current snapshot; a concurrent scan publishes a new one
+    snapshot = ensure_library_loaded('music')
+    tracks = snapshot.records
+    print(f"Returning {len(tracks)} tracks.")
+
+    # Optional projection, e.g. ?fields=title,artist,duration to leave out full lyrics
+    try:
+        fields = parse_music_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({
+            'error': str(e),
+            'allowed_fields': list(MUSIC_FIELDS) + list(MUSIC_DERIVED_FIELDS)
+        }), 400
+    fields_variant = f"f{'.'.join(fields)}" if fields else ""
+
+    sort = request.args.get('sort', 'filename')
+    order = request.args.get('order', 'asc')
+    if sort not in MUSIC_SORT_KEYS or order not in ('asc', 'desc'):
+        return jsonify({
+            'error': 'Invalid sort parameters',
+            'allowed_sorts': list(MUSIC_SORT_KEYS),
+            'allowed_orders': ['asc', 'desc']
+        }), 400
+
+    offset_mode = 'page' in request.args or 'per_page' in request.args
+    cursor_mode = not offset_mode and any(
+        arg in request.args for arg in ('cursor', 'limit', 'sort', 'order')
+    )
+
+    # For backward compatibility, if no pagination params, return full array
+    if not offset_mode and not cursor_mode:
+        return snapshot_response(
+            snapshot, fields_variant, lambda: [project_record(track, fields) for track in tracks]
+        )
+
+    if cursor_mode:
+        try:
+            limit = int(request.args.get('limit', 50))
+        except ValueError:
+            limit = 0
+        if limit <= 0 or limit > MAX_CURSOR_PAGE_SIZE:
+            return jsonify({'error': f'limit must be between 1 and {MAX_CURSOR_PAGE_SIZE}'}), 400
+
+        cursor = request.args.get('cursor', '')
+        after = None
+        view = snapshot
+        if cursor:
+            try:
+                generation, sort, order, after = decode_cursor(cursor)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            # Keep paging the generation the cursor was issued for while it is retained;
+            # otherwise resume after the same (sort value, filename) in the current one.
+            view = RECENT_MUSIC_SNAPSHOTS.get(generation, snapshot)
+
+        def build_cursor_page():
+            entries = view.sort_orders[sort]
+            descending = order == 'desc'
+            if after is None:
+                start = 0
+            elif descending:
+                start = len(entries) - bisect.bisect_left(entries, after)
+            else:
+                start = bisect.bisect_right(entries, after)
+            page_entries = sorted_slice(entries, descending, start, start + limit)
+            has_more = start + limit < len(entries)
+            return {
+                'tracks': [project_record(view.by_filename[name], fields) for _, name in page_entries],
+                'total': len(entries),
+                'sort': sort,
+                'order': order,
+                'limit': limit,
+                'generation': view.generation,
+                'next_cursor': (encode_cursor(view.generation, sort, order, page_entries[-1])
+                                if has_more and page_entries else None)
+            }
+
+        # Keyed by the re-encoded cursor: decoding is lenient, so equivalent cursor strings share
+        # a page, and the canonical form is URL-safe base64, which an ETag can carry as is
+        position = encode_cursor(generation, sort, order, after) if after is not None else ''
+        variant = f"c{sort}.{order}.{limit}.{position}{fields_variant}"
+        return snapshot_response(view, variant, build_cursor_page)
+
+    # Pagination support
+    try:
         page = int(request.args.get('page', 1))
         per_page = int(request.args.get('per_page', 50))
+    except ValueError:
+        return jsonify({'error': 'Invalid pagination parameters'}), 400
 
-        if page <= 0 or per_page <= 0:
-            return jsonify({'error': 'Invalid pagination parameters'}), 400
+    if page <= 0 or per_page <= 0:
+        return jsonify({'error': 'Invalid pagination parameters'}), 400
 
+    def build_page():
         start = (page - 1) * per_page
         end = start + per_page
-        paginated_tracks = METADATA_CACHE[start:end]
-
-        response = {
-            'tracks': paginated_tracks,
-            'total': len(METADATA_CACHE),
+        if sort == 'filename' and order == 'asc':
+            page_tracks = tracks[start:end]
+        else:
+            page_entries = sorted_slice(snapshot.sort_orders[sort], order == 'desc', start, end)
+            page_tracks = [snapshot.by_filename[name] for _, name in page_entries]
+        return {
+            'tracks': [project_record(track, fields) for track in page_tracks],
+            'total': len(tracks),
             'page': page,
             'per_page': per_page,
-            'total_pages': (len(METADATA_CACHE) + per_page - 1) // per_page
+            'total_pages': (len(tracks) + per_page - 1) // per_page
         }
 
-        # For backward compatibility, if no pagination params, return full array
-        if 'page' not in request.args and 'per_page' not in request.args:
-            return jsonify(METADATA_CACHE)
+    # Each (page, per_page, sort, fields) slice is encoded once per library generation
+    return snapshot_response(snapshot, f"p{page}x{per_page}.{sort}.{order}{fields_variant}", build_page)
+
+@app.route('/api/music/search')
+def search_music():
+    """Ranked search over track titles, artists and lyrics (?q=...&limit=20)"""
+    query = request.args.get('q', '').strip()
+    try:
+        limit = min(int(request.args.get('limit', 20)), 100)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    if limit <= 0:
+        return jsonify({'error': 'Invalid limit'}), 400
+
+    snapshot = ensure_library_loaded('music')
+    started = time.perf_counter()
+    ranked, total = snapshot.search_index.search(query, limit)
+
+    results = []
+    for filename, score in ranked:
+        track = snapshot.by_filename[filename]
+        results.append({
+            'filename': filename,
+            'title': track['title'],
+            'artist': track['artist'],
+            'duration': track['duration'],
+            'score': round(score, 2),
+            'snippet': highlight_snippet(track['lyrics'], query),
+        })
+
+    return jsonify({
+        'query': query,
+        'total': total,
+        'loading': snapshot.loading,
+        'results': results,
+        'took_ms': round((time.perf_counter() - started) * 1000, 2)
+    })
+
+@app.route('/api/music/<filename>')
+def get_track(filename):
+    """Return the full record (including lyrics) for one track"""
+    snapshot = ensure_library_loaded('music')
+    if snapshot.loading:
+        response = jsonify({'error': 'Music library is still loading', 'loading': True})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    track = snapshot.by_filename.get(filename)
+    if track is None:
+        return jsonify({'error': 'Track not found'}), 404
+    # One record is cheap to encode, so details don't take cache slots from the list pages;
+    # the ETag carries the whole (percent-encoded) filename so no two tracks share one
+    return snapshot_response(snapshot, f"t{quote(filename, safe='')}", lambda: track, cache=False)
+
+def _bounded_file_iter(f, start, length):
+    """Yield `length` bytes of f from `start`, then close it"""
+    try:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+def _file_body(f, start, length):
+    """Response body for one byte span of an open file.
+
+    Servers providing wsgi.file_wrapper (waitress, gunicorn) send it from their I/O
+    loop or with sendfile, honouring Content-Length, instead of iterating in Python.
+    """
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is None:
+        return _bounded_file_iter(f, start, length)
+    f.seek(start)
+    return file_wrapper(f, STREAM_CHUNK_SIZE)
+
+BYTE_RANGE_SPEC = re.compile(r'\s*(\d*)-(\d*)\s*')
+
+def _parse_byte_ranges(header):
+    """(start, stop) pairs from a Range header, or None if it is absent or malformed.
+
+    Suffix ranges ("-500") come back as (None, 500). Unlike werkzeug's parser this
+    accepts overlapping and out-of-order ranges, which clients may legitimately send.
+    """
+    unit, _, spec = (header or '').partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for part in spec.split(','):
+        match = BYTE_RANGE_SPEC.fullmatch(part)
+        if not match or not (match.group(1) or match.group(2)):
+            return None
+        first, last = match.groups()
+        if not first:
+            ranges.append((None, int(last)))
+        elif not last:
+            ranges.append((int(first), None))
+        elif int(last) < int(first):
+            return None
+        else:
+            ranges.append((int(first), int(last) + 1))
+    return ranges
+
+def _satisfiable_ranges(ranges, size):
+    """Sorted (start, stop) spans of parsed byte ranges that overlap the file, merged where they touch"""
+    spans = []
+    for start, stop in ranges:
+        if start is None:  # Suffix range: the last `stop` bytes
+            start, stop = max(0, size - stop), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            spans.append((start, stop))
+    merged = []
+    for start, stop in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def _multipart_byteranges(f, spans, size, mimetype, boundary):
+    """multipart/byteranges parts for several spans of f, plus the total body length"""
+    headers = [
+        f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\nContent-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n".encode('ascii')
+        for start, stop in spans
+    ]
+    closing = f"\r\n--{boundary}--\r\n".encode('ascii')
+    length = sum(len(header) for header in headers) + sum(stop - start for start, stop in spans) + len(closing)
+
+    def body():
+        try:
+            for header, (start, stop) in zip(headers, spans):
+                yield header
+                f.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        return
+                    remaining -= len(chunk)
+                    yield chunk
+            yield closing
+        finally:
+            f.close()
+
+    return body(), length
 
-        print(f"Returning {len(paginated_tracks)} tracks (page {page}/{response['total_pages']}).")
-        return jsonify(response)
+def send_ranged_file(folder, filename, mimetype, max_age=3600):
+    """Serve a file with conditional GET and single/multi byte-range support.
+
+    The file is handed to the server as an open file object (see _file_body), so
+    full and single-range responses never pass through Python chunk by chunk.
+    """
+    filepath = safe_join(folder, filename)
+    try:
+        f = open(filepath, 'rb')
+    except (OSError, TypeError):
+        return jsonify({'error': 'File not found'}), 404
+    file_stat = os.fstat(f.fileno())
+    size = file_stat.st_size
+    etag = f"{file_stat.st_mtime_ns:x}-{size:x}"
+    last_modified = datetime.fromtimestamp(int(file_stat.st_mtime), timezone.utc)
+
+    response = app.response_class(mimetype=mimetype, direct_passthrough=True)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = f'public, max-age={max_age}'
+
+    if not is_resource_modified(request.environ, etag, last_modified=last_modified):
+        f.close()
+        response.status_code = 304
+        return response
+
+    spans = None
+    byte_ranges = _parse_byte_ranges(request.headers.get('Range'))
+    if_range = request.if_range
+    if byte_ranges is not None and (
+        not (if_range.etag or if_range.date)
+        or if_range.etag == etag
+        or (if_range.date is not None and last_modified <= if_range.date)
+    ):
+        spans = _satisfiable_ranges(byte_ranges, size)
+        if not spans:
+            f.close()
+            response.status_code = 416
+            response.headers['Content-Range'] = f"bytes */{size}"
+            response.headers['Content-Length'] = '0'
+            return response
+        if len(spans) > MAX_BYTE_RANGES:
+            spans = None  # Not worth the overhead; send the whole file
+
+    if spans is None or len(spans) == 1:
+        start, stop = spans[0] if spans else (0, size)
+        length = stop - start
+        body = None  # Built below, only if there is a body to send
+        if spans:
+            response.status_code = 206
+            response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+    else:
+        boundary = uuid.uuid4().hex
+        body, length = _multipart_byteranges(f, spans, size, mimetype, boundary)
+        response.status_code = 206
+        response.headers['Content-Type'] = f"multipart/byteranges; boundary={boundary}"
+
+    response.headers['Content-Length'] = str(length)
+    if request.method == 'HEAD':
+        f.close()
+        response.response = ()
+    else:
+        response.response = body if body is not None else _file_body(f, start, length)
+    return response
 
 @app.route('/music/<filename>')
 def stream_music(filename):
     """Stream MP3 file for playback"""
+    if STREAM_FILE_WRAPPER:
+        return send_ranged_file(MUSIC_FOLDER, filename, 'audio/mpeg')
     response = make_response(send_from_directory(MUSIC_FOLDER, filename, mimetype='audio/mpeg', conditional=True))
     response.headers['Cache-Control'] = 'public, max-age=3600'  # 1 hour cache
     return response
@@ -771,10 +2719,10 @@ def stream_music(filename):
 @app.route('/api/pictures')
 def get_pictures():
     """Return JSON array of picture files"""
-    with FILE_CHANGE_LOCK:
-        if not PICTURES_CACHE:
-            load_picture_metadata()
-        return jsonify(PICTURES_CACHE)
+    snapshot = ensure_library_loaded('pictures')
+    return snapshot_response(snapshot, build_payload=lambda: [
+        picture_response_record(picture) for picture in snapshot.records
+    ])
 
 @app.route('/api/pictures/<filename>')
 def get_picture(filename):
@@ -783,27 +2731,53 @@ def get_picture(filename):
 
 @app.route('/api/pictures/<filename>/thumbnail')
 def get_thumbnail(filename):
-    """Serve thumbnail file"""
-    thumb_filename = f"{os.path.splitext(filename)[0]}.jpg"
-    
+    """Serve thumbnail file (?size=<px> picks the smallest configured size covering it, ?format=jpeg|webp)"""
+    # Only pictures in the library get thumbnail jobs, so arbitrary names can't flood the queue
+    snapshot = ensure_library_loaded('pictures')
+    if snapshot.loading:
+        response = jsonify({'error': 'Picture library is still loading', 'loading': True})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    if filename not in snapshot.by_filename:
+        return jsonify({'error': 'Picture not found'}), 404
+
+    fmt = request.args.get('format', 'jpeg').lower()
+    if fmt not in THUMBNAIL_FORMATS:
+        return jsonify({'error': f"Unsupported format, use one of: {', '.join(THUMBNAIL_FORMATS)}"}), 400
+    if fmt not in writable_thumbnail_formats():
+        fmt = 'jpeg'  # This Pillow can't write WebP; JPEG is always available
+    try:
+        requested = int(request.args.get('size', DEFAULT_THUMBNAIL_SIZE))
+    except ValueError:
+        requested = 0
+    if requested <= 0:
+        return jsonify({
+            'error': 'size must be a positive number of pixels',
+            'allowed_sizes': list(THUMBNAIL_SIZES)
+        }), 400
+    size = next((s for s in THUMBNAIL_SIZES if s >= requested), THUMBNAIL_SIZES[-1])
+
+    try:
+        thumb_path = thumbnail_path(filename, size, fmt)
+    except OSError:
+        return jsonify({'error': 'Picture not found'}), 404
+
     # Check if thumbnail exists
-    if not os.path.exists(os.path.join(THUMBNAILS_FOLDER, thumb_filename)):
-        # Try to generate it on demand
-        if os.path.exists(os.path.join(PICTURES_FOLDER, filename)):
-            generate_thumbnail(
-                os.path.join(PICTURES_FOLDER, filename),
-                os.path.join(THUMBNAILS_FOLDER, thumb_filename)
-            )
-            
-    return send_from_directory(THUMBNAILS_FOLDER, thumb_filename)
+    if not os.path.exists(thumb_path):
+        # Jump the queue (or join an already queued job) and wait a bounded time
+        queue_thumbnails(filename, PRIORITY_ON_DEMAND).wait(THUMBNAIL_WAIT_SECONDS)
+        if not os.path.exists(thumb_path):
+            response = make_response(send_from_directory('static', 'thumbnail-placeholder.svg'))
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+
+    THUMBNAIL_CACHE.touch(thumb_path)
+    return send_from_directory(THUMBNAILS_FOLDER, os.path.basename(thumb_path))
 
 @app.route('/api/documents')
 def get_documents():
     """Return JSON array of document files"""
-    with FILE_CHANGE_LOCK:
-        if not DOCUMENTS_CACHE:
-            load_document_metadata()
-        return jsonify(DOCUMENTS_CACHE)
+    return snapshot_response(ensure_library_loaded('documents'))
 
 @app.route('/api/documents/<filename>')
 def get_document(filename):
@@ -812,53 +2786,91 @@ def get_document(filename):
     as_attachment = ext != '.md'
     return send_from_directory(DOCUMENTS_FOLDER, filename, as_attachment=as_attachment)
 
+@app.route('/api/documents/<filename>/html')
+def get_document_html(filename):
+    """Rendered HTML fragment of a markdown document.
+
+    Without ?page the whole fragment is returned as text/html. ?page=N returns JSON
+    with page N of the document split at headings, so long documents can be shown
+    progressively.
+    """
+    if not is_markdown(filename):
+        return jsonify({'error': 'Only markdown files can be rendered'}), 400
+    try:
+        rendered, job = rendered_document(filename)
+    except (OSError, ValueError):
+        return jsonify({'error': 'File not found'}), 404
+    if rendered is None:
+        if not job.wait(HTML_WAIT_SECONDS):
+            response = jsonify({'error': 'Document is still rendering, try again shortly', 'job': job.to_dict()})
+            response.status_code = 503
+            response.headers['Retry-After'] = '2'
+            return response
+        if job.status == 'failed':
+            # The document exists but can't be rendered; that's not a 404
+            print(f"HTML render error for {filename}: {job.error}")
+            return jsonify({'error': f'Could not render document: {job.error}'}), 500
+        rendered = job.result
+
+    page = request.args.get('page')
+    if page is not None:
+        try:
+            page = int(page)
+        except ValueError:
+            return jsonify({'error': 'page must be an integer'}), 400
+        if not 0 <= page < len(rendered.pages):
+            return jsonify({'error': 'Page out of range', 'pages': len(rendered.pages)}), 404
+
+    etag = f"doc-{rendered.etag}-{'all' if page is None else page}"
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    elif page is None:
+        response = make_response(rendered.html)
+        response.headers['Content-Type'] = 'text/html; charset=utf-8'
+    else:
+        response = jsonify({
+            'filename': filename,
+            'page': page,
+            'pages': len(rendered.pages),
+            'next_page': page + 1 if page + 1 < len(rendered.pages) else None,
+            'html': rendered.pages[page]
+        })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/api/documents/<filename>/pdf')
 def get_document_pdf(filename):
-    """Convert markdown document to PDF and return it"""
-    from xhtml2pdf import pisa
-    from urllib.parse import quote
+    """Return a markdown document as PDF, rendered once per document version and cached"""
     filepath = os.path.join(DOCUMENTS_FOLDER, filename)
     if not os.path.exists(filepath):
         return jsonify({'error': 'File not found'}), 404
-    ext = os.path.splitext(filename)[1].lower()
-    if ext != '.md':
+    if not is_markdown(filename):
         return jsonify({'error': 'Only markdown files can be converted to PDF'}), 400
+
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            content = f.read()
-        body_html = markdown_lib.markdown(content, extensions=['tables', 'fenced_code'])
-        title = os.path.splitext(filename)[0]
-        full_html = f"""<!DOCTYPE html>
-<html><head><meta charset="utf-8"><title>{title}</title>
-<style>
-  body{{font-family:Helvetica;font-size:11pt;line-height:1.5;color:#000}}
-  h1{{font-size:18pt;font-weight:bold;margin:8pt 0 4pt}}
-  h2{{font-size:15pt;font-weight:bold;margin:8pt 0 4pt}}
-  h3{{font-size:13pt;font-weight:bold;margin:6pt 0 3pt}}
-  h4,h5,h6{{font-weight:bold;margin:5pt 0 3pt}}
-  p{{margin:4pt 0}}
-  ul,ol{{margin:4pt 0 6pt;padding-left:18pt}}
-  li{{margin:2pt 0}}
-  code{{font-size:9pt}}
-  pre{{background:#f0f0f0;padding:8pt;margin:6pt 0;font-size:9pt}}
-  blockquote{{margin:6pt 0;padding-left:10pt;border-left:3pt solid #667eea;color:#555}}
-  table{{width:100%;border-collapse:collapse;margin:6pt 0}}
-  th,td{{border:0.5pt solid #ccc;padding:4pt 6pt;text-align:left}}
-  th{{background:#f0f0f0;font-weight:bold}}
-  hr{{border-top:0.5pt solid #ccc;margin:8pt 0}}
-</style></head>
-<body>{body_html}</body></html>"""
-        buf = io.BytesIO()
-        pisa.CreatePDF(full_html.encode('utf-8'), dest=buf, encoding='utf-8')
-        pdf_bytes = buf.getvalue()
-        pdf_name = os.path.splitext(filename)[0] + '.pdf'
-        response = make_response(pdf_bytes)
-        response.headers['Content-Type'] = 'application/pdf'
-        response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(pdf_name)}"
-        return response
-    except Exception as e:
-        print(f"PDF generation error: {e}")
-        return jsonify({'error': str(e)}), 500
+        pdf_path = rendered_document_path(filename, os.stat(filepath), 'pdf', PDF_STYLESHEET_VERSION)
+    except OSError:
+        return jsonify({'error': 'File not found'}), 404
+    if not os.path.exists(pdf_path):
+        # Concurrent requests for the same document wait on one shared render job
+        job = queue_pdf(filename, PRIORITY_ON_DEMAND)
+        if not job.wait(PDF_WAIT_SECONDS):
+            response = jsonify({'error': 'PDF is still rendering, try again shortly', 'job': job.to_dict()})
+            response.status_code = 503
+            response.headers['Retry-After'] = '5'
+            return response
+        if job.status == 'failed':
+            print(f"PDF generation error: {job.error}")
+            return jsonify({'error': job.error}), 500
+        pdf_path = job.result
+
+    pdf_name = os.path.splitext(filename)[0] + '.pdf'
+    # Conditional GETs (If-None-Match / If-Modified-Since) are answered with 304 by send_file
+    response = send_file(pdf_path, mimetype='application/pdf', as_attachment=True,
+                         download_name=pdf_name, conditional=True, etag=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/api/config/folders')
 def get_folders_config():
@@ -879,9 +2891,10 @@ def refresh_metadata():
         load_document_metadata()
     return jsonify({
         'status': 'success', 
-        'music_count': len(METADATA_CACHE),
-        'pictures_count': len(PICTURES_CACHE),
-        'documents_count': len(DOCUMENTS_CACHE)
+        'music_count': len(LIBRARIES['music']),
+        'pictures_count': len(LIBRARIES['pictures']),
+        'documents_count': len(LIBRARIES['documents']),
+        'scan_stats': SCAN_STATS
     })
 
 @app.route('/api/health')
@@ -889,10 +2902,19 @@ def health_check():
     """Health check endpoint"""
     return jsonify({
         'status': 'healthy',
-        'files_count': len(METADATA_CACHE),
+        'files_count': len(LIBRARIES['music']),
         'music_folder': MUSIC_FOLDER,
-        'mdns_enabled': (ZEROCONF_INSTANCE is not None) or (AVAHI_PROCESS is not None),
-        'service_name': REGISTERED_SERVICE_NAME if (ZEROCONF_INSTANCE or AVAHI_PROCESS) else None
+        'scan_stats': SCAN_STATS,
+        'thumbnail_cache': THUMBNAIL_CACHE.stats(),
+        'internet_available': INTERNET_AVAILABLE,
+        'connectivity': CONNECTIVITY_PROBER.status(),
+        'mdns_enabled': MDNS_ADVERTISER.registered(),
+        'service_name': REGISTERED_SERVICE_NAME if MDNS_ADVERTISER.registered() else None,
+        'mdns': MDNS_ADVERTISER.status(),
+        'libraries': {
+            kind: {'loading': snapshot.loading, 'count': len(snapshot)}
+            for kind, snapshot in LIBRARIES.items()
+        }
     })
 
 @app.route('/api/config')
@@ -930,9 +2952,9 @@ def delete_track(filename):
         # Delete the file
         os.remove(filepath)
 
-        # Reload metadata
+        # Drop just this track from the library
         with FILE_CHANGE_LOCK:
-            load_metadata()
+            apply_library_change('music', filepath)
 
         return jsonify({
             'status': 'success',
@@ -1016,11 +3038,9 @@ def catch_all(path):
     if path.startswith('static/'):
         return send_from_directory('static', path[7:])
         
-    # Check connectivity
-    check_internet_connection()
-    
+    # Check connectivity (cached by the background prober)
     # If offline (hotspot mode), redirect everything to wifi setup
-    if not INTERNET_AVAILABLE:
+    if not internet_available():
         from flask import redirect
         return redirect('/setup-wifi')
         
@@ -1028,20 +3048,37 @@ def catch_all(path):
 
 @app.route('/api/wifi/networks')
 def wifi_networks():
-    """Get list of available WiFi networks"""
+    """Latest WiFi scan results, immediately; a background rescan starts if they are stale (or ?refresh=1).
+
+    While a scan runs, `scanning` is true and `job_id` can be long-polled at
+    /api/wifi/networks/scans/<job_id>.
+    """
+    result = WIFI_SCAN_LATEST['result']
+    scanned_at = WIFI_SCAN_LATEST['scanned_at']
+    stale = scanned_at is None or time.time() - scanned_at > WIFI_SCAN_MAX_AGE
+    job = WIFI_SCAN_QUEUE.active(('wifi-scan',))
+    if job is None and (stale or request.args.get('refresh') == '1'):
+        job = queue_wifi_scan()
+
+    payload = wifi_scan_payload(job)
+    # A failed last scan is only an error if no rescan is under way to replace it
+    return jsonify(payload), 200 if result is None or payload['scanning'] or payload['success'] else 500
+
+@app.route('/api/wifi/networks/scans/<job_id>')
+def wifi_scan_wait(job_id):
+    """Long-poll a WiFi scan job: returns once it finishes, or after ?timeout= seconds (max 30)"""
+    job = WIFI_SCAN_QUEUE.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Unknown or expired scan job'}), 404
     try:
-        result = scan_wifi_networks()
-        if result['success']:
-            return jsonify(result), 200
-        else:
-            return jsonify(result), 500
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({
-            'success': False,
-            'error': f'Error scanning networks: {str(e)}'
-        }), 500
+        timeout = float(request.args.get('timeout', 20))
+        if math.isnan(timeout):
+            raise ValueError('nan')
+    except ValueError:
+        return jsonify({'success': False, 'error': 'timeout must be a number of seconds'}), 400
+    job.wait(min(max(timeout, 0), 30))
+    payload = wifi_scan_payload(job)
+    return jsonify(payload), 200 if payload['scanning'] or payload['success'] else 500
 
 @app.route('/api/wifi/configure', methods=['POST'])
 def wifi_configure():
@@ -1077,6 +3114,8 @@ def wifi_configure():
             }), 400
 
         result = configure_wifi(ssid, password)
+        CONNECTIVITY_PROBER.trigger()
+        WIFI_STATUS_POLLER.trigger()
         if result['success']:
             return jsonify(result), 200
         else:
@@ -1152,137 +3191,201 @@ def wifi_reboot():
 
 def get_local_ip():
     """Get the local IP address of the machine, robust to offline networks"""
-    # 1. Try connecting to an external server (most reliable if internet available)
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.settimeout(0.1)
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
-    except Exception:
-        pass
-
-    # 2. Prefer an IP from active interfaces (works in hotspot mode too)
+    # 1. Prefer an IP from active interfaces, served from NETWORK_MONITOR's cache
+    #    (works in hotspot mode too)
     ips = get_local_ipv4_addresses()
     if ips:
         return ips[0]
 
-    # 3. Try getting IP from hostname -I (linux)
-    try:
-        import subprocess
-        result = subprocess.run(['hostname', '-I'], capture_output=True, text=True, timeout=1)
-        if result.returncode == 0:
-            ips = result.stdout.strip().split()
-            for ip in ips:
-                # Return first non-loopback IPv4
-                if '.' in ip and not ip.startswith('127.'):
-                    return ip
-    except Exception:
-        pass
-
-    # 4. Try parsing ip addr show
+    # 2. Nothing cached: the source address of the default route (a UDP connect sends no packets)
     try:
-        import subprocess
-        # Try standard paths
-        cmds = [['ip', '-4', 'addr', 'show'], ['/sbin/ip', '-4', 'addr', 'show']]
-        
-        for cmd in cmds:
-            try:
-                result = subprocess.run(cmd, capture_output=True, text=True, timeout=1)
-                if result.returncode == 0:
-                    output = result.stdout
-                    # Simple parsing for inet
-                    import re
-                    # Look for wlan0 first
-                    wlan_match = re.search(r'wlan0.*?inet\s+(\d+\.\d+\.\d+\.\d+)', output, re.DOTALL)
-                    if wlan_match:
-                        return wlan_match.group(1)
-                    
-                    # Look for any inet
-                    matches = re.findall(r'inet\s+(\d+\.\d+\.\d+\.\d+)', output)
-                    for ip in matches:
-                        if not ip.startswith('127.'):
-                            return ip
-            except FileNotFoundError:
-                continue
-    except Exception:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
+    except OSError:
         pass
 
-    # 5. Fallback to socket.gethostbyname (might return 127.0.1.1 on Debian)
+    # 3. Fallback to socket.gethostbyname (might return 127.0.1.1 on Debian)
     try:
         return socket.gethostbyname(socket.gethostname())
     except Exception:
         return "127.0.0.1"
 
 
-def get_local_ipv4_addresses() -> List[str]:
-    """Return likely-reachable non-loopback IPv4s, in preferred order.
-
-    Hotspot setups sometimes use `ap0`/`uap0` instead of `wlan0`; publishing only a single
-    "best guess" IP can break mDNS if the wrong interface is picked.
-    """
-    try:
-        import subprocess
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+IFF_UP = 0x1
+# rtnetlink multicast groups: link up/down and IPv4 address changes
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
 
-        preferred_interfaces = ("wlan0", "uap0", "ap0", "wlan1", "eth0")
-        cmds = [
-            ["ip", "-4", "-o", "addr", "show"],
-            ["/sbin/ip", "-4", "-o", "addr", "show"],
-        ]
+def list_ipv4_interfaces() -> List[Tuple[str, str]]:
+    """(interface, IPv4) pairs for interfaces that are up, read with ioctls (Linux only)"""
+    import fcntl
+    import struct
 
-        output = None
-        for cmd in cmds:
+    pairs = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        for _, name in socket.if_nameindex():
+            request = struct.pack('256s', name.encode('utf-8')[:15])
             try:
-                result = subprocess.run(cmd, capture_output=True, text=True, timeout=1)
-                if result.returncode == 0:
-                    output = result.stdout
-                    break
-            except FileNotFoundError:
-                continue
+                flags = struct.unpack_from('H', fcntl.ioctl(s.fileno(), SIOCGIFFLAGS, request), 16)[0]
+                if not flags & IFF_UP:
+                    continue
+                # struct ifreq: 16-byte name, then a sockaddr_in whose address starts at byte 20
+                address = fcntl.ioctl(s.fileno(), SIOCGIFADDR, request)[20:24]
+            except OSError:
+                continue  # No IPv4 address on this interface
+            pairs.append((name, socket.inet_ntoa(address)))
+    return pairs
+
+class NetworkMonitor:
+    """Cached interface addresses, invalidated by kernel address/link change events.
+
+    A daemon thread listens on an rtnetlink socket; when addresses change it
+    refreshes the cache once the burst of events settles and calls every listener
+    with the new (interface, IPv4) list. Where netlink isn't available, or while
+    the listener is down, the cache simply expires after FALLBACK_TTL seconds.
+    """
 
-        if not output:
+    FALLBACK_TTL = 30
+    SETTLE_SECONDS = 1.0
+    RESUBSCRIBE_DELAY = 5  # Pause before reopening the netlink socket after an error
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pairs = None
+        self._loaded = 0.0
+        self._listeners = []
+        self._thread = None
+        self.watching = False
+        self.changes = 0
+
+    def interfaces(self) -> List[Tuple[str, str]]:
+        self.start()
+        with self._lock:
+            expired = not self.watching and time.monotonic() - self._loaded > self.FALLBACK_TTL
+            if self._pairs is None or expired:
+                self._pairs = self._read()
+                self._loaded = time.monotonic()
+            return list(self._pairs)
+
+    def add_listener(self, callback):
+        """Call callback(pairs) from the monitor thread whenever addresses change"""
+        self._listeners.append(callback)
+
+    def _read(self):
+        try:
+            return list_ipv4_interfaces()
+        except (ImportError, OSError, AttributeError) as e:
+            print(f"Could not list network interfaces: {e}")
             return []
 
-        import re
+    def start(self):
+        """Start listening for change events (idempotent)"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, name='network-monitor', daemon=True)
+                self._thread.start()
 
-        candidates: List[Tuple[str, str]] = []
-        for line in output.splitlines():
-            # Example: "2: wlan0    inet 192.168.10.1/24 brd 192.168.10.255 scope global wlan0"
-            match = re.search(r"^\d+:\s+(\S+)\s+inet\s+(\d+\.\d+\.\d+\.\d+)/", line)
-            if not match:
-                continue
-            interface, ip = match.group(1), match.group(2)
-            if ip.startswith("127.") or ip.startswith("169.254."):
-                continue
-            candidates.append((interface, ip))
+    def _watch(self):
+        try:
+            resubscribed = False
+            while True:
+                try:
+                    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+                except (AttributeError, OSError) as e:
+                    print(f"Network change events unavailable ({e}); re-reading interfaces every {self.FALLBACK_TTL}s")
+                    return
+                with sock:
+                    try:
+                        sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+                    except OSError as e:
+                        print(f"Network change events unavailable ({e}); re-reading interfaces every {self.FALLBACK_TTL}s")
+                        return
+                    self.watching = True
+                    if resubscribed:
+                        # Changes may have been missed while the socket was down
+                        self._refresh()
+                    self._listen(sock)
+                # The socket failed; poll on FALLBACK_TTL until it is reopened
+                self.watching = False
+                resubscribed = True
+                time.sleep(self.RESUBSCRIBE_DELAY)
+        finally:
+            self.watching = False
 
-        if not candidates:
-            return []
+    def _listen(self, sock):
+        """Refresh on each settled burst of change events; returns if the socket fails"""
+        while True:
+            try:
+                sock.settimeout(None)
+                sock.recv(65536)
+                # Addresses usually change in bursts (link up, DHCP, hotspot switch): let them settle
+                sock.settimeout(self.SETTLE_SECONDS)
+                while True:
+                    sock.recv(65536)
+            except socket.timeout:
+                pass
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    print(f"Network change socket failed ({e}); resubscribing")
+                    return
+                # The kernel dropped events on a busy socket; re-read to catch up
+            self._refresh()
+
+    def _refresh(self):
+        pairs = self._read()
+        with self._lock:
+            changed = pairs != self._pairs
+            self._pairs = pairs
+            self._loaded = time.monotonic()
+        if not changed:
+            return
+        self.changes += 1
+        print(f"Network addresses changed: {', '.join(f'{name}={ip}' for name, ip in pairs) or 'none'}")
+        for callback in list(self._listeners):
+            try:
+                callback(pairs)
+            except Exception as e:
+                print(f"Network change listener failed: {e}")
 
-        # De-duplicate while keeping the most preferred interface first.
-        seen: Set[str] = set()
-        ordered: List[str] = []
+NETWORK_MONITOR = NetworkMonitor()
 
-        for preferred in preferred_interfaces:
-            for interface, ip in candidates:
-                if interface != preferred or ip in seen:
-                    continue
-                ordered.append(ip)
-                seen.add(ip)
+def get_local_ipv4_addresses() -> List[str]:
+    """Return likely-reachable non-loopback IPv4s, in preferred order.
+
+    Hotspot setups sometimes use `ap0`/`uap0` instead of `wlan0`; publishing only a single
+    "best guess" IP can break mDNS if the wrong interface is picked.
+    """
+    preferred_interfaces = ("wlan0", "uap0", "ap0", "wlan1", "eth0")
+
+    candidates = [
+        (interface, ip) for interface, ip in NETWORK_MONITOR.interfaces()
+        if not ip.startswith("127.") and not ip.startswith("169.254.")
+    ]
+
+    # De-duplicate while keeping the most preferred interface first.
+    seen: Set[str] = set()
+    ordered: List[str] = []
 
-        for _, ip in candidates:
-            if ip in seen:
+    for preferred in preferred_interfaces:
+        for interface, ip in candidates:
+            if interface != preferred or ip in seen:
                 continue
             ordered.append(ip)
             seen.add(ip)
 
-        return ordered
-    except Exception:
-        return []
+    for _, ip in candidates:
+        if ip in seen:
+            continue
+        ordered.append(ip)
+        seen.add(ip)
+
+    return ordered
 
 def check_internet_connection():
-    """Check if internet connection is available"""
+    """Check if internet connection is available (blocking; request handlers read INTERNET_AVAILABLE)"""
     global INTERNET_AVAILABLE
     try:
         # Try to connect to a reliable external server
@@ -1297,23 +3400,27 @@ def check_internet_connection():
         INTERNET_AVAILABLE = False
         return False
 
+# Keeps INTERNET_AVAILABLE current in the background so page loads and captive-portal
+# probes never wait on the check themselves
+CONNECTIVITY_PROBER = PeriodicRefresher('connectivity-prober', check_internet_connection, CONNECTIVITY_CHECK_INTERVAL)
+# Re-check as soon as interface addresses change (Wi-Fi joined, hotspot started, ...)
+NETWORK_MONITOR.add_listener(lambda pairs: CONNECTIVITY_PROBER.trigger())
+
+def internet_available():
+    """Cached internet state; only a call before the first probe ever finished waits for one"""
+    if CONNECTIVITY_PROBER.updated is None:
+        CONNECTIVITY_PROBER.wait_for_refresh(3)
+    return INTERNET_AVAILABLE
+
 def scan_wifi_networks():
-    """Scan for available WiFi networks using iwlist"""
+    """Scan for available WiFi networks using iwlist (blocking; run it through queue_wifi_scan)"""
     try:
         import subprocess
-        print("Scanning for WiFi networks...")
-
-        # Check if wlan0 exists first
-        interface_check = subprocess.run(
-            ['ip', 'link', 'show', 'wlan0'],
-            capture_output=True,
-            text=True,
-            timeout=3
-        )
+        started = time.time()
 
-        if interface_check.returncode != 0:
-            print("WARNING: wlan0 not found (Pi likely in hotspot mode)")
-            print("WiFi scan skipped - interface not available")
+        # Check if the WiFi interface exists first
+        if WIFI_INTERFACE not in {name for _, name in socket.if_nameindex()}:
+            print(f"WiFi scan skipped: {WIFI_INTERFACE} not found (Pi likely in hotspot mode)")
             return {
                 'success': False,
                 'error': 'WiFi adapter not available (Pi in hotspot mode)',
@@ -1321,16 +3428,14 @@ def scan_wifi_networks():
             }
 
         result = subprocess.run(
-            ['sudo', 'iwlist', 'wlan0', 'scan'],
+            ['sudo', 'iwlist', WIFI_INTERFACE, 'scan'],
             capture_output=True,
             text=True,
             timeout=10
         )
 
-        print(f"iwlist exit code: {result.returncode}")
-
         if result.returncode != 0:
-            print(f"iwlist error: {result.stderr}")
+            print(f"iwlist error (exit code {result.returncode}): {result.stderr}")
             return {
                 'success': False,
                 'error': f'iwlist command failed: {result.stderr}'
@@ -1338,37 +3443,22 @@ def scan_wifi_networks():
 
         networks = []
         current_network = {}
-        lines = result.stdout.split('\n')
 
-        print(f"Total lines in scan output: {len(lines)}")
-
-        for line in lines:
+        for line in result.stdout.split('\n'):
             line = line.strip()
 
             if 'ESSID:' in line:
                 essid = line.split('ESSID:')[1].strip('"')
-                print(f"Found ESSID: '{essid}'")
 
                 # Save previous network if exists
                 if current_network and 'ssid' in current_network:
-                    print(f"  Saving network: {current_network['ssid']}")
                     networks.append(current_network)
 
                 # Start new network
                 if essid and essid != 'off/any':
-                    # Visible network
-                    print(f"  Adding visible network: {essid}")
                     current_network = {'ssid': essid}
-                elif essid == 'off/any':
-                    # Hidden network - create placeholder
-                    print("  Adding hidden network placeholder")
-                    current_network = {
-                        'ssid': 'Hidden Network',
-                        'hidden': True
-                    }
                 else:
-                    # Empty ESSID - treat as hidden
-                    print("  Adding empty ESSID as hidden")
+                    # Hidden network (off/any or empty ESSID) - create placeholder
                     current_network = {
                         'ssid': 'Hidden Network',
                         'hidden': True
@@ -1378,16 +3468,13 @@ def scan_wifi_networks():
                 if current_network:  # Ensure we have a network to update
                     encryption = line.split('Encryption key:')[1].strip()
                     current_network['encryption'] = 'off' if encryption == 'off' else 'on'
-                    print(f"  Network {current_network.get('ssid', '?')} encryption: {current_network['encryption']}")
 
             elif 'IE: IEEE 802.11i/WPA2' in line:
                 if current_network:
                     current_network['security'] = 'WPA2'
-                    print(f"  Network {current_network.get('ssid', '?')} security: WPA2")
             elif 'IE: WPA Version' in line:
                 if current_network:
                     current_network['security'] = 'WPA'
-                    print(f"  Network {current_network.get('ssid', '?')} security: WPA")
 
             elif 'Quality=' in line:
                 if current_network:
@@ -1397,16 +3484,17 @@ def scan_wifi_networks():
 
         # Add the last network
         if current_network and 'ssid' in current_network:
-            print(f"Adding final network: {current_network['ssid']}")
             networks.append(current_network)
 
-        print(f"Total networks found: {len(networks)}")
-        for net in networks:
-            print(f"  - {net['ssid']}")
-
-        # Sort by signal strength if available
-        networks.sort(key=lambda x: x.get('signal', '0'), reverse=True)
+        # Sort by signal strength (quality numerator, e.g. "52/70") if available
+        def signal_quality(network):
+            try:
+                return int(network.get('signal', '0').split('/')[0])
+            except ValueError:
+                return 0
+        networks.sort(key=signal_quality, reverse=True)
 
+        print(f"WiFi scan found {len(networks)} networks in {time.time() - started:.1f}s")
         return {
             'success': True,
             'networks': networks
@@ -1433,25 +3521,28 @@ def scan_wifi_networks():
             'error': f'Error scanning WiFi: {str(e)}'
         }
 
-def restart_mdns_service():
-    """Restart mDNS service to update IP address"""
-    print("Restarting mDNS service...")
-    unregister_mdns_service()
-    
-    # Wait for IP address update
-    import time
-    max_retries = 10
-    for i in range(max_retries):
-        # Check if we have a valid non-loopback IP
-        ip = get_local_ip()
-        if ip and not ip.startswith("127."):
-            print(f"✓ Network connection established (IP: {ip})")
-            break
-            
-        print(f"Waiting for network connection... ({i+1}/{max_retries})")
-        time.sleep(1)
-        
-    return register_mdns_service()
+# WiFi scans run one at a time in the background; concurrent refreshes share the pending job
+WIFI_SCAN_QUEUE = BackgroundJobQueue('wifi-scan')
+WIFI_SCAN_LATEST = {'result': None, 'scanned_at': None}
+
+def _run_wifi_scan():
+    result = scan_wifi_networks()
+    WIFI_SCAN_LATEST.update(result=result, scanned_at=time.time())
+    return result
+
+def queue_wifi_scan():
+    """Start a WiFi scan, or join the one already pending/running; returns the job"""
+    return WIFI_SCAN_QUEUE.submit(('wifi-scan',), _run_wifi_scan, priority=PRIORITY_ON_DEMAND)
+
+def wifi_scan_payload(job=None):
+    """Latest scan results with their timestamp, plus the state of a refresh job if any"""
+    payload = dict(WIFI_SCAN_LATEST['result'] or {'success': True, 'networks': []})
+    scanned_at = WIFI_SCAN_LATEST['scanned_at']
+    payload['scanned_at'] = datetime.fromtimestamp(scanned_at).isoformat() if scanned_at else None
+    payload['age_seconds'] = round(time.time() - scanned_at, 1) if scanned_at else None
+    payload['scanning'] = job is not None and job.status in ('pending', 'running')
+    payload['job_id'] = job.id if job is not None else None
+    return payload
 
 def configure_wifi(ssid, password):
     """Configure WiFi by writing to wpa_supplicant.conf"""
@@ -1554,13 +3645,13 @@ network={{
                 print("WiFi interface status:")
                 print(status_result.stdout[:200] + "..." if len(status_result.stdout) > 200 else status_result.stdout)
 
-                # Update mDNS service with new IP
-                if ZEROCONF_AVAILABLE:
-                    restart_mdns_service()
+                # Re-announce mDNS records with the new IP (the network monitor also
+                # catches it if DHCP finishes later)
+                MDNS_ADVERTISER.addresses_changed()
 
                 return {
                     'success': True,
-                    'message': f'WiFi connected! mDNS service updated. You can now access the server at http://cubie.local:{SERVICE_PORT}',
+                    'message': f'WiFi connected! mDNS service is being updated. You can now access the server at http://cubie.local:{SERVICE_PORT}',
                     'reboot_required': False
                 }
         else:
@@ -1594,133 +3685,117 @@ network={{
             'error': f'Error configuring WiFi: {str(e)}'
         }
 
-def get_wifi_status():
-    """Get current WiFi connection status using iwconfig or iw"""
-    import subprocess
-
-    # Helper to run command
-    def run_cmd(cmd_list):
+SIOCGIWESSID = 0x8B1B
+IW_ESSID_MAX_SIZE = 32
+
+def read_essid(interface):
+    """SSID the interface is associated with (or serving, in AP mode), via the wireless-extensions ioctl"""
+    import array
+    import fcntl
+    import struct
+
+    buf = array.array('B', bytes(IW_ESSID_MAX_SIZE + 1))
+    # struct iwreq: 16-byte name, then struct iw_point {void *pointer; __u16 length; __u16 flags}
+    request = struct.pack('16sPHH', interface.encode('utf-8')[:15], buf.buffer_info()[0], len(buf), 0).ljust(32, b'\0')
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        result = fcntl.ioctl(s.fileno(), SIOCGIWESSID, request)
+    length = struct.unpack_from('H', result, 16 + struct.calcsize('P'))[0]
+    return buf[:min(length, IW_ESSID_MAX_SIZE)].tobytes().rstrip(b'\0').decode('utf-8', errors='replace')
+
+def read_wireless_signal(interface):
+    """(link quality, signal level in dBm) from /proc/net/wireless, or None if the interface isn't listed"""
+    with open('/proc/net/wireless') as f:
+        for line in f.readlines()[2:]:
+            fields = line.split()
+            if fields and fields[0].rstrip(':') == interface:
+                return float(fields[2]), float(fields[3])
+    return None
+
+def _wifi_status_from_commands(interface):
+    """Fallback for drivers without wireless-extensions: parse `iw dev <if> link`, then `iwconfig <if>`"""
+    import shutil
+
+    search_path = os.pathsep.join([os.environ.get('PATH', ''), '/usr/sbin', '/sbin'])
+
+    iw = shutil.which('iw', path=search_path)
+    if iw:
         try:
-            return subprocess.run(
-                cmd_list,
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
-        except FileNotFoundError:
-            return None
-        except Exception as e:
-            print(f"Error running {cmd_list[0]}: {e}")
-            return None
-
-    # 1. Try iwconfig (legacy but common)
-    # Check common paths if not in PATH
-    # Added sudo versions as fallback
-    iwconfig_cmds = [
-        ['iwconfig', 'wlan0'], 
-        ['/sbin/iwconfig', 'wlan0'], 
-        ['/usr/sbin/iwconfig', 'wlan0'],
-        ['sudo', 'iwconfig', 'wlan0'],
-        ['sudo', '/sbin/iwconfig', 'wlan0']
-    ]
-    
-    for cmd in iwconfig_cmds:
-        result = run_cmd(cmd)
-        if result and result.returncode == 0:
-            output = result.stdout
-            if 'ESSID:' in output:
-                try:
-                    essid = output.split('ESSID:')[1].split('\n')[0].strip().strip('"')
-                    
-                    signal = "N/A"
-                    if 'Signal level=' in output:
-                        signal_part = output.split('Signal level=')[1].split()[0]
-                        # Sometimes it is quality=xx/xx, sometimes level=-xx dBm
-                        if 'dBm' in output or (signal_part.lstrip('-').isdigit() and int(signal_part) < 0): # Check if it's a negative number
-                             signal = f"{signal_part} dBm"
-                        else:
-                             # quality is xx/xx
-                             try:
-                                 quality_val = int(signal_part.split('/')[0])
-                                 if quality_val >= 70: signal = "Excellent"
-                                 elif quality_val >= 40: signal = "Good"
-                                 else: signal = "Fair"
-                             except ValueError:
-                                 signal = f"Quality: {signal_part}"
-                                 
-                    if essid and essid != 'off/any':
-                        return {
-                            'connected': True,
-                            'ssid': essid,
-                            'signal': signal,
-                            'interface': 'wlan0'
-                        }
-                except Exception as e:
-                    print(f"Error parsing iwconfig: {e}")
-            
-            # If we ran successfully but didn't return, it might be disconnected or parsing failed
-            if 'ESSID:off/any' in output or 'ESSID:""' in output:
-                 return {'connected': False, 'interface': 'wlan0'}
-
-    # 2. Try iw (modern replacement)
-    # iw dev wlan0 link
-    # Added sudo versions as fallback
-    iw_cmds = [
-        ['iw', 'dev', 'wlan0', 'link'], 
-        ['/usr/sbin/iw', 'dev', 'wlan0', 'link'], 
-        ['/sbin/iw', 'dev', 'wlan0', 'link'],
-        ['sudo', 'iw', 'dev', 'wlan0', 'link'],
-        ['sudo', '/usr/sbin/iw', 'dev', 'wlan0', 'link']
-    ]
-    
-    for cmd in iw_cmds:
-        result = run_cmd(cmd)
-        if result:
-            if result.returncode == 0:
-                output = result.stdout
-                if 'Not connected' in output:
-                    return {'connected': False, 'interface': 'wlan0'}
-                
-                try:
-                    # Parse iw output
-                    ssid = "Unknown"
-                    signal = "N/A"
-                    
-                    for line in output.split('\n'):
-                        line = line.strip()
-                        if line.startswith('SSID:'):
-                            ssid = line.split('SSID:')[1].strip().strip('"')
-                        elif line.startswith('signal:'):
-                            signal = line.split('signal:')[1].strip()
-                    
-                    if ssid != "Unknown":
-                        return {
-                            'connected': True,
-                            'ssid': ssid,
-                            'signal': signal,
-                            'interface': 'wlan0'
-                        }
-                except Exception as e:
-                    print(f"Error parsing iw: {e}")
-            else:
-                # iw failed (maybe interface down?)
-                pass
+            output = subprocess.run([iw, 'dev', interface, 'link'], capture_output=True, text=True, timeout=5).stdout
+        except (OSError, subprocess.TimeoutExpired):
+            output = ''
+        if 'Not connected' in output:
+            return {'connected': False, 'interface': interface}
+        ssid = signal = None
+        for line in output.split('\n'):
+            line = line.strip()
+            if line.startswith('SSID:'):
+                ssid = line.split('SSID:')[1].strip().strip('"')
+            elif line.startswith('signal:'):
+                signal = line.split('signal:')[1].strip()
+        if ssid:
+            return {'connected': True, 'ssid': ssid, 'signal': signal or 'N/A', 'interface': interface}
+
+    iwconfig = shutil.which('iwconfig', path=search_path)
+    if iwconfig:
+        try:
+            output = subprocess.run([iwconfig, interface], capture_output=True, text=True, timeout=5).stdout
+        except (OSError, subprocess.TimeoutExpired):
+            output = ''
+        if 'ESSID:' in output:
+            essid = output.split('ESSID:')[1].split('\n')[0].strip().strip('"')
+            if essid and essid != 'off/any':
+                signal = 'N/A'
+                if 'Signal level=' in output:
+                    signal = output.split('Signal level=')[1].split()[0]
+                    signal = f"{signal} dBm" if signal.lstrip('-').isdigit() else f"Quality: {signal}"
+                return {'connected': True, 'ssid': essid, 'signal': signal, 'interface': interface}
+            return {'connected': False, 'interface': interface}
 
     return {
         'connected': False,
         'error': 'Could not determine WiFi status (iwconfig/iw missing or failed)'
     }
 
-def register_mdns_service():
-    """Register mDNS service for network discovery with Android compatibility"""
-    global ZEROCONF_INSTANCE, ZEROCONF_INSTANCES, REGISTERED_SERVICE_NAME, AVAHI_PROCESS
+def read_wifi_status(interface=None):
+    """Current WiFi link state: SSID via ioctl and signal from /proc/net/wireless, without forking"""
+    interface = interface or WIFI_INTERFACE
+    if interface not in {name for _, name in socket.if_nameindex()}:
+        return {'connected': False, 'interface': interface, 'error': f'No {interface} interface'}
+    try:
+        ssid = read_essid(interface)
+    except (ImportError, OSError):
+        # No such interface, or a driver without wireless-extensions support
+        return _wifi_status_from_commands(interface)
 
-    if not ZEROCONF_AVAILABLE:
-        print("mDNS not available (zeroconf not installed)")
-        print("Install with: pip install zeroconf")
-        return None
+    if not ssid:
+        return {'connected': False, 'interface': interface}
 
-    # Check and ensure avahi-daemon is running
+    signal = 'N/A'
+    try:
+        reading = read_wireless_signal(interface)
+    except (OSError, ValueError, IndexError):
+        reading = None
+    if reading is not None:
+        signal = f"{int(reading[1])} dBm"
+    return {'connected': True, 'ssid': ssid, 'signal': signal, 'interface': interface}
+
+# One poller serves every /api/wifi/status caller from memory
+WIFI_STATUS_POLLER = PeriodicRefresher('wifi-status', read_wifi_status, WIFI_STATUS_INTERVAL)
+NETWORK_MONITOR.add_listener(lambda pairs: WIFI_STATUS_POLLER.trigger())
+NETWORK_MONITOR.add_listener(lambda pairs: TAILSCALE_STATUS.trigger())
+
+def get_wifi_status():
+    """Cached WiFi status plus its age; a pending: true placeholder until the first poll finishes"""
+    WIFI_STATUS_POLLER.start()
+    if WIFI_STATUS_POLLER.updated is None:
+        return {'pending': True, 'connected': False, 'age_seconds': None}
+    status = dict(WIFI_STATUS_POLLER.value or {'connected': False, 'error': 'WiFi status not available yet'})
+    age = WIFI_STATUS_POLLER.age()
+    status['age_seconds'] = round(age, 1) if age is not None else None
+    return status
+
+def ensure_avahi_daemon():
+    """Make sure avahi-daemon is running; avahi-publish-service only talks to it"""
     print("Checking mDNS service (avahi-daemon)...")
     try:
         result = subprocess.run(
@@ -1736,235 +3811,246 @@ def register_mdns_service():
     except Exception as e:
         print(f"  Note: Could not check avahi-daemon: {e}")
 
-    # Check network connectivity
-    print("\nChecking network connectivity...")
+def stop_avahi_publishers():
+    """Stop the avahi-publish-service children this server started.
 
-    ip_addresses = get_local_ipv4_addresses()
-    local_ip = ip_addresses[0] if ip_addresses else get_local_ip()
-    has_internet = check_internet_connection()
+    PIDs come from AVAHI_PROCESSES and AVAHI_PID_FILE, which also covers children
+    left running across an os.execv restart. A PID is only signalled if it
+    still belongs to avahi-publish-service, so other publishers on the system
+    are left alone.
+    """
+    global AVAHI_PROCESSES
+    pids = {proc.pid for proc in AVAHI_PROCESSES}
+    try:
+        with open(AVAHI_PID_FILE) as f:
+            pids.update(int(line) for line in f if line.strip().isdigit())
+    except OSError:
+        pass
 
-    if has_internet:
-        print("✓ Internet connection available")
-    elif local_ip and not local_ip.startswith("127."):
-        print(f"✓ Local network connected (IP: {local_ip})")
-        print("  ⚠ No internet access (Local Mode)")
-    else:
-        print("⚠ No network connection detected")
-        print("  WiFi setup required. Visit /setup-wifi to configure WiFi")
+    stopped = []
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                if b'avahi-publish' not in f.read():
+                    continue  # Exited, and the PID now belongs to something else
+            os.kill(pid, signal.SIGTERM)
+            stopped.append(pid)
+        except OSError:
+            continue  # Already gone
 
-    hostname = socket.gethostname()
-    ip_address = local_ip
-    server_local_hostname = f"{hostname}.local."
+    for proc in AVAHI_PROCESSES:
+        try:
+            proc.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+    # Children inherited from before an os.execv have no Popen to reap them
+    deadline = time.monotonic() + 2
+    for pid in set(stopped) - {proc.pid for proc in AVAHI_PROCESSES}:
+        try:
+            while os.waitpid(pid, os.WNOHANG) == (0, 0) and time.monotonic() < deadline:
+                time.sleep(0.05)
+        except ChildProcessError:
+            pass  # Not our child
 
-    if not ip_address or ip_address.startswith("127."):
-        print("⚠ Warning: Could not register mDNS service")
-        print("  Error: No usable IP address available for mDNS")
-        return None
+    AVAHI_PROCESSES = []
+    try:
+        os.remove(AVAHI_PID_FILE)
+    except OSError:
+        pass
+    if stopped:
+        print(f"✓ Stopped {len(stopped)} avahi-publish-service process(es)")
+
+def start_avahi_publishers(name, txt_records):
+    """Fallback responder: one avahi-publish-service child per MDNS_SERVICES entry"""
+    import shutil
+    if not shutil.which('avahi-publish-service'):
+        raise RuntimeError("avahi-publish-service not installed")
+
+    ensure_avahi_daemon()
+    stop_avahi_publishers()
+    for suffix, service_type, extra_txt in MDNS_SERVICES:
+        txt = dict(txt_records, **extra_txt)
+        cmd = ['avahi-publish-service', name + suffix, service_type.replace('.local.', ''), str(SERVICE_PORT)]
+        cmd += [f'{key}={value}' for key, value in txt.items()]
+        try:
+            AVAHI_PROCESSES.append(subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        except OSError as e:
+            print(f"⚠ Failed to start {cmd[2]}: {e}")
+    try:
+        with open(AVAHI_PID_FILE, 'w') as f:
+            f.write(''.join(f"{proc.pid}\n" for proc in AVAHI_PROCESSES))
+    except OSError as e:
+        print(f"Warning: Could not write {AVAHI_PID_FILE}: {e}")
+
+    # avahi-publish-service exits straight away if the daemon rejects the service
+    time.sleep(0.5)
+    running = [proc for proc in AVAHI_PROCESSES if proc.poll() is None]
+    if not running:
+        stop_avahi_publishers()
+        raise RuntimeError("avahi-publish-service exited immediately")
+    print(f"✓ Started {len(running)} avahi-publish-service process(es) (PIDs: {', '.join(str(p.pid) for p in running)})")
+
+def _register_zeroconf(hostname, addresses, txt_records):
+    """Publish every MDNS_SERVICES entry from one Zeroconf instance.
+
+    Each ServiceInfo names <hostname>.local. as its server, so the same responder
+    also answers A queries for the hostname. Returns the registered instance
+    name; on failure nothing is left registered.
+    """
+    global ZEROCONF_INSTANCE, ZEROCONF_INSTANCES
+
+    zeroconf_module = lazy_module('zeroconf')
+    ServiceInfo, Zeroconf = zeroconf_module.ServiceInfo, zeroconf_module.Zeroconf
+    NonUniqueNameException = zeroconf_module.NonUniqueNameException
+    IPVersion, InterfaceChoice = zeroconf_module.IPVersion, zeroconf_module.InterfaceChoice
 
-    mdns_addresses = [socket.inet_aton(ip) for ip in (ip_addresses or [ip_address])]
+    server_local_hostname = f"{hostname}.local."
+    mdns_addresses = [socket.inet_aton(ip) for ip in addresses]
 
-    def build_service_info(name: str, service_type: str):
+    def build_service_info(name, service_type, extra_txt):
         """Create a ServiceInfo object with Android-compatible settings"""
-        service_name = f"{name}.{service_type}"
-        # Add comprehensive TXT records for Android discovery
-        txt_records = {
-            'path': '/',
-            'description': 'Music Server',
-            'version': '1.0',
-            'device': hostname,
-            'port': str(SERVICE_PORT),
-        }
         return ServiceInfo(
             service_type,
-            service_name,
+            f"{name}.{service_type}",
             addresses=mdns_addresses,
             port=SERVICE_PORT,
-            properties=txt_records,
+            properties=dict(txt_records, **extra_txt),
             server=server_local_hostname
         )
 
-    registered_service_name = SERVICE_NAME
+    # All services share this instance's sockets, cache and announcement scheduling
+    zeroconf = Zeroconf(interfaces=InterfaceChoice.All, ip_version=IPVersion.V4Only)
     registered_services = []
-    AVAHI_PROCESS = None  # Track avahi-publish-service process
-
+    name = SERVICE_NAME
     try:
-        # Primary HTTP service
-        zeroconf = Zeroconf(
-            interfaces=InterfaceChoice.All,
-            ip_version=IPVersion.V4Only
-        )
-
+        _, primary_type, primary_txt = MDNS_SERVICES[0]
         try:
-            info = build_service_info(registered_service_name, SERVICE_TYPE)
+            info = build_service_info(name, primary_type, primary_txt)
             zeroconf.register_service(info)
-            registered_services.append((zeroconf, info))
-            print(f"✓ Registered HTTP service: {registered_service_name}")
+            print(f"✓ Registered HTTP service: {name}")
         except NonUniqueNameException:
-            zeroconf.close()
-            registered_service_name = f"{SERVICE_NAME}-{hostname}"
-            zeroconf = Zeroconf(interfaces=InterfaceChoice.All, ip_version=IPVersion.V4Only)
-            info = build_service_info(registered_service_name, SERVICE_TYPE)
+            name = f"{SERVICE_NAME}-{hostname}"
+            info = build_service_info(name, primary_type, primary_txt)
             zeroconf.register_service(info)
-            registered_services.append((zeroconf, info))
-            print(f"⚠ Name collision, using fallback: {registered_service_name}")
+            print(f"⚠ Name collision, using fallback: {name}")
+        registered_services.append((zeroconf, info))
 
-        # Register as _workstation._tcp for Android network discovery
-        try:
-            workstation_info = build_service_info(registered_service_name, "_workstation._tcp.local.")
-            zeroconf.register_service(workstation_info)
-            registered_services.append((zeroconf, workstation_info))
-            print(f"✓ Registered workstation service for Android discovery")
-        except Exception as e:
-            print(f"  Note: Could not register workstation service: {e}")
+        # _workstation and _airplay help Android discovery
+        for suffix, service_type, extra_txt in MDNS_SERVICES[1:]:
+            try:
+                info = build_service_info(name + suffix, service_type, extra_txt)
+                zeroconf.register_service(info)
+                registered_services.append((zeroconf, info))
+                print(f"✓ Registered {service_type} service")
+            except Exception as e:
+                print(f"  Note: Could not register {service_type} service: {e}")
 
-        # Register hostname directly for name resolution
-        try:
-            hostname_info = ServiceInfo(
-                "_tcp.local.",
-                f"{hostname}._tcp.local.",
-                addresses=mdns_addresses,
-                port=SERVICE_PORT,
-                properties={'name': 'Music Server'},
-                server=server_local_hostname
-            )
-            zeroconf.register_service(hostname_info)
-            registered_services.append((zeroconf, hostname_info))
-            print(f"✓ Registered hostname service")
-        except Exception as e:
-            print(f"  Note: Could not register hostname service: {e}")
+    except Exception:
+        zeroconf.close()
+        raise
 
-        ZEROCONF_INSTANCE = zeroconf
-        REGISTERED_SERVICE_NAME = registered_service_name
-        ZEROCONF_INSTANCES = registered_services
+    ZEROCONF_INSTANCE = zeroconf
+    ZEROCONF_INSTANCES = registered_services
+    return name
 
-        # ALSO use avahi-publish-service for better local network support
-        # This is especially important for hotspot mode where avahi-daemon may not work
-        # Android needs multiple service types for reliable discovery in local-only mode
-        print("\nStarting avahi-publish-service for local network...")
-        try:
-            # Stop any existing avahi-publish-service
-            subprocess.run(['pkill', '-f', 'avahi-publish-service'], stderr=subprocess.DEVNULL)
-
-            # Start multiple avahi-publish-service instances for Android compatibility
-            # Android responds better to these service types in local networks
-
-            # 1. HTTP service (standard)
-            avahi_http_cmd = [
-                'avahi-publish-service',
-                registered_service_name,
-                '_http._tcp',
-                str(SERVICE_PORT),
-                'path=/',
-                f'device={hostname}',
-                'description=Music Server',
-            ]
-
-            # 2. AirPlay service (Android/Chromecast compatible)
-            avahi_airplay_cmd = [
-                'avahi-publish-service',
-                f'{registered_service_name}-airplay',
-                '_airplay._tcp',
-                str(SERVICE_PORT),
-                'device=Music Server',
-                f'fv=1',
-            ]
-
-            # 3. Workstation service (Android network discovery)
-            avahi_workstation_cmd = [
-                'avahi-publish-service',
-                f'{registered_service_name}-workstation',
-                '_workstation._tcp',
-                str(SERVICE_PORT),
-                'Workstation',
-            ]
-
-            # Start all three services in background
-            processes = []
-            for cmd in [avahi_http_cmd, avahi_airplay_cmd, avahi_workstation_cmd]:
-                try:
-                    proc = subprocess.Popen(
-                        cmd,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True
-                    )
-                    processes.append(proc)
-                    print(f"✓ Started: {cmd[2]} service")
-                except Exception as e:
-                    print(f"⚠ Failed to start {cmd[2]}: {e}")
+def register_mdns_service():
+    """Register mDNS service for network discovery with Android compatibility.
+
+    One in-process zeroconf responder publishes everything in MDNS_SERVICES and
+    the hostname's A record. avahi-publish-service children are only started when zeroconf
+    is missing or fails, or when MDNS_RESPONDER=avahi. Blocks on subprocesses
+    and multicast probing, so it runs on the MDNS_ADVERTISER worker. Returns the
+    responder in use ('zeroconf' or 'avahi'), and raises RuntimeError if nothing
+    could be registered.
+    """
+    global REGISTERED_SERVICE_NAME
 
-            # Check if at least one service started
-            time.sleep(0.5)
-            running_processes = [p for p in processes if p.poll() is None]
+    # Publishers left over from before an os.execv restart
+    stop_avahi_publishers()
 
-            if running_processes:
-                AVAHI_PROCESS = running_processes[0]  # Store first one for cleanup
-                print(f"✓ Started {len(running_processes)} mDNS services (PID: {running_processes[0].pid})")
-            else:
-                print("⚠ No mDNS services started")
+    # Check network connectivity
+    print("\nChecking network connectivity...")
 
-        except FileNotFoundError:
-            print("⚠ avahi-publish-service not installed (skipping)")
-        except Exception as e:
-            print(f"⚠ Error starting avahi-publish-service: {e}")
-
-        print(f"\n✓ mDNS services registered successfully")
-        print(f"  - Service Name: {registered_service_name}")
-        print(f"  - IP Address: {ip_address}")
-        print(f"  - Port: {SERVICE_PORT}")
-        print(f"  - Hostname: {hostname}.local")
-        print(f"  - Services:")
-        print(f"    • HTTP: http://{hostname}.local:{SERVICE_PORT}")
-        print(f"    • Workstation: {hostname}.local")
-        print(f"    • Direct: http://{ip_address}:{SERVICE_PORT}")
-        print(f"\n📱 For Android users:")
-        print(f"    Try accessing: http://{hostname}.local:{SERVICE_PORT}")
-        print(f"    If that doesn't work, use the IP address shown above")
-
-        # Verify service visibility
-        try:
-            result = subprocess.run(
-                ['avahi-browse', '-a', '-t'],
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
-            output = result.stdout.lower()
-            if registered_service_name.lower() in output:
-                print("\n✓ Service visible via avahi-browse")
-            else:
-                print("\n⚠ Service not visible in avahi-browse (may still work on Android)")
-        except:
-            pass
+    ip_addresses = get_local_ipv4_addresses()
+    local_ip = ip_addresses[0] if ip_addresses else get_local_ip()
 
-        return zeroconf
+    if INTERNET_AVAILABLE:
+        print("✓ Internet connection available")
+    elif local_ip and not local_ip.startswith("127."):
+        print(f"✓ Local network connected (IP: {local_ip})")
+        print("  ⚠ No internet access (Local Mode)")
+    else:
+        print("⚠ No network connection detected")
+        print("  WiFi setup required. Visit /setup-wifi to configure WiFi")
 
-    except Exception as e:
-        import traceback
-        print("⚠ Warning: mDNS registration failed")
-        print(f"  Error: {str(e)}")
-        traceback.print_exc()
-        return None
+    hostname = socket.gethostname()
+    ip_address = local_ip
+
+    if not ip_address or ip_address.startswith("127."):
+        print("⚠ Warning: Could not register mDNS service")
+        print("  Error: No usable IP address available for mDNS")
+        raise RuntimeError("No usable IP address available for mDNS")
+
+    # Add comprehensive TXT records for Android discovery
+    txt_records = {
+        'path': '/',
+        'description': 'Music Server',
+        'version': '1.0',
+        'device': hostname,
+        'port': str(SERVICE_PORT),
+    }
+
+    responder = None
+    if MDNS_RESPONDER != 'avahi':
+        if not ZEROCONF_AVAILABLE:
+            print("mDNS: zeroconf not installed (pip install zeroconf), trying avahi-publish-service")
+        else:
+            try:
+                REGISTERED_SERVICE_NAME = _register_zeroconf(hostname, ip_addresses or [ip_address], txt_records)
+                responder = 'zeroconf'
+            except Exception as e:
+                import traceback
+                print("⚠ Warning: zeroconf registration failed, trying avahi-publish-service")
+                print(f"  Error: {str(e)}")
+                traceback.print_exc()
+
+    if responder is None:
+        try:
+            start_avahi_publishers(SERVICE_NAME, txt_records)
+        except Exception as e:
+            print("⚠ Warning: mDNS registration failed")
+            print(f"  Error: {str(e)}")
+            raise
+        REGISTERED_SERVICE_NAME = SERVICE_NAME
+        responder = 'avahi'
+
+    print(f"\n✓ mDNS services registered successfully ({responder})")
+    print(f"  - Service Name: {REGISTERED_SERVICE_NAME}")
+    print(f"  - IP Address: {ip_address}")
+    print(f"  - Port: {SERVICE_PORT}")
+    print(f"  - Hostname: {hostname}.local")
+    print(f"  - Services:")
+    print(f"    • HTTP: http://{hostname}.local:{SERVICE_PORT}")
+    print(f"    • Workstation: {hostname}.local")
+    print(f"    • Direct: http://{ip_address}:{SERVICE_PORT}")
+    print(f"\n📱 For Android users:")
+    print(f"    Try accessing: http://{hostname}.local:{SERVICE_PORT}")
+    print(f"    If that doesn't work, use the IP address shown above")
+    return responder
 
 def unregister_mdns_service():
     """Unregister mDNS service on shutdown"""
-    global ZEROCONF_INSTANCE, ZEROCONF_INSTANCES, AVAHI_PROCESS
+    global ZEROCONF_INSTANCE, ZEROCONF_INSTANCES
 
-    # Stop avahi-publish-service processes first
-    # We now track multiple processes, so just kill all of them
-    try:
-        subprocess.run(['pkill', '-f', 'avahi-publish-service'], stderr=subprocess.DEVNULL)
-        print("✓ Stopped all avahi-publish-service processes")
-    except Exception as e:
-        print(f"Error stopping avahi-publish-service: {e}")
+    stop_avahi_publishers()
 
     # Unregister all services
-    if ZEROCONF_INSTANCES:
-        for zeroconf, service_info in ZEROCONF_INSTANCES:
-            try:
-                zeroconf.unregister_service(service_info)
-            except Exception as e:
-                print(f"Error unregistering service: {e}")
+    for zeroconf, service_info in ZEROCONF_INSTANCES:
+        try:
+            zeroconf.unregister_service(service_info)
+        except Exception as e:
+            print(f"Error unregistering service: {e}")
 
     if ZEROCONF_INSTANCE:
         try:
@@ -1975,12 +4061,160 @@ def unregister_mdns_service():
         finally:
             ZEROCONF_INSTANCE = None
             ZEROCONF_INSTANCES = []
-            AVAHI_PROCESS = None
+
+def update_mdns_addresses(addresses):
+    """Re-announce every registered ServiceInfo with new addresses, without unregistering.
+
+    Returns False only if the avahi publishers are gone, in which case the caller
+    must register again.
+    """
+    if ZEROCONF_INSTANCE is None:
+        return bool(AVAHI_PROCESSES)  # avahi-daemon follows address changes by itself
+    # Sockets for InterfaceChoice.All are bound per address, so pick up new ones first.
+    # Older zeroconf has no update_interfaces; the records are still updated in place
+    # and announced on the sockets it already has.
+    update_interfaces = getattr(ZEROCONF_INSTANCE, 'update_interfaces', None)
+    if update_interfaces is not None:
+        update_interfaces()
+    packed = [socket.inet_aton(ip) for ip in addresses]
+    for zeroconf, info in ZEROCONF_INSTANCES:
+        info.addresses = packed
+        zeroconf.update_service(info)
+    return True
+
+class MdnsAdvertiser:
+    """Runs mDNS registration, address updates and shutdown on one background worker.
+
+    Jobs run in submission order, so an address change seen while the first
+    registration is still probing simply follows it. status() is reported by
+    /api/health.
+    """
+
+    def __init__(self):
+        import shutil
+        self.available = ZEROCONF_AVAILABLE or shutil.which('avahi-publish-service') is not None
+        self._jobs = BackgroundJobQueue('mdns')
+        self._lock = threading.Lock()
+        self._status = {
+            'state': 'stopped' if self.available else 'unavailable',  # registering, registered, failed, stopping
+            'responder': None,  # 'zeroconf' (in-process) or 'avahi' (avahi-publish-service children)
+            'service_name': None,
+            'addresses': [],
+            'error': None,
+            'since': time.time(),
+        }
+
+    def _set_state(self, state, **fields):
+        with self._lock:
+            self._status.update(fields, state=state, since=time.time())
+
+    def _register(self, func):
+        self._set_state('registering', error=None)
+        try:
+            responder = func()
+        except Exception as e:
+            self._set_state('failed', responder=None, service_name=None, addresses=[], error=str(e))
+            raise
+        if ZEROCONF_INSTANCES:
+            addresses = ZEROCONF_INSTANCES[0][1].parsed_addresses()
+        else:
+            addresses = get_local_ipv4_addresses()
+        self._set_state('registered', responder=responder, service_name=REGISTERED_SERVICE_NAME, addresses=addresses)
+        return {'responder': responder, 'service_name': REGISTERED_SERVICE_NAME, 'addresses': addresses}
+
+    def _unregister(self):
+        self._set_state('stopping')
+        try:
+            unregister_mdns_service()
+        finally:
+            self._set_state('stopped', responder=None, service_name=None, addresses=[])
+
+    def _update_addresses(self):
+        addresses = get_local_ipv4_addresses()
+        with self._lock:
+            state, current = self._status['state'], self._status['addresses']
+        if state == 'failed':
+            # Typically no usable address at start-up; try again now that one appeared
+            return self._register(register_mdns_service) if addresses else None
+        if state != 'registered' or addresses == current:
+            return None
+        if not addresses:
+            # Offline: keep the records so they are simply refreshed when an address returns
+            print("mDNS: no usable IPv4 address, keeping the current records")
+            return None
+        print(f"mDNS: addresses changed {current} -> {addresses}")
+        if update_mdns_addresses(addresses):
+            self._set_state('registered', addresses=addresses)
+            return {'service_name': REGISTERED_SERVICE_NAME, 'addresses': addresses}
+        unregister_mdns_service()
+        return self._register(register_mdns_service)
+
+    def start(self):
+        """Queue the initial registration; returns its job"""
+        return self._jobs.submit(('mdns', 'register'), self._register, register_mdns_service, priority=PRIORITY_ON_DEMAND)
+
+    def addresses_changed(self):
+        """Queue an update of the published addresses; returns its job, or None if not registering"""
+        with self._lock:
+            if self._status['state'] not in ('registering', 'registered', 'failed'):
+                return None
+        # A running update may already have read the old addresses, so only a pending one is joined
+        return self._jobs.submit(('mdns', 'update'), self._update_addresses, join_running=False)
+
+    def stop(self, timeout=5):
+        """Unregister after any queued work, waiting up to timeout seconds; returns True if done"""
+        return self._jobs.submit(('mdns', 'unregister'), self._unregister, priority=PRIORITY_ON_DEMAND).wait(timeout)
+
+    def registered(self):
+        with self._lock:
+            return self._status['state'] == 'registered'
+
+    def status(self):
+        with self._lock:
+            status = dict(self._status)
+        status['age_seconds'] = round(time.time() - status.pop('since'), 1)
+        return status
+
+MDNS_ADVERTISER = MdnsAdvertiser()
+NETWORK_MONITOR.add_listener(lambda pairs: MDNS_ADVERTISER.addresses_changed())
+
+def run_server(port, on_listening=None):
+    """Serve the app on all interfaces with the configured engine until interrupted.
+
+    on_listening() is called once the listening socket is bound (just before it,
+    for the development server), for work that should not delay the first request.
+    """
+    engine = SERVER_ENGINE
+    if engine == 'waitress' and not WAITRESS_AVAILABLE:
+        print("Warning: waitress not installed, falling back to the development server")
+        engine = 'dev'
+
+    if engine == 'waitress':
+        with startup_phase('bind http server'):
+            server = lazy_module('waitress').create_server(
+                app, host='0.0.0.0', port=port,
+                threads=SERVER_THREADS,
+                connection_limit=SERVER_CONNECTION_LIMIT,
+                channel_timeout=SERVER_CHANNEL_TIMEOUT,
+                ident='Cubie',
+            )
+        print(f"Serving with waitress ({SERVER_THREADS} threads, {SERVER_CONNECTION_LIMIT} connections max, "
+              f"{SERVER_CHANNEL_TIMEOUT}s idle timeout)")
+        startup_report()
+        if on_listening:
+            on_listening()
+        server.run()
+    else:
+        print("Serving with the Flask development server")
+        startup_report()
+        if on_listening:
+            on_listening()
+        app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
 
 def start_file_monitor():
     """Start the file system monitor"""
     event_handler = MusicEventHandler()
-    observer = Observer()
+    observer = lazy_module('watchdog.observers').Observer()
     
     # Ensure folders exist
     for folder in [MUSIC_FOLDER, PICTURES_FOLDER, DOCUMENTS_FOLDER]:
@@ -1995,54 +4229,72 @@ def start_file_monitor():
     print("Started file monitor on music, pictures, and documents")
     return observer
 
+def prepare_server():
+    """Server start phase: pick the port and start the background probes.
+
+    The captive portal redirect is set up by on_server_listening(), once the server is bound.
+    """
+    with startup_phase('select port'):
+        select_service_port()
+    # Probes run on their own threads, so their first (slow) results are usually
+    # in before the first status request instead of being run by it
+    NETWORK_MONITOR.start()
+    CONNECTIVITY_PROBER.start()
+    WIFI_STATUS_POLLER.start()
+    TAILSCALE_STATUS.start()
+
+def on_server_listening():
+    """Work started once the HTTP socket is bound: library scans and the captive portal redirect"""
+    # Libraries are scanned once the server is listening, not before
+    start_library_load()
+    # Try to configure iptables (may fail without sudo, that's OK)
+    start_captive_portal_redirect()
+
+record_startup('phase', 'import app', STARTUP_STARTED)
+
 if __name__ == '__main__':
     print("=" * 50)
     print("AIY Music Server - Pi Zero Music Server")
     print("=" * 50)
 
-    get_exif_data("pictures/image_1765229010_A_cute_robot_painter_in_a_futu.jpg")
+    prepare_server()
 
     print(f"Music folder: {MUSIC_FOLDER}")
     print(f"Server port: {SERVICE_PORT} (auto-selected)")
 
-    # Check internet connectivity on startup
-    print("\nChecking internet connection...")
-    if check_internet_connection():
-        print("✓ Internet connection available")
-    else:
-        print("⚠ No internet connection detected")
-        print("  WiFi setup is required to get internet access")
-        print(f"  Visit http://localhost:{SERVICE_PORT}/setup-wifi to configure WiFi")
-
-    load_metadata()
+    # Internet connectivity is probed in the background (see connectivity in /api/health)
+    print("\nChecking internet connection in the background...")
+    print(f"  Without internet, visit http://localhost:{SERVICE_PORT}/setup-wifi to configure WiFi")
 
-    # Register mDNS service
-    zeroconf_instance = None
-    if ZEROCONF_AVAILABLE:
-        zeroconf_instance = register_mdns_service()
+    # Register mDNS service in the background; /api/health reports its progress
+    if MDNS_ADVERTISER.available:
+        MDNS_ADVERTISER.start()
+    else:
+        print("Warning: neither zeroconf nor avahi-publish-service is installed. mDNS service will not be available.")
 
     try:
-        observer = start_file_monitor()
+        with startup_phase('start file monitor'):
+            observer = start_file_monitor()
     except Exception as e:
         print(f"Warning: Could not start file monitor: {e}")
         observer = None
 
     try:
         print(f"\nStarting server on http://0.0.0.0:{SERVICE_PORT}")
-        if zeroconf_instance:
-            print(f"✓ mDNS enabled")
+        if MDNS_ADVERTISER.available:
+            print("✓ mDNS registering in the background (status in /api/health)")
             print(f"  📱 Android users: Visit http://cubie:{SERVICE_PORT} (hotspot DNS) or http://<pi-ip>:{SERVICE_PORT}")
             print(f"  🖥️  Mac/Desktop: Visit http://cubie.local:{SERVICE_PORT}")
         else:
             print("⚠ mDNS disabled: Using IP address instead")
         print("\nPress Ctrl+C to stop")
         print("=" * 50)
-        app.run(host='0.0.0.0', port=SERVICE_PORT, debug=False)
+        run_server(SERVICE_PORT, on_listening=on_server_listening)
     except KeyboardInterrupt:
         print("\nShutting down...")
     finally:
         if observer:
             observer.stop()
             observer.join()
-        if zeroconf_instance:
-            unregister_mdns_service()
+        if MDNS_ADVERTISER.available:
+            MDNS_ADVERTISER.stop()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Benchmark the HTTP serving engines: waitress vs the Flask development server.
+
+Each engine is started in its own process (SERVER_ENGINE=...) with the music
+library loaded from the project's music folder, then hammered by several
+client processes that each keep one HTTP/1.1 connection alive and request a
+mix of API and static URLs. Reports requests/sec and p50/p99 latency.
+
+Usage:
+    python benchmarks/bench_http_server.py [--clients 8] [--seconds 10] [--engines waitress,dev]
+"""
+
+import argparse
+import http.client
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+PROJECT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DEFAULT_PATHS = ['/api/health', '/api/music?fields=title,artist,duration', '/api/documents', '/static/app.js']
+
+SERVER_CODE = """
+import sys
+import app
+app.load_metadata()
+app.load_document_metadata()
+app.run_server(int(sys.argv[1]))
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(engine, port, threads):
+    env = dict(os.environ, SERVER_ENGINE=engine, SERVER_THREADS=str(threads))
+    proc = subprocess.Popen(
+        [sys.executable, '-c', SERVER_CODE, str(port)],
+        cwd=PROJECT_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"{engine} server did not start on port {port}")
+
+
+def client(args):
+    """One keep-alive connection issuing requests round-robin until the deadline"""
+    port, paths, deadline = args
+    latencies = []
+    errors = 0
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    index = 0
+    while time.time() < deadline:
+        path = paths[index % len(paths)]
+        index += 1
+        start = time.perf_counter()
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+            if response.getheader('Connection', '').lower() == 'close':
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+    return latencies, errors
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_engine(engine, clients, seconds, threads, paths):
+    port = free_port()
+    proc = start_server(engine, port, threads)
+    try:
+        # Warm up (first requests encode the library snapshots)
+        client((port, paths, time.time() + 1))
+        deadline = time.time() + seconds
+        with multiprocessing.Pool(clients) as pool:
+            results = pool.map(client, [(port, paths, deadline)] * clients)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    latencies = [latency for result, _ in results for latency in result]
+    errors = sum(errors for _, errors in results)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / seconds,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=8, help='concurrent keep-alive clients (default 8)')
+    parser.add_argument('--seconds', type=float, default=10, help='measurement time per engine (default 10)')
+    parser.add_argument('--threads', type=int, default=8, help='SERVER_THREADS for waitress (default 8)')
+    parser.add_argument('--engines', default='waitress,dev', help='comma-separated engines (default waitress,dev)')
+    parser.add_argument('--path', action='append', help='URL path to request (repeatable)')
+    args = parser.parse_args()
+    paths = args.path or DEFAULT_PATHS
+
+    print(f"{args.clients} clients, {args.seconds:g}s per engine, paths: {', '.join(paths)}")
+    print(f"\n{'engine':<10} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for engine in args.engines.split(','):
+        stats = run_engine(engine, args.clients, args.seconds, args.threads, paths)
+        print(f"{engine:<10} {stats['requests']:>9} {stats['errors']:>7} {stats['rps']:>9.1f} "
+              f"{stats['p50']:>8.2f} {stats['p99']:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Benchmark the picture metadata reader against the previous implementation.
+
+Generates a mixed JPEG/PNG/WebP corpus (with and without EXIF, IPTC and
+Windows XP* tags) in a temporary folder, checks that both readers return the
+same fields, and reports the per-image cost of each.
+
+Usage:
+    python benchmarks/bench_image_metadata.py [--images 300] [--size 2000] [--rounds 3]
+"""
+
+import argparse
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+from PIL import Image, ExifTags
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import app  # noqa: E402
+
+
+def legacy_get_exif_data(image_path):
+    """get_exif_data as it was before the single-pass reader (kept verbatim for comparison)"""
+    decode_text = app.decode_text
+    try:
+        img = Image.open(image_path)
+        width, height = img.size
+
+        # Try to get EXIF data safely
+        exif = {}
+        try:
+            raw_exif = img._getexif()
+            if raw_exif:
+                exif = { ExifTags.TAGS.get(k, k): v for k, v in raw_exif.items() }
+        except (AttributeError, TypeError):
+            pass
+
+        title = ""
+        caption = ""
+
+        # Try IPTC first (this is what macOS uses for Title)
+        try:
+            from PIL import IptcImagePlugin
+            iptc = IptcImagePlugin.getiptcinfo(img)
+            if iptc:
+                # IPTC Object Name (2, 5) = Title/Headline
+                if (2, 5) in iptc:
+                    val = iptc[(2, 5)]
+                    if isinstance(val, bytes):
+                        title = val.decode('utf-8', errors='ignore').strip()
+                    elif isinstance(val, list) and val:
+                        title = val[0].decode('utf-8', errors='ignore').strip() if isinstance(val[0], bytes) else str(val[0]).strip()
+                    else:
+                        title = str(val).strip()
+
+                # IPTC Headline (2, 105) as backup title
+                if not title and (2, 105) in iptc:
+                    val = iptc[(2, 105)]
+                    if isinstance(val, bytes):
+                        title = val.decode('utf-8', errors='ignore').strip()
+                    else:
+                        title = str(val).strip()
+
+                # IPTC Caption/Abstract (2, 120)
+                if (2, 120) in iptc:
+                    val = iptc[(2, 120)]
+                    if isinstance(val, bytes):
+                        caption = val.decode('utf-8', errors='ignore').strip()
+                    else:
+                        caption = str(val).strip()
+        except Exception as e:
+            print(f"IPTC read error: {e}")
+
+        # XPTitle (Windows)
+        for key in list(exif.keys()):
+            if key == 0x9c9b or key == 'XPTitle':
+                try:
+                    val = exif[key]
+                    if isinstance(val, bytes):
+                        decoded = decode_text(val)
+                        if decoded and not title:
+                            title = decoded
+                except Exception as _e:
+                    pass
+            if key == 0x9c9c or key == 'XPComment':
+                try:
+                    val = exif[key]
+                    if isinstance(val, bytes):
+                        decoded = decode_text(val)
+                        if decoded and not caption:
+                            caption = decoded
+                except Exception as _e:
+                    pass
+
+        if 'DocumentName' in exif:
+            title = str(exif['DocumentName']).strip()
+
+        if 'ImageDescription' in exif:
+            val = exif['ImageDescription']
+            if isinstance(val, bytes):
+                try:
+                    caption = val.decode('utf-8').strip()
+                except Exception as _e:
+                    caption = val.decode('latin-1', errors='ignore').strip()
+            else:
+                caption = decode_text(val)
+
+        # Get date - try EXIF first
+        date_taken = str(exif.get('DateTimeOriginal', ''))
+
+        # Try IPTC date if no EXIF date
+        if not date_taken:
+            try:
+                from PIL import IptcImagePlugin
+                iptc = IptcImagePlugin.getiptcinfo(img)
+                if iptc:
+                    # IPTC Date Created (2, 55) + Time Created (2, 60)
+                    if (2, 55) in iptc:
+                        val = iptc[(2, 55)]
+                        if isinstance(val, bytes):
+                            date_taken = val.decode('utf-8', errors='ignore').strip()
+                        else:
+                            date_taken = str(val).strip()
+            except Exception as _e:
+                pass
+
+        # Fall back to file modification date if still no date
+        if not date_taken:
+            try:
+                mtime = os.path.getmtime(image_path)
+                from datetime import datetime
+                date_taken = datetime.fromtimestamp(mtime).strftime('%Y:%m:%d %H:%M:%S')
+            except Exception as _e:
+                pass
+
+        return {
+            'width': width,
+            'height': height,
+            'title': title,
+            'caption': caption,
+            'make': str(exif.get('Make', '')),
+            'model': str(exif.get('Model', '')),
+            'date_taken': date_taken
+        }
+
+    except Exception as e:
+        print(f"Error reading metadata from {image_path}: {e}")
+        try:
+            img = Image.open(image_path)
+            w, h = img.size
+            return {'width': w, 'height': h, 'title': '', 'caption': '', 'make': '', 'model': '', 'date_taken': ''}
+        except:
+            return {'width': 0, 'height': 0, 'title': '', 'caption': '', 'make': '', 'model': '', 'date_taken': ''}
+
+
+def iptc_segment(title, caption):
+    """A JPEG APP13 Photoshop segment carrying IPTC Object Name and Caption datasets"""
+    datasets = b''
+    for number, text in ((5, title), (120, caption)):
+        value = text.encode('utf-8')
+        datasets += b'\x1c\x02' + bytes([number]) + struct.pack('>H', len(value)) + value
+    if len(datasets) % 2:
+        datasets += b'\x00'
+    resource = b'8BIM' + struct.pack('>H', 0x0404) + b'\x00\x00' + struct.pack('>I', len(datasets)) + datasets
+    payload = b'Photoshop 3.0\x00' + resource
+    return b'\xff\xed' + struct.pack('>H', len(payload) + 2) + payload
+
+
+def make_exif(index):
+    exif = Image.Exif()
+    exif[0x010f] = 'Raspberry'  # Make
+    exif[0x0110] = f'Camera {index % 3}'  # Model
+    exif[0x9c9b] = f'XP title {index}'.encode('utf-16-le') + b'\x00\x00'  # XPTitle
+    return exif
+
+
+def build_corpus(folder, count, size):
+    """Write `count` images cycling through the formats and metadata variants"""
+    paths = []
+    for index in range(count):
+        # A gradient compresses realistically without costing much to generate
+        img = Image.linear_gradient('L').resize((size, size * 3 // 4)).convert('RGB')
+        variant = index % 6
+        if variant == 0:
+            path = os.path.join(folder, f'{index}.jpg')
+            img.save(path, 'JPEG', quality=85, exif=make_exif(index).tobytes())
+        elif variant == 1:
+            path = os.path.join(folder, f'{index}.jpg')
+            img.save(path, 'JPEG', quality=85)
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path, 'wb') as f:
+                f.write(data[:2] + iptc_segment(f'IPTC title {index}', 'A caption') + data[2:])
+        elif variant == 2:
+            path = os.path.join(folder, f'{index}.jpg')
+            img.save(path, 'JPEG', quality=85)
+        elif variant == 3:
+            path = os.path.join(folder, f'{index}.png')
+            img.save(path, 'PNG')
+        elif variant == 4:
+            path = os.path.join(folder, f'{index}.png')
+            img.save(path, 'PNG', exif=make_exif(index).tobytes())
+        else:
+            path = os.path.join(folder, f'{index}.webp')
+            img.save(path, 'WEBP', quality=80, exif=make_exif(index).tobytes())
+        paths.append(path)
+    return paths
+
+
+def time_reader(reader, paths, rounds):
+    """Best-of-rounds mean seconds per image"""
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for path in paths:
+            reader(path)
+        elapsed = (time.perf_counter() - start) / len(paths)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--images', type=int, default=300, help='corpus size (default 300)')
+    parser.add_argument('--size', type=int, default=2000, help='image width in pixels (default 2000)')
+    parser.add_argument('--rounds', type=int, default=3, help='timing rounds, best is reported (default 3)')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='metadata-bench-')
+    try:
+        print(f"Generating {args.images} images ({args.size}px wide) in {folder}...")
+        paths = build_corpus(folder, args.images, args.size)
+
+        mismatches = [p for p in paths if legacy_get_exif_data(p) != app.get_exif_data(p)]
+        print(f"Readers disagree on {len(mismatches)} of {len(paths)} images")
+        for path in mismatches[:5]:
+            print(f"  {os.path.basename(path)}: legacy={legacy_get_exif_data(path)} new={app.get_exif_data(path)}")
+
+        by_format = {}
+        for path in paths:
+            by_format.setdefault(os.path.splitext(path)[1], []).append(path)
+
+        print(f"\n{'corpus':<8} {'images':>6} {'legacy ms':>10} {'new ms':>8} {'speedup':>8}")
+        for label, group in [('all', paths)] + sorted(by_format.items()):
+            legacy = time_reader(legacy_get_exif_data, group, args.rounds)
+            new = time_reader(app.get_exif_data, group, args.rounds)
+            print(f"{label:<8} {len(group):>6} {legacy * 1000:>10.3f} {new * 1000:>8.3f} {legacy / new:>7.1f}x")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Measure the mDNS responder: memory of the process tree and multicast packets sent.
+
+Runs each responder arrangement in its own process and registers the server's
+services there:
+
+  legacy    zeroconf for _http/_workstation plus one avahi-publish-service
+            child per service type (the arrangement before the consolidated
+            responder)
+  zeroconf  one in-process zeroconf responder for everything (the default)
+  avahi     avahi-publish-service children only (MDNS_RESPONDER=avahi fallback)
+
+For each arrangement it reports the RSS of the responder process plus its
+children, and the mDNS responses naming this host seen on 224.0.0.251:5353.
+Responses are counted during start-up (announcements) and then per second
+while PTR queries for every service type are sent at a fixed rate, like a few
+phones browsing the network. Modes that need avahi-publish-service are skipped
+when it isn't installed. avahi-daemon's own memory isn't counted because it
+runs whether or not we publish through it. Needs Linux (/proc).
+
+Usage:
+    python benchmarks/bench_mdns_responder.py [--seconds 20] [--settle 5] [--query-interval 1]
+"""
+
+import argparse
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+PROJECT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MDNS_GROUP = '224.0.0.251'
+MDNS_PORT = 5353
+SERVICE_TYPES = ('_http._tcp.local', '_workstation._tcp.local', '_airplay._tcp.local')
+
+RESPONDER_CODE = """
+import sys
+import app
+mode, app.SERVICE_PORT = sys.argv[1], int(sys.argv[2])
+if mode == 'legacy':
+    hostname = app.socket.gethostname()
+    txt = {'path': '/', 'description': 'Music Server', 'version': '1.0', 'device': hostname, 'port': sys.argv[2]}
+    services = app.MDNS_SERVICES
+    app.MDNS_SERVICES = services[:2]
+    app._register_zeroconf(hostname, app.get_local_ipv4_addresses(), txt)
+    app.MDNS_SERVICES = services
+    app.start_avahi_publishers(app.SERVICE_NAME, txt)
+else:
+    app.MDNS_RESPONDER = mode
+    app.register_mdns_service()
+print('ready', flush=True)
+sys.stdin.read()  # Until the benchmark closes our stdin
+app.unregister_mdns_service()
+"""
+
+
+def ptr_query(service_type):
+    """A single-question mDNS PTR query packet"""
+    qname = b''.join(bytes([len(label)]) + label.encode() for label in service_type.split('.')) + b'\0'
+    return struct.pack('>HHHHHH', 0, 0, 1, 0, 0, 0) + qname + struct.pack('>HH', 12, 1)
+
+
+def process_tree_rss(pid):
+    """(RSS in bytes, process count) for pid and all of its descendants"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    rss = count = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+        count += 1
+        stack.extend(children.get(current, ()))
+    return rss, count
+
+
+class Sniffer:
+    """Records (time, size) of mDNS responses that mention a given name"""
+
+    def __init__(self, needle):
+        self.needle = needle
+        self.packets = []
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._sock.bind(('', MDNS_PORT))
+        membership = struct.pack('4s4s', socket.inet_aton(MDNS_GROUP), socket.inet_aton('0.0.0.0'))
+        self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        self._sock.settimeout(0.2)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                data, _ = self._sock.recvfrom(9000)
+            except socket.timeout:
+                continue
+            # QR bit set: a response (announcements are unsolicited responses)
+            if len(data) > 12 and data[2] & 0x80 and self.needle in data.lower():
+                self.packets.append((time.time(), len(data)))
+
+    def between(self, start, end):
+        selected = [size for stamp, size in self.packets if start <= stamp < end]
+        return len(selected), sum(selected)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._sock.close()
+
+
+def run_mode(mode, sniffer, args):
+    started = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, '-c', RESPONDER_CODE, mode, str(args.port)],
+        cwd=PROJECT_ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
+    try:
+        for line in proc.stdout:
+            if line.strip() == 'ready':
+                break
+        else:
+            raise RuntimeError(f"{mode} responder exited before registering")
+        time.sleep(args.settle)
+        startup_packets, _ = sniffer.between(started, time.time())
+
+        queries = [ptr_query(service_type) for service_type in SERVICE_TYPES]
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+            sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+            steady_start = time.time()
+            while time.time() - steady_start < args.seconds:
+                for query in queries:
+                    sender.sendto(query, (MDNS_GROUP, MDNS_PORT))
+                time.sleep(args.query_interval)
+            steady_end = time.time()
+        rss, processes = process_tree_rss(proc.pid)
+    finally:
+        proc.stdin.close()
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+    time.sleep(1)  # Let goodbye packets pass before the next mode starts
+
+    steady_packets, steady_bytes = sniffer.between(steady_start, steady_end)
+    duration = steady_end - steady_start
+    return {
+        'rss_mb': rss / (1024 * 1024),
+        'processes': processes,
+        'startup_packets': startup_packets,
+        'packets_per_s': steady_packets / duration,
+        'bytes_per_s': steady_bytes / duration,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=20, help='measurement time with queries per mode (default 20)')
+    parser.add_argument('--settle', type=float, default=5, help='seconds of start-up announcements to count (default 5)')
+    parser.add_argument('--query-interval', type=float, default=1,
+                        help='seconds between rounds of PTR queries (default 1)')
+    parser.add_argument('--port', type=int, default=5000, help='service port to advertise (default 5000)')
+    parser.add_argument('--modes', default='legacy,zeroconf,avahi', help='comma-separated modes to run')
+    args = parser.parse_args()
+
+    has_avahi = shutil.which('avahi-publish-service') is not None
+    sniffer = Sniffer(socket.gethostname().split('.')[0].lower().encode())
+    try:
+        print(f"{args.seconds:g}s per mode, {len(SERVICE_TYPES)} PTR queries every {args.query_interval:g}s")
+        print(f"\n{'mode':<10} {'RSS MB':>8} {'procs':>6} {'startup pkts':>13} {'pkts/s':>8} {'bytes/s':>9}")
+        for mode in args.modes.split(','):
+            if mode in ('legacy', 'avahi') and not has_avahi:
+                print(f"{mode:<10} skipped (avahi-publish-service not installed)")
+                continue
+            stats = run_mode(mode, sniffer, args)
+            print(f"{mode:<10} {stats['rss_mb']:>8.1f} {stats['processes']:>6} {stats['startup_packets']:>13} "
+                  f"{stats['packets_per_s']:>8.2f} {stats['bytes_per_s']:>9.0f}")
+    finally:
+        sniffer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Benchmark SearchIndex.search against the previous implementation.
+
+Builds a synthetic music library whose lyrics follow a Zipf distribution over an
+English-like vocabulary, so common words ("the", "you", "that") appear in almost
+every track, like real lyrics. Checks that both implementations rank the same
+tracks for a set of typeahead and multi-word queries, and reports the latency
+of each.
+
+Usage:
+    python benchmarks/bench_music_search.py [--tracks 20000] [--words 120] [--rounds 5]
+"""
+
+import argparse
+import bisect
+import heapq
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import app  # noqa: E402
+
+COMMON_WORDS = (
+    'the you i to and a me my in it that of your on be all we is love for this so do '
+    'know what just can no like up now when with its not there they will go come one '
+    'down day heart time way night back baby then see out say let take feel think '
+    'about away through around again tonight ever never nothing everything above'
+).split()
+
+QUERIES = ('th', 'the', 'th ab', 'you', 'love you', 'heart night', 'bab', 'ever th',
+           'zq', 'title', 'artist42', 'the you i')
+
+
+class LegacySearchIndex:
+    """SearchIndex as it was before weight tiers (kept verbatim for comparison)"""
+
+    PREFIX_FACTOR = 0.6
+    MIN_PREFIX_LENGTH = 2
+    MAX_PREFIX_EXPANSIONS = 200
+
+    def __init__(self, records):
+        self.postings = {}
+        for record in records:
+            for token, weight in app.SearchIndex._record_weights(record).items():
+                self.postings.setdefault(token, {})[record['filename']] = weight
+        self.tokens = sorted(self.postings)
+
+    def _expand(self, term):
+        if term in self.postings:
+            yield term, 1.0
+        if len(term) < self.MIN_PREFIX_LENGTH:
+            return
+        start = bisect.bisect_left(self.tokens, term)
+        for token in itertools.islice(self.tokens, start, start + self.MAX_PREFIX_EXPANSIONS):
+            if not token.startswith(term):
+                break
+            if token != term:
+                yield token, self.PREFIX_FACTOR
+
+    def search(self, query, limit):
+        terms = list(dict.fromkeys(app.tokenize(query)))
+        if not terms:
+            return [], 0
+
+        scores = None
+        for term in terms:
+            term_scores = {}
+            for token, factor in self._expand(term):
+                for filename, weight in self.postings[token].items():
+                    score = weight * factor
+                    if term_scores.get(filename, 0) < score:
+                        term_scores[filename] = score
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {filename: score + term_scores[filename]
+                          for filename, score in scores.items() if filename in term_scores}
+            if not scores:
+                return [], 0
+
+        ranked = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+        return ranked, len(scores)
+
+
+def make_records(count, words_per_track, seed=1):
+    rng = random.Random(seed)
+    rare = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9)))
+            for _ in range(5000)]
+    vocabulary = COMMON_WORDS + rare
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    records = []
+    for index in range(count):
+        lyrics = ' '.join(rng.choices(vocabulary, weights, k=words_per_track))
+        title = ' '.join(rng.choices(vocabulary, weights, k=rng.randint(1, 4)))
+        records.append({
+            'filename': f'track{index:06d}.mp3',
+            'title': f'Title {title}',
+            'artist': f'Artist{index % 300}',
+            'lyrics': lyrics,
+        })
+    return records
+
+
+def time_query(index, query, limit, rounds):
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        result = index.search(query, limit)
+        best = min(best, time.perf_counter() - started)
+    return result, best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=20000, help='tracks in the library (default 20000)')
+    parser.add_argument('--words', type=int, default=120, help='lyrics words per track (default 120)')
+    parser.add_argument('--limit', type=int, default=20, help='results per query (default 20)')
+    parser.add_argument('--rounds', type=int, default=5, help='timing rounds per query, best is kept (default 5)')
+    args = parser.parse_args()
+
+    records = make_records(args.tracks, args.words)
+    started = time.perf_counter()
+    index = app.SearchIndex.from_records(records)
+    print(f"{args.tracks} tracks, {args.words} lyrics words each; "
+          f"index built in {time.perf_counter() - started:.2f}s")
+    legacy = LegacySearchIndex(records)
+
+    print(f"\n{'query':<14} {'total':>7} {'legacy ms':>10} {'ms':>8}  same top {args.limit}")
+    for query in QUERIES:
+        (legacy_ranked, legacy_total), legacy_ms = time_query(legacy, query, args.limit, args.rounds)
+        (ranked, total), ms = time_query(index, query, args.limit, args.rounds)
+        same = [name for name, _ in ranked] == [name for name, _ in legacy_ranked]
+        # Prefix expansion is now also bounded by posting count, so very common
+        # prefixes may legitimately match fewer tracks
+        note = '' if total == legacy_total else f' (legacy total {legacy_total})'
+        print(f"{query!r:<14} {total:>7} {legacy_ms:>10.2f} {ms:>8.2f}  {'yes' if same else 'NO'}{note}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Load test /music/<filename>: server CPU per streamed MB, file-wrapper path vs legacy.
+
+Generates a few large dummy tracks, starts the server once per delivery mode
+(STREAM_FILE_WRAPPER=1 and 0) in its own process, and has several client
+processes seek around the tracks with Range requests, like players scrubbing
+through long songs, mixed with full downloads. Server CPU time is read from
+/proc before and after, so this needs Linux.
+
+Usage:
+    python benchmarks/bench_music_streaming.py [--clients 6] [--seconds 10] [--engine waitress]
+"""
+
+import argparse
+import http.client
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SERVER_CODE = """
+import sys
+import app
+app.MUSIC_FOLDER = sys.argv[2]
+app.run_server(int(sys.argv[1]))
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process_cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime and stime are fields 14 and 15 of /proc/<pid>/stat
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def start_server(port, music_folder, engine, file_wrapper):
+    env = dict(os.environ, SERVER_ENGINE=engine, STREAM_FILE_WRAPPER='1' if file_wrapper else '0')
+    proc = subprocess.Popen(
+        [sys.executable, '-c', SERVER_CODE, str(port), music_folder],
+        cwd=PROJECT_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def client(args):
+    """Seek around the tracks with one keep-alive connection; returns (bytes, requests, errors)"""
+    port, tracks, deadline, seed = args
+    rng = random.Random(seed)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    received = requests = errors = 0
+    while time.time() < deadline:
+        name, size = rng.choice(tracks)
+        roll = rng.random()
+        if roll < 0.1:
+            headers = {}  # Full download
+        elif roll < 0.2:
+            start = rng.randrange(size)
+            headers = {'Range': f'bytes={start}-'}  # Play from a seek point to the end
+        else:
+            start = rng.randrange(size)
+            headers = {'Range': f'bytes={start}-{start + rng.randint(64, 1024) * 1024 - 1}'}
+        try:
+            conn.request('GET', f'/music/{name}', headers=headers)
+            response = conn.getresponse()
+            while True:
+                chunk = response.read(256 * 1024)
+                if not chunk:
+                    break
+                received += len(chunk)
+            if response.status not in (200, 206):
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        requests += 1
+    conn.close()
+    return received, requests, errors
+
+
+def run_mode(file_wrapper, engine, music_folder, tracks, clients, seconds):
+    port = free_port()
+    proc = start_server(port, music_folder, engine, file_wrapper)
+    try:
+        client((port, tracks, time.time() + 1, 0))  # Warm up
+        cpu_before = process_cpu_seconds(proc.pid)
+        deadline = time.time() + seconds
+        with multiprocessing.Pool(clients) as pool:
+            results = pool.map(client, [(port, tracks, deadline, seed) for seed in range(1, clients + 1)])
+        cpu = process_cpu_seconds(proc.pid) - cpu_before
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    megabytes = sum(r[0] for r in results) / (1024 * 1024)
+    return {
+        'mb': megabytes,
+        'requests': sum(r[1] for r in results),
+        'errors': sum(r[2] for r in results),
+        'cpu': cpu,
+        'cpu_ms_per_mb': cpu * 1000 / megabytes if megabytes else float('nan'),
+        'mb_per_s': megabytes / seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=6, help='concurrent clients (default 6)')
+    parser.add_argument('--seconds', type=float, default=10, help='measurement time per mode (default 10)')
+    parser.add_argument('--engine', default='waitress', help='SERVER_ENGINE to test (default waitress)')
+    parser.add_argument('--tracks', type=int, default=4, help='number of dummy tracks (default 4)')
+    parser.add_argument('--track-mb', type=int, default=40, help='size of each dummy track in MB (default 40)')
+    args = parser.parse_args()
+
+    music_folder = tempfile.mkdtemp(prefix='stream-bench-')
+    try:
+        tracks = []
+        for index in range(args.tracks):
+            name = f'track{index}.mp3'
+            with open(os.path.join(music_folder, name), 'wb') as f:
+                f.write(os.urandom(args.track_mb * 1024 * 1024))
+            tracks.append((name, args.track_mb * 1024 * 1024))
+
+        print(f"{args.clients} clients, {args.seconds:g}s per mode, {args.engine} engine, "
+              f"{args.tracks} x {args.track_mb} MB tracks")
+        print(f"\n{'mode':<14} {'requests':>9} {'errors':>7} {'MB':>9} {'MB/s':>8} {'CPU s':>7} {'CPU ms/MB':>10}")
+        for label, file_wrapper in (('legacy', False), ('file_wrapper', True)):
+            stats = run_mode(file_wrapper, args.engine, music_folder, tracks, args.clients, args.seconds)
+            print(f"{label:<14} {stats['requests']:>9} {stats['errors']:>7} {stats['mb']:>9.1f} "
+                  f"{stats['mb_per_s']:>8.1f} {stats['cpu']:>7.2f} {stats['cpu_ms_per_mb']:>10.3f}")
+    finally:
+        shutil.rmtree(music_folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
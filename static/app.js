@@ -8,6 +8,19 @@ let touchStartX = null;
 let touchStartY = null;
 let currentFontSize = 'medium';
 let deleteTrackIndex = null;
+const lyricsCache = new Map();
+let documentLoadId = 0;
+let lyricsLoadId = 0;
+let libraryRetryTimer = null;
+
+// List view only needs a short lyrics preview; full lyrics are loaded per track on demand
+const TRACK_LIST_FIELDS = 'title,artist,duration,created,lyrics_preview,has_lyrics';
+
+// Rendered width of a pictures grid cell (2/3/4 columns), so the browser picks the right thumbnail size
+const THUMBNAIL_GRID_SIZES = '(min-width: 768px) 25vw, (min-width: 640px) 33vw, 50vw';
+
+// How often to re-fetch while the server is still scanning its libraries after a start
+const LIBRARY_LOADING_RETRY_MS = 1000;
 
 const elements = {
     musicList: document.getElementById('music-list'),
@@ -53,21 +66,32 @@ const elements = {
 
 
 async function fetchAllData() {
-    await Promise.all([fetchMusic(), fetchPictures(), fetchDocuments()]);
-    elements.status.textContent = 'Ready';
+    clearTimeout(libraryRetryTimer);
+    const loading = await Promise.all([fetchMusic(), fetchPictures(), fetchDocuments()]);
     updateFileCount();
+    // Right after a server start the libraries are still being scanned: show what
+    // has loaded so far and check again shortly
+    if (loading.some(Boolean)) {
+        elements.status.textContent = 'Loading library...';
+        libraryRetryTimer = setTimeout(fetchAllData, LIBRARY_LOADING_RETRY_MS);
+    } else {
+        elements.status.textContent = 'Ready';
+    }
 }
     
 async function fetchMusic() {
     try {
-        const response = await fetch('/api/music');
+        const response = await fetch(`/api/music?fields=${TRACK_LIST_FIELDS}`);
         if (response.ok) {
             musicData = await response.json();
+            lyricsCache.clear();
             filteredTracks = musicData;
             if (currentTab === 'music') updateUI();
         }
+        return response.headers.has('X-Library-Loading');
     } catch (error) {
         console.error('Error fetching music:', error);
+        return false;
     }
 }
 
@@ -78,8 +102,10 @@ async function fetchPictures() {
             picturesData = await response.json();
             if (currentTab === 'pictures') updateUI();
         }
+        return response.headers.has('X-Library-Loading');
     } catch (error) {
         console.error('Error fetching pictures:', error);
+        return false;
     }
 }
 
@@ -90,8 +116,10 @@ async function fetchDocuments() {
             documentsData = await response.json();
             if (currentTab === 'documents') updateUI();
         }
+        return response.headers.has('X-Library-Loading');
     } catch (error) {
         console.error('Error fetching documents:', error);
+        return false;
     }
 }
 
@@ -129,14 +157,14 @@ function renderTrackList() {
 
     elements.musicList.innerHTML = filteredTracks.map((track, index) => {
         const isPlaying = musicData[currentTrackIndex]?.filename === track.filename;
-        const lyricsPreview = track.lyrics ? track.lyrics.substring(0, 100) + '...' : 'No lyrics available';
+        const lyricsPreview = track.has_lyrics ? track.lyrics_preview + '...' : 'No lyrics available';
         const actualIndex = musicData.indexOf(track);
 
         return `
             <div class="track-item ${isPlaying ? 'playing' : ''}" data-index="${actualIndex}">
                 <div class="track-title">${escapeHtml(track.title)}</div>
                 <div class="track-artist">${escapeHtml(track.artist)}</div>
-                ${track.lyrics ? `<div class="track-lyrics-preview">${escapeHtml(lyricsPreview)}</div>` : ''}
+                ${track.has_lyrics ? `<div class="track-lyrics-preview">${escapeHtml(lyricsPreview)}</div>` : ''}
                 <div class="track-meta">
                     <span>${formatDuration(track.duration)}</span>
                     <span>${formatDate(track.created)}</span>
@@ -145,7 +173,7 @@ function renderTrackList() {
                     <button class="action-btn" onclick="playTrack(${actualIndex})" title="${isPlaying ? 'Pause' : 'Play'}">
                         ${isPlaying ? '<i data-lucide="pause" class="w-7 h-7"></i>' : '<i data-lucide="play" class="w-7 h-7"></i>'}
                     </button>
-                    ${track.lyrics ? `<button class="action-btn fullscreen-btn" onclick="showFullscreenLyrics(${actualIndex})" title="Fullscreen Lyrics"><i data-lucide="maximize" class="w-7 h-7"></i></button>` : ''}
+                    ${track.has_lyrics ? `<button class="action-btn fullscreen-btn" onclick="showFullscreenLyrics(${actualIndex})" title="Fullscreen Lyrics"><i data-lucide="maximize" class="w-7 h-7"></i></button>` : ''}
                     <button class="action-btn delete-btn" onclick="confirmDeleteTrack(${actualIndex})" title="Delete">
                         <i data-lucide="trash-2" class="w-7 h-7"></i>
                     </button>
@@ -172,7 +200,10 @@ function renderPicturesGrid() {
 
     elements.picturesGrid.innerHTML = picturesData.map((pic, index) => `
         <div class="bg-white/90 dark:bg-gray-800/90 rounded-xl overflow-hidden shadow-sm hover:shadow-md transition-all cursor-pointer aspect-square relative group" onclick="showFullscreenImage(${index})">
-            <img src="${pic.thumbnail_url}" alt="${escapeHtml(pic.title)}" loading="lazy" class="w-full h-full object-cover transition-transform duration-300 group-hover:scale-110">
+            <picture>
+                ${pic.thumbnail_srcset && pic.thumbnail_srcset.webp ? `<source type="image/webp" srcset="${pic.thumbnail_srcset.webp}" sizes="${THUMBNAIL_GRID_SIZES}">` : ''}
+                <img src="${pic.thumbnail_url}" ${pic.thumbnail_srcset ? `srcset="${pic.thumbnail_srcset.jpeg}" sizes="${THUMBNAIL_GRID_SIZES}"` : ''} alt="${escapeHtml(pic.title)}" loading="lazy" class="w-full h-full object-cover transition-transform duration-300 group-hover:scale-110">
+            </picture>
             <div class="absolute bottom-0 left-0 right-0 bg-gradient-to-t from-black/80 via-black/40 to-transparent p-2 opacity-0 group-hover:opacity-100 transition-opacity flex flex-col justify-end h-1/2">
                 <div class="text-white text-sm font-semibold truncate">${escapeHtml(pic.title)}</div>
             </div>
@@ -226,21 +257,38 @@ async function openDocument(index) {
         return;
     }
 
+    // Rendered server-side; long documents arrive in pages split at headings
+    const loadId = ++documentLoadId;
     try {
         elements.status.textContent = 'Opening document...';
-        const response = await fetch(doc.url);
-        if (!response.ok) throw new Error(`Failed to load ${doc.filename}`);
-        const text = await response.text();
-        const html = markdownToHtml(text);
-        showDocumentViewer(doc, html);
+        let page = await fetchDocumentPage(doc, 0);
+        showDocumentViewer(doc, page.html || '<p>No content</p>');
         elements.status.textContent = 'Ready';
+        while (page.next_page !== null && loadId === documentLoadId) {
+            page = await fetchDocumentPage(doc, page.next_page);
+            if (loadId !== documentLoadId) break;
+            elements.documentContent.insertAdjacentHTML('beforeend', page.html);
+        }
     } catch (error) {
         console.error('Error opening document:', error);
+        if (loadId !== documentLoadId) return;
         showError('Could not open document; downloaded instead.');
         window.open(doc.url, '_blank');
     }
 }
 
+async function fetchDocumentPage(doc, page, retries = 5) {
+    const response = await fetch(`${doc.url}/html?page=${page}`);
+    if (response.status === 503 && retries > 0) {
+        // Still rendering: wait as the server asks, then try again
+        const delay = (parseInt(response.headers.get('Retry-After'), 10) || 2) * 1000;
+        await new Promise(resolve => setTimeout(resolve, delay));
+        return fetchDocumentPage(doc, page, retries - 1);
+    }
+    if (!response.ok) throw new Error(`Failed to load ${doc.filename}`);
+    return response.json();
+}
+
 function showDocumentViewer(doc, html) {
     elements.documentTitle.textContent = doc.title || doc.filename;
     elements.documentContent.innerHTML = html;
@@ -249,132 +297,12 @@ function showDocumentViewer(doc, html) {
 }
 
 function hideDocumentViewer() {
+    documentLoadId++;  // Stop appending pages of the document being closed
     elements.documentViewer.classList.add('hidden');
     elements.documentViewer.style.display = 'none';
     elements.documentContent.innerHTML = '';
 }
 
-function markdownToHtml(markdown) {
-    const lines = markdown.replace(/\r\n/g, '\n').split('\n');
-    let html = '';
-    let inList = false;
-    let listTag = '';
-    let inCode = false;
-    for (let idx = 0; idx < lines.length; idx++) {
-        const line = lines[idx];
-
-        if (line.trim().startsWith('```')) {
-            if (!inCode) {
-                inCode = true;
-                html += '<pre><code>';
-            } else {
-                inCode = false;
-                html += '</code></pre>';
-            }
-            continue;
-        }
-
-        if (inCode) {
-            html += `${escapeHtml(line)}\n`;
-            continue;
-        }
-
-        // Tables: header | header2
-        const nextLine = lines[idx + 1] || '';
-        const isTableHeader = line.includes('|') && /^\s*\|?(.+\|)+.+\|?\s*$/.test(line);
-        const isSeparator = /^\s*\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)+\|?\s*$/.test(nextLine);
-        if (isTableHeader && isSeparator) {
-            if (inList) {
-                html += listTag === 'ol' ? '</ol>' : '</ul>';
-                inList = false;
-                listTag = '';
-            }
-            const headers = line.split('|').map((cell) => inlineMarkdown(cell.trim())).filter(Boolean);
-            const rows = [];
-            idx += 1; // skip separator line
-            while (idx + 1 < lines.length) {
-                const rowLine = lines[idx + 1];
-                if (!rowLine.includes('|')) break;
-                rows.push(rowLine.split('|').map((cell) => inlineMarkdown(cell.trim())).filter(Boolean));
-                idx += 1;
-            }
-            html += '<table class="doc-table"><thead><tr>';
-            headers.forEach((h) => html += `<th>${h}</th>`);
-            html += '</tr></thead><tbody>';
-            rows.forEach((row) => {
-                html += '<tr>';
-                row.forEach((cell) => html += `<td>${cell}</td>`);
-                html += '</tr>';
-            });
-            html += '</tbody></table>';
-            continue;
-        }
-
-        const headingMatch = line.match(/^(#{1,6})\s+(.*)$/);
-        if (headingMatch) {
-            const level = headingMatch[1].length;
-            html += `<h${level}>${inlineMarkdown(headingMatch[2])}</h${level}>`;
-            continue;
-        }
-
-        const listMatch = line.match(/^[-*]\s+(.*)$/);
-        const orderedMatch = line.match(/^\d+\.\s+(.*)$/);
-        if (listMatch || orderedMatch) {
-            const targetTag = orderedMatch ? 'ol' : 'ul';
-            if (!inList || listTag !== targetTag) {
-                if (inList) {
-                    html += listTag === 'ol' ? '</ol>' : '</ul>';
-                }
-                html += targetTag === 'ol' ? '<ol>' : '<ul>';
-                inList = true;
-                listTag = targetTag;
-            }
-            const content = orderedMatch ? orderedMatch[1] : listMatch[1];
-            html += `<li>${inlineMarkdown(content)}</li>`;
-            continue;
-        }
-
-        if (inList) {
-            html += listTag === 'ol' ? '</ol>' : '</ul>';
-            inList = false;
-            listTag = '';
-        }
-
-        const blockquoteMatch = line.match(/^>\s?(.*)$/);
-        if (blockquoteMatch) {
-            html += `<blockquote>${inlineMarkdown(blockquoteMatch[1])}</blockquote>`;
-            continue;
-        }
-
-        if (/^(-{3,}|_{3,}|\*{3,})$/.test(line.trim())) {
-            html += '<hr>';
-            continue;
-        }
-
-        if (line.trim() === '') {
-            html += '';
-            continue;
-        }
-
-        html += `<p>${inlineMarkdown(line)}</p>`;
-    }
-
-    if (inList) html += '</ul>';
-    if (inCode) html += '</code></pre>';
-    return html || '<p>No content</p>';
-}
-
-function inlineMarkdown(text) {
-    let escaped = escapeHtml(text);
-    escaped = escaped.replace(/\*\*(.+?)\*\*/g, '<strong>$1</strong>');
-    escaped = escaped.replace(/\*(.+?)\*/g, '<em>$1</em>');
-    escaped = escaped.replace(/`([^`]+)`/g, '<code>$1</code>');
-    escaped = escaped.replace(/!\[(.*?)\]\((.+?)\)/g, '<img src="$2" alt="$1" loading="lazy">');
-    escaped = escaped.replace(/\[(.+?)\]\((.+?)\)/g, '<a href="$2" target="_blank" rel="noopener noreferrer">$1</a>');
-    escaped = escaped.replace(/(\bhttps?:\/\/[^\s<]+)/g, '<a href="$1" target="_blank" rel="noopener noreferrer">$1</a>');
-    return escaped;
-}
-
 // Image Viewer Logic
 function showFullscreenImage(index) {
     if (index < 0 || index >= picturesData.length) return;
@@ -509,21 +437,46 @@ function playNextTrack() {
     }
 }
 
-function showFullscreenLyrics(index) {
+async function fetchLyrics(track) {
+    if (lyricsCache.has(track.filename)) return lyricsCache.get(track.filename);
+
+    const response = await fetch(`/api/music/${encodeURIComponent(track.filename)}`);
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+    const details = await response.json();
+    lyricsCache.set(track.filename, details.lyrics || '');
+    return details.lyrics || '';
+}
+
+async function showFullscreenLyrics(index) {
     if (index < 0 || index >= musicData.length) return;
 
     const track = musicData[index];
+    const loadId = ++lyricsLoadId;
+    const content = document.getElementById('fullscreen-lyrics-content');
     document.getElementById('fullscreen-title').textContent = track.title;
     document.getElementById('fullscreen-artist').textContent = track.artist;
-    document.getElementById('fullscreen-lyrics-content').textContent = track.lyrics || 'No lyrics available';
+    content.textContent = track.lyrics_preview || 'Loading lyrics...';
     document.getElementById('fullscreen-lyrics').classList.remove('hidden');
     document.getElementById('fullscreen-lyrics').style.display = 'flex';
 
     currentFontSize = 'medium';
     updateFontSize();
+
+    try {
+        const lyrics = await fetchLyrics(track);
+        if (loadId !== lyricsLoadId) return;  // Another track was opened (or the panel closed) meanwhile
+        content.textContent = lyrics || 'No lyrics available';
+    } catch (error) {
+        if (loadId !== lyricsLoadId) return;
+        console.error('Error fetching lyrics:', error);
+        showError(`Failed to load lyrics: ${error.message}`);
+    }
 }
 
 function hideFullscreenLyrics() {
+    lyricsLoadId++;  // Drop a lyrics response still in flight
     document.getElementById('fullscreen-lyrics').classList.add('hidden');
     document.getElementById('fullscreen-lyrics').style.display = 'none';
 }
@@ -35,6 +35,11 @@ async function loadCurrentStatus() {
         const response = await fetch('/api/wifi/status');
         const data = await response.json();
 
+        if (data.pending) {
+            // The server's first status poll hasn't finished yet
+            setTimeout(loadCurrentStatus, 1000);
+            return;
+        }
         if (data.connected) {
             currentSsidEl.textContent = data.ssid;
             currentSignalEl.textContent = `Signal: ${data.signal || 'N/A'}`;
@@ -62,21 +67,27 @@ function setupEventListeners() {
     restartBtn.addEventListener('click', restartServer);
 }
 
-// Load available WiFi networks
+// Load available WiFi networks: cached results come back at once, and if the
+// server started a rescan we long-poll for its results and refresh the list
 async function loadNetworks() {
     try {
         const response = await fetch('/api/wifi/networks');
-        const data = await response.json();
+        let data = await response.json();
 
         if (!response.ok) {
             throw new Error(data.error || 'Failed to load networks');
         }
 
-        networks = data.networks || [];
-        displayNetworks();
-        hideLoading();
-        showForm();
+        // Nothing usable cached yet (no scan, or the last one failed): keep the
+        // spinner up until the rescan finishes
+        if (data.scanning && (!data.scanned_at || !data.success)) {
+            data = await waitForScan(data.job_id);
+        }
+        showNetworks(data);
 
+        if (data.scanning) {
+            showNetworks(await waitForScan(data.job_id));
+        }
     } catch (error) {
         console.error('Error loading networks:', error);
         showError(`Failed to load WiFi networks: ${error.message}`);
@@ -84,6 +95,30 @@ async function loadNetworks() {
     }
 }
 
+async function waitForScan(jobId) {
+    let data;
+    do {
+        const response = await fetch(`/api/wifi/networks/scans/${jobId}?timeout=20`);
+        data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || 'WiFi scan failed');
+        }
+    } while (data.scanning);
+    return data;
+}
+
+function showNetworks(data) {
+    // Keep the user's choice if it is still in the refreshed list
+    const selectedSsid = networkSelectEl.value;
+    networks = data.networks || [];
+    displayNetworks();
+    if (selectedSsid && networks.some(network => network.ssid === selectedSsid)) {
+        networkSelectEl.value = selectedSsid;
+    }
+    hideLoading();
+    showForm();
+}
+
 // Display networks in dropdown
 function displayNetworks() {
     if (networks.length === 0) {
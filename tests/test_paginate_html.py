@@ -0,0 +1,51 @@
+"""paginate_html must only break pages between top-level blocks."""
+
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import app  # noqa: E402
+
+CONTAINERS = ('ul', 'ol', 'li', 'blockquote', 'pre', 'table')
+
+
+def assert_balanced(page):
+    for tag in CONTAINERS:
+        opened = len(re.findall(rf'<{tag}[\s>]', page))
+        closed = page.count(f'</{tag}>')
+        assert opened == closed, f"unbalanced <{tag}> in page: {page[:200]!r}"
+
+
+def paginate_markdown(text, page_chars):
+    html = app.markdown_to_html(text)
+    pages = app.paginate_html(html, page_chars)
+    assert '\n'.join(pages) == html
+    return pages
+
+
+def test_long_list_with_nested_headings_stays_on_one_page():
+    items = '\n\n'.join(f"- ## Item heading {i}\n\n    item body {i} " + 'x' * 80 for i in range(40))
+    text = f"# Intro\n\nSome text.\n\n{items}\n\n# After\n\nMore text."
+    pages = paginate_markdown(text, page_chars=300)
+    assert len(pages) == 2
+    for page in pages:
+        assert_balanced(page)
+    assert pages[0].count('<h2>') == 40
+    assert pages[1].startswith('<h1>After</h1>')
+
+
+def test_blockquote_crossing_the_page_size_is_not_split():
+    quote = '\n>\n'.join(f"> ## Quoted heading {i}\n> " + 'y' * 120 for i in range(20))
+    text = f"# Start\n\n{quote}\n\n## Next section\n\nText."
+    pages = paginate_markdown(text, page_chars=200)
+    for page in pages:
+        assert_balanced(page)
+    assert any('<blockquote>' in page and '</blockquote>' in page for page in pages)
+
+
+def test_top_level_headings_still_start_pages():
+    text = '\n\n'.join(f"## Section {i}\n\n" + 'z' * 150 for i in range(6))
+    pages = paginate_markdown(text, page_chars=100)
+    assert len(pages) == 6
+    assert all(page.startswith('<h2>') for page in pages)